@@ -0,0 +1,317 @@
+"""
+Reproducible benchmark for the API.
+
+Seeds a throwaway SQLite database with a configurable amount of characters,
+planets, users and favorites, then measures every route in src/main.py
+twice: in-process through the Flask test client, and over HTTP against a
+real server process with several load generator processes. Latency
+percentiles, throughput and peak memory go to a JSON file so CI can diff
+two runs.
+
+    $ python benchmarks/run.py --characters 100000 --planets 20000 --output bench.json
+    $ python benchmarks/run.py --compare old.json bench.json
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+
+def load_app(db_path):
+    os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + db_path
+    os.environ['SNAPSHOT_DIR'] = os.path.join(os.path.dirname(db_path), 'snapshots')
+    if SRC not in sys.path:
+        sys.path.insert(0, SRC)
+    from main import create_app
+    return create_app()
+
+
+def seed(app, options):
+    from sqlalchemy import insert
+    from models import db, User, Character, Planet, FavoritesCharacters, FavoritesPlanets
+    from popularity import POPULARITY_KINDS, rebuild_popularity
+
+    rnd = random.Random(options.seed)
+    genders = ('male', 'female', 'n/a', 'hermaphrod')
+    colors = ('blue', 'brown', 'yellow', 'red', 'black')
+    climates = ('arid', 'temperate', 'frozen', 'murky', 'tropical')
+    terrains = ('desert', 'grasslands', 'mountains', 'jungle', 'ocean')
+
+    def batches(rows, size=5000):
+        for start in range(0, len(rows), size):
+            yield rows[start:start + size]
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        characters = [{
+            'id': i, 'name': 'Character %d' % i, 'url': 'https://swapi.dev/api/people/%d/' % i,
+            'gender': rnd.choice(genders), 'eye_color': rnd.choice(colors), 'hair_color': rnd.choice(colors),
+            'skin_color': rnd.choice(colors), 'birth_year': '%dBBY' % rnd.randint(1, 900),
+            'height': rnd.randint(60, 260), 'mass': rnd.randint(20, 1400),
+        } for i in range(1, options.characters + 1)]
+        planets = [{
+            'id': i, 'name': 'Planet %d' % i, 'url': 'https://swapi.dev/api/planets/%d/' % i,
+            'diameter': rnd.randint(0, 200000), 'orbital_period': rnd.randint(100, 5000),
+            'rotation_period': rnd.randint(6, 60), 'climate': rnd.choice(climates), 'terrain': rnd.choice(terrains),
+            'population': rnd.randint(0, 2 * 10 ** 9), 'surface_water': rnd.randint(0, 100), 'gravity': rnd.randint(0, 4),
+        } for i in range(1, options.planets + 1)]
+        users = [{'id': i, 'email': 'user%d@example.com' % i, 'password': 'x', 'is_active': True}
+                 for i in range(1, options.users + 1)]
+        fav_characters, fav_planets = set(), set()
+        for _ in range(options.favorites):
+            user = rnd.randint(1, options.users)
+            fav_characters.add((user, rnd.randint(1, options.characters)))
+            fav_planets.add((user, rnd.randint(1, options.planets)))
+
+        for model, rows in ((Character, characters), (Planet, planets), (User, users),
+                            (FavoritesCharacters, [{'id_user': u, 'id_character': c} for u, c in sorted(fav_characters)]),
+                            (FavoritesPlanets, [{'id_user': u, 'id_planet': p} for u, p in sorted(fav_planets)])):
+            for batch in batches(rows):
+                db.session.execute(insert(model.__table__), batch)
+        for kind in POPULARITY_KINDS:
+            rebuild_popularity(kind)
+        db.session.commit()
+
+
+def scenarios(options):
+    """(name, method, path, json body, untimed request run before) for every route."""
+    rnd = random.Random(options.seed + 1)
+    character = lambda: rnd.randint(1, options.characters)
+    planet = lambda: rnd.randint(1, options.planets)
+    user = lambda: rnd.randint(1, options.users)
+    # the write scenarios use a user with no seeded favorites, and an untimed request
+    # before each one puts the row in the state the measured request expects
+    writer = options.users + 1
+    add_character = '/favorite/character?id_user=%d&id_character=1' % writer
+    add_planet = '/favorite/planet?id_user=%d&id_planet=1' % writer
+    return [
+        ('sitemap', 'GET', lambda: '/', None, None),
+        ('openapi', 'GET', lambda: '/openapi.json', None, None),
+        ('people_all', 'GET', lambda: '/people', None, None),
+        ('people_snapshot', 'GET', lambda: '/snapshot/people', None, None),
+        ('people_page', 'GET', lambda: '/people?limit=100&after=%d' % character(), None, None),
+        ('people_stream', 'GET', lambda: '/people?stream=true', None, None),
+        ('people_filtered', 'GET', lambda: '/people?fields=id,name&gender=female&height_min=150&limit=100', None, None),
+        ('people_top', 'GET', lambda: '/people/top?limit=20', None, None),
+        ('people_stats', 'GET', lambda: '/stats/people?by=gender&columns=height,mass', None, None),
+        ('planets_stats', 'GET', lambda: '/stats/planets?by=climate&columns=population', None, None),
+        ('people_ids', 'GET', lambda: '/people?ids=%s' % ','.join(str(character()) for _ in range(50)), None, None),
+        ('people_batch', 'POST', lambda: '/people/batch', lambda: {'ids': [character() for _ in range(200)]}, None),
+        ('character', 'GET', lambda: '/character/%d' % character(), None, None),
+        ('planets_all', 'GET', lambda: '/planets', None, None),
+        ('planets_page', 'GET', lambda: '/planets?limit=100&after=%d' % planet(), None, None),
+        ('planets_top', 'GET', lambda: '/planets/top?limit=20', None, None),
+        ('planet', 'GET', lambda: '/planets/%d' % planet(), None, None),
+        ('search', 'GET', lambda: '/search?q=%s' % rnd.choice(('c', 'char', 'planet+%d' % planet(), 'arid', 'jung')), None, None),
+        ('users', 'GET', lambda: '/users', None, None),
+        ('user_favorites', 'GET', lambda: '/users/favorites?id_user=%d' % user(), None, None),
+        ('user_favorites_expanded', 'GET', lambda: '/users/favorites?id_user=%d&expand=true' % user(), None, None),
+        ('health_db', 'GET', lambda: '/health/db', None, None),
+        ('favorite_character_add', 'POST', lambda: add_character, None, ('DELETE', add_character)),
+        ('favorite_character_delete', 'DELETE', lambda: add_character, None, ('POST', add_character)),
+        ('favorite_planet_add', 'POST', lambda: add_planet, None, ('DELETE', add_planet)),
+        ('favorite_planet_delete', 'DELETE', lambda: add_planet, None, ('POST', add_planet)),
+        ('favorites_batch', 'POST', lambda: '/favorites/batch', lambda: {
+            'id_user': writer,
+            'character': {'add': [2, 3], 'remove': [2, 3]},
+            'planets': {'add': [2], 'remove': [2]},
+        }, None),
+    ]
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    maxrss = resource.getrusage(who).ru_maxrss
+    return round(maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 2)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    # nearest-rank
+    index = max(0, int(math.ceil(pct / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, errors):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+    }
+
+
+def run_test_client(app, options):
+    from models import db, User
+    with app.app_context():
+        db.session.add(User(email='writer@example.com', password='x', is_active=True))
+        db.session.commit()
+
+    client = app.test_client()
+    results = {}
+    for name, method, path, body, before in scenarios(options):
+        for _ in range(options.warmup):
+            if before:
+                client.open(before[1], method=before[0])
+            client.open(path(), method=method, json=body() if body else None)
+        latencies, errors = [], 0
+        elapsed = 0.0
+        for _ in range(options.iterations):
+            if before:
+                client.open(before[1], method=before[0])
+            request_started = time.perf_counter()
+            response = client.open(path(), method=method, json=body() if body else None)
+            response.get_data()
+            latencies.append(time.perf_counter() - request_started)
+            elapsed += latencies[-1]
+            errors += response.status_code >= 500
+        results[name] = summarize(latencies, elapsed, errors)
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def serve(db_path, port, ready):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app = load_app(db_path)
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    ready.set()
+    server.serve_forever()
+
+
+def load_worker(args):
+    # only the GET routes: concurrent writers would race on the same favorites rows
+    port, options, duration, worker = args
+    options.seed += worker
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    plan = [(name, method, path) for name, method, path, _, _ in scenarios(options) if method == 'GET']
+    latencies = {name: [] for name, _, _ in plan}
+    errors = {name: 0 for name, _, _ in plan}
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        for name, method, path in plan:
+            started = time.perf_counter()
+            try:
+                conn.request(method, path())
+                response = conn.getresponse()
+                response.read()
+                failed = response.status >= 500
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                failed = True
+            latencies[name].append(time.perf_counter() - started)
+            errors[name] += failed
+    return latencies, errors
+
+
+def run_http(db_path, options):
+    ctx = multiprocessing.get_context('spawn')
+    ready = ctx.Event()
+    server = ctx.Process(target=serve, args=(db_path, options.port, ready), daemon=True)
+    server.start()
+    if not ready.wait(60):
+        raise RuntimeError('el servidor no arranco')
+    time.sleep(0.2)
+
+    started = time.perf_counter()
+    with ctx.Pool(options.workers) as pool:
+        outcomes = pool.map(load_worker, [(options.port, options, options.duration, i) for i in range(options.workers)])
+    elapsed = time.perf_counter() - started
+    server.terminate()
+    server.join()
+
+    merged, errors = {}, {}
+    for latencies, failed in outcomes:
+        for name, values in latencies.items():
+            merged.setdefault(name, []).extend(values)
+            errors[name] = errors.get(name, 0) + failed[name]
+    results = {name: summarize(values, elapsed, errors[name]) for name, values in merged.items()}
+    total = sum(len(values) for values in merged.values())
+    results['total'] = summarize([x for values in merged.values() for x in values], elapsed, sum(errors.values()))
+    results['total']['throughput_rps'] = round(total / elapsed, 2)
+    # largest of the server and the load generators
+    results['peak_rss_children_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return results
+
+
+def compare(old_path, new_path, threshold):
+    """Prints p95 changes between two result files; exits 1 if any got slower than `threshold` percent."""
+    with open(old_path) as fp:
+        old = json.load(fp)
+    with open(new_path) as fp:
+        new = json.load(fp)
+    regressions = 0
+    for mode in ('test_client', 'http'):
+        for name, stats in sorted(new.get(mode, {}).items()):
+            before = old.get(mode, {}).get(name)
+            if not isinstance(stats, dict) or not isinstance(before, dict) or not before.get('p95_ms'):
+                continue
+            change = (stats['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+            flag = ' <-- REGRESION' if change > threshold else ''
+            regressions += bool(flag)
+            print('%-12s %-28s p95 %9.3f -> %9.3f ms (%+.1f%%)%s' % (mode, name, before['p95_ms'], stats['p95_ms'], change, flag))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--characters', type=int, default=10000)
+    parser.add_argument('--planets', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--favorites', type=int, default=5000, help='favoritos por tipo (aprox.)')
+    parser.add_argument('--iterations', type=int, default=50, help='peticiones por ruta con el test client')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=4, help='procesos generadores de carga HTTP')
+    parser.add_argument('--duration', type=float, default=10.0, help='segundos de carga HTTP')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-http', action='store_true')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compara dos resultados y sale')
+    parser.add_argument('--threshold', type=float, default=10.0, help='%% de p95 que cuenta como regresion')
+    options = parser.parse_args()
+
+    if options.compare:
+        sys.exit(compare(options.compare[0], options.compare[1], options.threshold))
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix='swapi-bench-'), 'bench.db')
+    app = load_app(db_path)
+    seed_started = time.perf_counter()
+    seed(app, options)
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': {k: v for k, v in vars(options).items() if k not in ('compare', 'output')},
+            'seed_seconds': round(time.perf_counter() - seed_started, 2),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'test_client': run_test_client(app, options),
+    }
+    if not options.skip_http:
+        report['http'] = run_http(db_path, options)
+
+    with open(options.output, 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    print('Resultados en %s' % options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Startup time of a worker per configuration profile.
+
+Every run is a fresh interpreter that imports src/main.py and calls
+`create_app()`, the work gunicorn repeats each time it boots or recycles a
+worker. Reports the median wall time per profile and, from
+`python -X importtime`, the packages whose modules take longest to import.
+
+    $ python benchmarks/startup.py --profiles development api --runs 7
+    $ python benchmarks/startup.py --output startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# prints the seconds spent importing main and building the app
+BOOT = """
+import time
+started = time.perf_counter()
+from main import create_app
+imported = time.perf_counter()
+create_app()
+print(imported - started, time.perf_counter() - imported)
+"""
+
+
+def boot(profile, db_path, importtime=False):
+    env = dict(os.environ, APP_PROFILE=profile, DB_CONNECTION_STRING='sqlite:///' + db_path)
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', BOOT]
+    return subprocess.run(command, cwd=SRC, env=env, capture_output=True, text=True, check=True)
+
+
+def slowest_imports(stderr, top):
+    """Packages by import time of their own modules (self time), from the `-X importtime` output."""
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    ranked = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    return [{'package': name, 'ms': round(us / 1000.0, 1)} for name, us in ranked]
+
+
+def measure(profile, db_path, runs, top):
+    imports, apps, totals = [], [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        done = boot(profile, db_path)
+        totals.append(time.perf_counter() - started)
+        import_seconds, app_seconds = (float(value) for value in done.stdout.split())
+        imports.append(import_seconds)
+        apps.append(app_seconds)
+    return {
+        'runs': runs,
+        'import_ms': round(statistics.median(imports) * 1000, 1),
+        'create_app_ms': round(statistics.median(apps) * 1000, 1),
+        'startup_ms': round(statistics.median(i + a for i, a in zip(imports, apps)) * 1000, 1),
+        'process_ms': round(statistics.median(totals) * 1000, 1),
+        'slowest_imports': slowest_imports(boot(profile, db_path, importtime=True).stderr, top),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', nargs='+', default=['development', 'api'])
+    parser.add_argument('--runs', type=int, default=5, help='procesos por perfil')
+    parser.add_argument('--top', type=int, default=10, help='paquetes mas lentos a mostrar')
+    parser.add_argument('--output', help='guarda el reporte en JSON')
+    options = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix='swapi-startup-'), 'startup.db')
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'profiles': {},
+    }
+    for profile in options.profiles:
+        result = report['profiles'][profile] = measure(profile, db_path, options.runs, options.top)
+        print('%-12s arranque %8.1f ms (import %.1f ms, create_app %.1f ms, proceso %.1f ms)' % (
+            profile, result['startup_ms'], result['import_ms'], result['create_app_ms'], result['process_ms']))
+        for entry in result['slowest_imports']:
+            print('    %-28s %8.1f ms' % (entry['package'], entry['ms']))
+
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+        print('Resultados en %s' % options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""composite primary keys and foreign keys for favorites
+
+Revision ID: 8c1f4e2a9d37
+Revises: 2550a47b80de
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1f4e2a9d37'
+down_revision = '2550a47b80de'
+branch_labels = None
+depends_on = None
+
+# favorites table -> (id column, catalog table)
+FAVORITES = {
+    'favorites_characters': ('id_character', 'character'),
+    'favorites_planet': ('id_planet', 'planet'),
+}
+
+
+def _rebuild(table_name, id_column, catalog, composite):
+    """Creates the new shape as a temporary table, copies the rows, and swaps it in.
+
+    Done this way instead of ALTER so it works the same on PostgreSQL, MySQL and SQLite.
+    """
+    tmp_name = table_name + '_tmp'
+    columns = [
+        sa.Column('id_user', sa.Integer(), nullable=False),
+        sa.Column(id_column, sa.Integer(), nullable=False),
+    ]
+    if composite:
+        columns += [
+            sa.ForeignKeyConstraint(['id_user'], ['user.id'], name='fk_%s_id_user' % table_name),
+            sa.ForeignKeyConstraint([id_column], [catalog + '.id'], name='fk_%s_%s' % (table_name, id_column), ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('id_user', id_column, name='pk_%s' % table_name),
+        ]
+    else:
+        # unnamed like the original tables, the names above are still taken while both tables exist
+        columns += [
+            sa.ForeignKeyConstraint(['id_user'], ['user.id'], ),
+            sa.PrimaryKeyConstraint('id_user'),
+        ]
+    op.create_table(tmp_name, *columns)
+
+    old = sa.table(table_name, sa.column('id_user'), sa.column(id_column))
+    new = sa.table(tmp_name, sa.column('id_user'), sa.column(id_column))
+    if composite:
+        # drop duplicates and favorites pointing to rows that no longer exist
+        target = sa.table(catalog, sa.column('id'))
+        rows = sa.select(old.c.id_user, old.c[id_column]).distinct().select_from(
+            old.join(target, target.c.id == old.c[id_column]))
+    else:
+        # the old schema only fits one favorite per user, keep the lowest id
+        rows = sa.select(old.c.id_user, sa.func.min(old.c[id_column])).group_by(old.c.id_user)
+    op.execute(new.insert().from_select(['id_user', id_column], rows))
+
+    op.drop_table(table_name)
+    op.rename_table(tmp_name, table_name)
+    if composite:
+        op.create_index(op.f('ix_%s_%s' % (table_name, id_column)), table_name, [id_column], unique=False)
+
+
+def upgrade():
+    for table_name, (id_column, catalog) in FAVORITES.items():
+        _rebuild(table_name, id_column, catalog, composite=True)
+
+
+def downgrade():
+    for table_name, (id_column, catalog) in FAVORITES.items():
+        _rebuild(table_name, id_column, catalog, composite=False)
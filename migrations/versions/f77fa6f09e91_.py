@@ -0,0 +1,45 @@
+"""favorite counters per character and planet
+
+Revision ID: f77fa6f09e91
+Revises: 3e9b7d51c0a4
+Create Date: 2026-10-18 10:36:01.457840
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f77fa6f09e91'
+down_revision = '3e9b7d51c0a4'
+branch_labels = None
+depends_on = None
+
+# counter table -> (id column, catalog table, favorites table)
+COUNTERS = {
+    'character_popularity': ('id_character', 'character', 'favorites_characters'),
+    'planet_popularity': ('id_planet', 'planet', 'favorites_planet'),
+}
+
+
+def upgrade():
+    for table_name, (id_column, catalog, favorites) in COUNTERS.items():
+        op.create_table(table_name,
+        sa.Column(id_column, sa.Integer(), nullable=False),
+        sa.Column('favorites', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint([id_column], [catalog + '.id'], name='fk_%s_%s' % (table_name, id_column), ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint(id_column, name='pk_%s' % table_name)
+        )
+        op.create_index(op.f('ix_%s_favorites' % table_name), table_name, ['favorites'], unique=False)
+
+        # backfill from the favorites that already exist
+        source = sa.table(favorites, sa.column(id_column))
+        counter = sa.table(table_name, sa.column(id_column), sa.column('favorites'))
+        counts = sa.select(source.c[id_column], sa.func.count()).group_by(source.c[id_column])
+        op.execute(counter.insert().from_select([id_column, 'favorites'], counts))
+
+
+def downgrade():
+    for table_name in reversed(list(COUNTERS)):
+        op.drop_index(op.f('ix_%s_favorites' % table_name), table_name=table_name)
+        op.drop_table(table_name)
@@ -3,6 +3,7 @@ from flask_admin import Admin
 from models import db, User, Character, Planet
 from flask_admin.contrib.sqla import ModelView
 
+
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
@@ -10,6 +11,7 @@ def setup_admin(app):
 
     
     # Add your models here, for example this is how we add a the User model to the admin
+    # the cached characters and planets are dropped by the change events of every commit (changes.py)
     admin.add_view(ModelView(User, db.session))
     admin.add_view(ModelView(Character, db.session))
     admin.add_view(ModelView(Planet, db.session))
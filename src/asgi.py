@@ -0,0 +1,455 @@
+"""
+ASGI entry point: the API routes served by async handlers on an async SQLAlchemy engine.
+
+    $ uvicorn asgi:application --app-dir src --workers 2
+
+Needs `uvicorn` (or any ASGI server), `asgiref` and the async driver for the
+database: asyncpg for PostgreSQL, aiomysql for MySQL, aiosqlite for SQLite
+(all in the Pipfile). The URL is derived from DB_CONNECTION_STRING unless
+ASYNC_DB_CONNECTION_STRING is set. Paths not handled here (the admin,
+/metrics, /search, ...) are passed on to the sync Flask app. wsgi.py keeps
+serving the sync app.
+
+The native handlers read from the primary only: DB_REPLICA_URLS and the
+read-your-writes window (see replicas.py) apply to the routes passed on to
+the sync app, not to these.
+"""
+import os
+import re
+import time
+from urllib.parse import parse_qsl, urlencode
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_etags
+from main import create_app
+from cache import MISSING, get_cache, cache_key
+from compression import compress_response, negotiate
+from conditional import make_etag, matching_etag
+from database import engine_options, pool_status
+from metrics import instrument_engine, start_request, record_request_metrics
+from favorites import FAVORITE_KINDS, parse_batch, apply_batch, favorite_ids, add_favorite, remove_favorite
+from favorites import expanded_favorites, MAX_EXPANDED_FAVORITES
+from filters import fields_arg, filter_args
+from lookup import ids_arg, ids_body, lookup_rows
+from models import User, Character, Planet
+from pagination import get_page_args, int_arg, STREAM_CHUNK_SIZE
+from ratelimit import rejection
+from serializers import get_encoder, matches_jsonify
+from utils import APIException
+from versions import get_versions
+
+flask_app = create_app()
+
+ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+    'mariadb': 'mariadb+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_database_url(url):
+    """Swaps the sync driver of a SQLAlchemy URL for its async counterpart."""
+    scheme, rest = url.split('://', 1)
+    return ASYNC_DRIVERS.get(scheme.split('+')[0], scheme) + '://' + rest
+
+
+class Request:
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path'].rstrip('/') or '/'
+        self.args = MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True))
+        self.headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+        self.body = body
+
+    def get_json(self):
+        try:
+            return flask_app.json.loads(self.body) if self.body else None
+        except ValueError:
+            return None
+
+
+def json_response(data, status=200):
+    return flask_app.json.response(data), status
+
+
+def rows_body(encoder, rows):
+    if matches_jsonify():
+        return encoder.encode_rows(rows) + '\n'
+    return flask_app.json.dumps([encoder.to_dict(row) for row in rows], indent=2) + '\n'
+
+
+class ASGIApp:
+
+    def __init__(self, app, url=None):
+        self.app = app
+        sync_url = os.environ.get('DB_CONNECTION_STRING', '')
+        url = url or os.environ.get('ASYNC_DB_CONNECTION_STRING') or async_database_url(sync_url)
+        self.engine = create_async_engine(url, **engine_options(sync_url))
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+        admission = app.extensions.get('admission')
+        if admission is not None and admission.pools:
+            # the native routes wait for this pool, not the sync app's
+            admission.pools.append(self.engine.sync_engine.pool)
+        self.metrics = app.extensions.get('metrics')
+        if self.metrics is not None:
+            instrument_engine(self.engine.sync_engine)
+        # everything else goes to the sync app, so both entry points serve the same routes
+        self.fallback = WsgiToAsgi(app)
+        self.routes = [
+            ('GET', '/people', self.people, 'Hubo un error en traer los personajes'),
+            ('GET', '/character/(?P<id>[0-9]+)', self.single_character, 'Hubo un error en traer un personaje en especifico'),
+            ('POST', '/people/batch', self.people_batch, 'Hubo un error en traer los personajes'),
+            ('GET', '/planets', self.planets, 'Hubo un error en traer los planetas'),
+            ('POST', '/planets/batch', self.planets_batch, 'Hubo un error en traer los planetas'),
+            ('GET', '/planets/(?P<id>[0-9]+)', self.single_planet, 'Hubo un error trayendo un planeta en especifico'),
+            ('GET', '/users', self.users, 'Hubo un error'),
+            ('GET', '/users/favorites', self.user_favs, 'Hubo un error en recuperar los favoritos'),
+            ('POST', '/favorite/character', self.add_character_fav, 'Hubo un error en agregar el personaje a favoritos'),
+            ('POST', '/favorite/planet', self.add_planet_fav, 'Hubo un error en agregar el planeta a favoritos'),
+            ('DELETE', '/favorite/character', self.delete_fav_character, 'Hubo un error eliminando el personaje de favoritos'),
+            ('DELETE', '/favorite/planet', self.delete_fav_planet, 'Hubo un error eliminando el planeta de favoritos'),
+            ('POST', '/favorites/batch', self.batch_favs, 'Hubo un error actualizando los favoritos'),
+            ('GET', '/health/db', self.health_db, 'Hubo un error'),
+        ]
+        self.routes = [(method, re.compile(pattern + '$'), handler, msg) for method, pattern, handler, msg in self.routes]
+        self.labels = {handler: self.route_label(method, pattern) for method, pattern, handler, _ in self.routes}
+
+    def route_label(self, method, pattern):
+        """The Flask rule of the same route, so /metrics has one series whichever app served it."""
+        path = re.sub(r'\(\?P<\w+>[^)]*\)', '1', pattern.pattern[:-1])
+        try:
+            rule, _ = self.app.url_map.bind('').match(path, method=method, return_rule=True)
+            return rule.rule
+        except Exception:
+            return path
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        route, params = self.match(scope)
+        if route is None:
+            return await self.fallback(scope, receive, send)
+
+        body = b''
+        more = True
+        while more:
+            message = await receive()
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+        request = Request(scope, body)
+        if request.method == 'HEAD':
+            send = self.headers_only(send)
+
+        admission = self.app.extensions.get('admission')
+        if admission is not None:
+            client = admission.client_key(request.headers, (scope.get('client') or ('',))[0])
+            rejected = admission.enter(request.method, request.path, client)
+            if rejected is not None:
+                data, status, headers = rejection(*rejected)
+                response, status = json_response(data, status)
+                response.headers.update(headers)
+                return await self.send_response(send, response, status)
+
+        _, _, handler, error_msg = route
+        # the app context gives the handlers the same config, cache and session events as the sync app
+        with self.app.app_context():
+            if self.metrics is not None:
+                start_request()
+                send = self.timed_send(send, self.labels[handler], request.method)
+            try:
+                result = await handler(request, **params)
+            except APIException as error:
+                result = json_response(error.to_dict(), error.status_code)
+            except Exception:
+                self.app.logger.exception('Error en %s %s', request.method, request.path)
+                result = json_response({'msg': error_msg}, 500)
+            try:
+                if isinstance(result, tuple):
+                    await self.send_response(send, *result, accept_encoding=request.headers.get('accept-encoding'))
+                else:
+                    await result(send)
+            finally:
+                if admission is not None:
+                    admission.leave()
+
+    def timed_send(self, send, route, method):
+        """`send` recording the request in /metrics and adding Server-Timing as the response starts."""
+        async def timed(message):
+            if message['type'] == 'http.response.start':
+                server_timing = record_request_metrics(self.metrics, route, method, message['status'], self.app.logger)
+                if server_timing is not None:
+                    message = dict(message, headers=list(message['headers']) + [
+                        (b'server-timing', server_timing.encode('latin-1'))])
+            await send(message)
+        return timed
+
+    def headers_only(self, send):
+        """`send` for a HEAD request: the headers of the GET (Content-Length included), an empty body."""
+        async def head(message):
+            if message['type'] == 'http.response.body':
+                if message.get('more_body', False):
+                    return
+                message = {'type': 'http.response.body', 'body': b''}
+            await send(message)
+        return head
+
+    def match(self, scope):
+        path = scope['path'].rstrip('/') or '/'
+        for route in self.routes:
+            method, pattern, _, _ = route
+            found = pattern.match(path)
+            if found and (method == scope['method'] or (method == 'GET' and scope['method'] == 'HEAD')):
+                return route, {key: int(value) for key, value in found.groupdict().items()}
+        return None, {}
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def send_response(self, send, response, status, accept_encoding=None):
+        response.status_code = status
+        compress_response(response, accept_encoding, self.app.config['COMPRESS_MIN_SIZE'], self.app.config['COMPRESS_LEVEL'])
+        headers = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in response.headers.items()]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+
+    # -- conditional GET ---------------------------------------------------
+
+    async def read_versions(self, names):
+        """Reads the data versions of `names` for this request without blocking the loop (see versions.py)."""
+        async with self.Session() as session:
+            await get_versions().prefetch(names, session)
+
+    async def etag_for(self, request, table, row=None):
+        """The ETag for this request, plus a ready 304 when the client already has it."""
+        await self.read_versions([table] if row is None else [(table, row)])
+        etag = make_etag(get_versions(), (table,), request.path, request.args, row)
+        matched = matching_etag(parse_etags(request.headers.get('if-none-match')), etag)
+        if matched is not None:
+            return etag, self.with_etag((self.app.response_class(status=304), 304), matched)
+        return etag, None
+
+    def with_etag(self, result, etag):
+        response, status = result
+        if status in (200, 304):
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = self.app.config['CATALOG_CACHE_CONTROL']
+        return response, status
+
+    # -- catalog -----------------------------------------------------------
+
+    async def listing(self, request, model):
+        etag, not_modified = await self.etag_for(request, model.__tablename__)
+        if not_modified:
+            return not_modified
+        if not request.args:
+            return self.with_etag(await self.full_listing(request, model), etag)
+        ids = ids_arg(request.args)
+        limit, after, stream = get_page_args(request.args)
+        fields = fields_arg(model, request.args)
+        if ids is not None:
+            return self.with_etag(await self.lookup(model, ids, fields), etag)
+        encoder = get_encoder(model, fields)
+        stmt = encoder.select().where(*filter_args(model, request.args)).order_by(model.id)
+        if after is not None:
+            stmt = stmt.where(model.id > after)
+
+        if stream:
+            if limit is not None:
+                stmt = stmt.limit(limit)
+            return self.stream_rows(stmt, encoder, etag)
+
+        async with self.Session() as session:
+            rows = (await session.execute(stmt if limit is None else stmt.limit(limit + 1))).all()
+        next_after = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_after = rows[-1].id
+        response = self.app.response_class(rows_body(encoder, rows), mimetype='application/json')
+        if next_after is not None:
+            args = request.args.to_dict()
+            args.update(after=next_after, limit=limit)
+            response.headers['Link'] = '<%s?%s>; rel="next"' % (request.path, urlencode(args, safe=','))
+        return self.with_etag((response, 200), etag)
+
+    async def full_listing(self, request, model):
+        """The whole table, served from the precompressed payloads the sync app shares."""
+        payloads = self.app.extensions['precompressed']
+        await self.read_versions([model.__tablename__])
+        fingerprint = get_versions().fingerprint((model.__tablename__,))
+        encoding = negotiate(request.headers.get('accept-encoding'))
+        data = payloads.get(request.path, fingerprint, encoding)
+        if data is MISSING:
+            encoder = get_encoder(model)
+            async with self.Session() as session:
+                rows = (await session.execute(encoder.select().order_by(model.id))).all()
+            data = payloads.set(request.path, fingerprint, rows_body(encoder, rows).encode('utf-8'), encoding)
+        response = self.app.response_class(data, mimetype='application/json')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        return response, 200
+
+    def stream_rows(self, stmt, encoder, etag):
+        """Writes the JSON array as the rows arrive from a server-side cursor."""
+        async def respond(send):
+            headers = [(b'content-type', b'application/json'), (b'etag', ('"%s"' % etag).encode('latin-1')),
+                       (b'cache-control', self.app.config['CATALOG_CACHE_CONTROL'].encode('latin-1'))]
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b'[', 'more_body': True})
+            first = True
+            async with self.Session() as session:
+                result = await session.stream(stmt.execution_options(yield_per=STREAM_CHUNK_SIZE))
+                async for chunk in result.partitions():
+                    items = ','.join([encoder.encode_row(row) for row in chunk])
+                    if not first:
+                        items = ',' + items
+                    first = False
+                    await send({'type': 'http.response.body', 'body': items.encode('ascii'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b']\n'})
+        return respond
+
+    async def lookup(self, model, ids, fields):
+        async with self.Session() as session:
+            found = await session.run_sync(lambda sync_session: lookup_rows(model, ids, fields, sync_session))
+        return json_response(found)
+
+    async def batch_lookup(self, request, model):
+        ids = ids_body(request.get_json())
+        return await self.lookup(model, ids, fields_arg(model, request.args))
+
+    async def single(self, request, model, id, error_msg):
+        etag, not_modified = await self.etag_for(request, model.__tablename__, id)
+        if not_modified:
+            return not_modified
+        cache = get_cache()
+        key = cache_key(model, id)
+        value = cache.get(key)
+        if value is MISSING:
+            async with self.Session() as session:
+                row = await session.get(model, id)
+            if row is None:
+                # same answer the sync view gives for a missing id
+                return json_response({'msg': error_msg}, 500)
+            value = row.serialize()
+            cache.set(key, value)
+        return self.with_etag(json_response(value), etag)
+
+    async def people(self, request):
+        return await self.listing(request, Character)
+
+    async def planets(self, request):
+        return await self.listing(request, Planet)
+
+    async def people_batch(self, request):
+        return await self.batch_lookup(request, Character)
+
+    async def planets_batch(self, request):
+        return await self.batch_lookup(request, Planet)
+
+    async def single_character(self, request, id):
+        return await self.single(request, Character, id, 'Hubo un error en traer un personaje en especifico')
+
+    async def single_planet(self, request, id):
+        return await self.single(request, Planet, id, 'Hubo un error trayendo un planeta en especifico')
+
+    async def users(self, request):
+        encoder = get_encoder(User)
+        async with self.Session() as session:
+            rows = (await session.execute(encoder.select())).all()
+        return self.app.response_class(rows_body(encoder, rows), mimetype='application/json'), 200
+
+    # -- favorites ---------------------------------------------------------
+
+    async def user_favs(self, request):
+        expand = request.args.get('expand', '').lower() in ('1', 'true', 'yes')
+        limit = min(int_arg('limit', 1, request.args) or MAX_EXPANDED_FAVORITES, MAX_EXPANDED_FAVORITES)
+        id_user = int(request.args.get('id_user'))
+        async with self.Session() as session:
+            if expand:
+                def load(sync_session):
+                    characters, more_characters = expanded_favorites(id_user, 'character', limit, sync_session)
+                    planets, more_planets = expanded_favorites(id_user, 'planets', limit, sync_session)
+                    return {'character': characters, 'planets': planets, 'truncated': more_characters or more_planets}
+            else:
+                def load(sync_session):
+                    return {
+                        'character': [{'id_character': x} for x in favorite_ids(id_user, 'character', sync_session)],
+                        'planets': [{'id_planet': x} for x in favorite_ids(id_user, 'planets', sync_session)],
+                    }
+            favs = await session.run_sync(load)
+        return json_response(favs)
+
+    async def add_fav(self, request, kind, msg):
+        _, id_column, _ = FAVORITE_KINDS[kind]
+        id_user = int(request.args.get('id_user'))
+        id = int(request.args.get(id_column))
+        async with self.Session() as session:
+            await session.run_sync(lambda sync_session: add_favorite(id_user, kind, id, sync_session))
+            await session.commit()
+        return json_response({'msg': msg})
+
+    async def delete_fav(self, request, kind, ok_msg, missing_msg):
+        _, id_column, _ = FAVORITE_KINDS[kind]
+        id_user = int(request.args.get('id_user'))
+        id = int(request.args.get(id_column))
+        async with self.Session() as session:
+            removed = await session.run_sync(lambda sync_session: remove_favorite(id_user, kind, id, sync_session))
+            if removed == 0:
+                return json_response({'msg': missing_msg}, 404)
+            await session.commit()
+        return json_response({'msg': ok_msg})
+
+    async def add_character_fav(self, request):
+        return await self.add_fav(request, 'character', 'Personaje agregado a favoritos')
+
+    async def add_planet_fav(self, request):
+        return await self.add_fav(request, 'planets', 'Planeta agregado a favoritos')
+
+    async def delete_fav_character(self, request):
+        return await self.delete_fav(request, 'character', 'Personaje eliminado con éxito', 'Personaje no encontrado en favoritos')
+
+    async def delete_fav_planet(self, request):
+        return await self.delete_fav(request, 'planets', 'Planeta eliminado con éxito', 'Planeta no encontrado en favoritos')
+
+    async def batch_favs(self, request):
+        id_user, changes = parse_batch(request.get_json())
+        async with self.Session() as session:
+            exists = (await session.execute(select(func.count()).select_from(User).where(User.id == id_user))).scalar()
+            if not exists:
+                raise APIException('El usuario no existe', status_code=404)
+
+            def apply(sync_session):
+                return {kind: apply_batch(id_user, kind, adds, removes, sync_session)
+                        for kind, (adds, removes) in changes.items()}
+            results = await session.run_sync(apply)
+            await session.commit()
+        return json_response(results)
+
+    async def health_db(self, request):
+        status = pool_status(self.engine)
+        started = time.perf_counter()
+        try:
+            async with self.engine.connect() as conn:
+                await conn.execute(text('SELECT 1'))
+            status['ok'] = True
+        except Exception as error:
+            status['ok'] = False
+            status['error'] = error.__class__.__name__
+        status['latency_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        return json_response(status, 200 if status['ok'] else 503)
+
+
+application = ASGIApp(flask_app)
@@ -0,0 +1,210 @@
+"""
+Read-through cache for the catalog lookups (characters and planets).
+
+Two tiers: a small LRU living inside each worker process and an optional
+shared tier (redis, or an in-memory stand-in for tests) so every gunicorn
+worker benefits from a row another worker already loaded.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+
+MISSING = object()
+
+
+class LRUCache:
+    """Process-local LRU with a size limit and a time to live per entry."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is MISSING:
+                return MISSING
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemorySharedCache:
+    """Stand-in for the shared tier that keeps everything in this process."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return MISSING
+            return json.loads(value)
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, json.dumps(value))
+
+    def set_many(self, items, ttl=None):
+        for key, value in items.items():
+            self.set(key, value, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class RedisSharedCache:
+    """Shared tier backed by redis (needs the optional `redis` package)."""
+
+    def __init__(self, url):
+        import redis
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        if value is None:
+            return MISSING
+        return json.loads(value)
+
+    def get_many(self, keys):
+        return [MISSING if value is None else json.loads(value) for value in self._client.mget(keys)] if keys else []
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, json.dumps(value), ex=ttl or None)
+
+    def set_many(self, items, ttl=None):
+        pipeline = self._client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(key, json.dumps(value), ex=ttl or None)
+        pipeline.execute()
+
+    def delete(self, key):
+        self._client.delete(key)
+
+
+class ReadThroughCache:
+
+    def __init__(self, local, shared=None, namespace='catalog', ttl=300):
+        self.local = local
+        self.shared = shared
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def _shared_key(self, key):
+        return '%s:%s' % (self.namespace, key)
+
+    def get(self, key):
+        """The value from the first tier that has it, or MISSING."""
+        value = self.local.get(key)
+        if value is not MISSING:
+            return value
+        if self.shared is not None:
+            value = self.shared.get(self._shared_key(key))
+            if value is not MISSING:
+                self.local.set(key, value)
+        return value
+
+    def get_many(self, keys):
+        """{key: value} for the keys found in either tier, one round trip to the shared tier."""
+        found = {}
+        for key in keys:
+            value = self.local.get(key)
+            if value is not MISSING:
+                found[key] = value
+        missing = [key for key in keys if key not in found]
+        if self.shared is not None and missing:
+            for key, value in zip(missing, self.shared.get_many([self._shared_key(key) for key in missing])):
+                if value is not MISSING:
+                    self.local.set(key, value)
+                    found[key] = value
+        return found
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(self._shared_key(key), value, self.ttl)
+
+    def set_many(self, items):
+        for key, value in items.items():
+            self.local.set(key, value)
+        if self.shared is not None and items:
+            self.shared.set_many({self._shared_key(key): value for key, value in items.items()}, self.ttl)
+
+    def get_or_load(self, key, loader):
+        """Returns the cached value for `key`, calling `loader()` on a miss in both tiers."""
+        value = self.get(key)
+        if value is MISSING:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(self._shared_key(key))
+
+
+def shared_cache_from_url(url):
+    if not url:
+        return None
+    if url == 'memory://':
+        return MemorySharedCache()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisSharedCache(url)
+    raise ValueError('CACHE_SHARED_URL no soportada: %s' % url)
+
+
+def setup_cache(app):
+    ttl = int(os.environ.get('CACHE_TTL', 300))
+    local = LRUCache(maxsize=int(os.environ.get('CACHE_SIZE', 1024)), ttl=ttl)
+    shared = shared_cache_from_url(os.environ.get('CACHE_SHARED_URL'))
+    app.extensions['catalog_cache'] = ReadThroughCache(local, shared, ttl=ttl)
+
+
+def get_cache():
+    return current_app.extensions['catalog_cache']
+
+
+def cache_key(model, id):
+    return '%s:%s' % (model.__tablename__, id)
+
+
+def invalidate_row(model, id):
+    get_cache().invalidate(cache_key(model, id))
@@ -0,0 +1,351 @@
+"""
+Change events across processes, event-driven cache invalidation and the
+`/changes?since=` feed.
+
+versions.py captures every committed change and hands a ChangeEvent to the
+listeners of this process. The other workers learn of it from the change
+log itself: each one replays the entries it has not seen yet as remote
+events, at most CHANGES_POLL_INTERVAL seconds after they are written (on
+the next request, no thread involved) and before using any data version
+that counts entries it has not replayed. Nothing else has to run for
+changes to reach every worker; a bus only makes it sooner:
+
+    CHANGES_POLL_INTERVAL    seconds between reads of the change log by each worker (1)
+    CHANGES_BUS_URL          redis://... to also publish the events on redis pub/sub (none by default;
+                             memory:// is the in-process stand-in, it reaches no other worker)
+    CHANGES_SETTLE           seconds before a change shows up in the feed (1), so a transaction
+                             that took its sequence number earlier but committed later is not skipped
+    CHANGES_RETENTION_DAYS   days of change log kept by `flask prune-changes` (7)
+
+Each worker drops the catalog rows named by an event from its local cache
+(the worker that made the change also drops them from the shared tier), so
+admin edits, imports and favorites all invalidate the same way. A worker
+replays its own entries too, dropping rows it already dropped. The ETags
+need no event: the data versions are read from the change log itself.
+
+    GET /changes?since=120&tables=character,planet&limit=500
+
+returns the change log after sequence 120: clients and CDN purgers keep the
+last `next_since` and only fetch the rows that changed. `row` is null when a
+bulk statement did not name its rows; refetch the table then. A `since`
+older than the retained log answers 410.
+
+    $ flask mark-changed character planet      after changing data with raw SQL or a migration
+    $ flask prune-changes --days 7
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, func, select
+from cache import cache_key
+from models import db, Character, Planet, ChangeLog
+from utils import APIException
+from pagination import int_arg
+from versions import ChangeEvent, TRACKED_TABLES, decode_key, mark_changed
+
+DEFAULT_CHANGES_LIMIT = 500
+MAX_CHANGES_LIMIT = 1000
+DEFAULT_SETTLE = 1
+DEFAULT_POLL_INTERVAL = 1
+# entries replayed per read of the log; a worker further behind drops its whole local cache
+MAX_REPLAYED = 5000
+DEFAULT_RETENTION_DAYS = 7
+CACHED_MODELS = {'character': Character, 'planet': Planet}
+# tables of the feed (the popularity counters follow the favorites)
+FEED_TABLES = ('character', 'planet', 'favorites_characters', 'favorites_planet')
+
+
+def encode_event(change, origin):
+    rows = None if change.rows is None else [[list(key) if isinstance(key, tuple) else key, op]
+                                             for key, op in change.rows.items()]
+    return json.dumps({'origin': origin, 'table': change.table, 'rows': rows})
+
+
+def decode_event(message):
+    data = json.loads(message)
+    rows = None if data['rows'] is None else {
+        tuple(key) if isinstance(key, list) else key: op for key, op in data['rows']}
+    return data['origin'], ChangeEvent(data['table'], rows, remote=True)
+
+
+class MemoryBus:
+    """Stand-in for the cross-process bus: delivers to every relay subscribed to this instance."""
+
+    def __init__(self):
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def publish(self, message):
+        with self.lock:
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            callback(message)
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+
+
+class RedisBus:
+    """Redis pub/sub between every worker (needs the optional `redis` package)."""
+
+    def __init__(self, url, channel='changes'):
+        import redis
+        self.channel = channel
+        self._client = redis.Redis.from_url(url)
+
+    def publish(self, message):
+        self._client.publish(self.channel, message)
+
+    def subscribe(self, callback):
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: lambda message: callback(message['data'])})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def bus_from_url(url):
+    if not url:
+        return None
+    if url == 'memory://':
+        return MemoryBus()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBus(url)
+    raise ValueError('CHANGES_BUS_URL no soportada: %s' % url)
+
+
+class ChangeRelay:
+    """Publishes the local events of one app on the bus and replays the remote ones locally."""
+
+    def __init__(self, versions, bus):
+        self.versions = versions
+        self.bus = bus
+        self.origin = os.urandom(8).hex()
+        self.published = 0
+        self.received = 0
+        versions.subscribe(self.publish)
+        bus.subscribe(self.receive)
+
+    def publish(self, change):
+        if change.remote:
+            return
+        try:
+            self.bus.publish(encode_event(change, self.origin))
+            self.published += 1
+        except Exception:
+            # the change is committed and logged; the other workers replay it from the change log
+            current_app.logger.exception('No se pudo publicar el cambio de %s', change.table)
+
+    def receive(self, message):
+        origin, change = decode_event(message)
+        if origin == self.origin:
+            return
+        self.received += 1
+        self.versions.notify(change)
+
+    def render_metrics(self):
+        return [
+            '# TYPE change_events_published_total counter',
+            'change_events_published_total %d' % self.published,
+            '# TYPE change_events_received_total counter',
+            'change_events_received_total %d' % self.received,
+        ]
+
+
+class ChangeLogFollower:
+    """Replays the change log written by every process as remote events to the listeners of this one."""
+
+    def __init__(self, versions, interval=DEFAULT_POLL_INTERVAL, settle=DEFAULT_SETTLE):
+        self.versions = versions
+        self.interval = interval
+        self.settle = settle
+        self.cursor = None  # every entry up to this seq is replayed; None until the first read
+        self.replayed = set()  # the seqs past the cursor already replayed
+        self.events = 0
+        self._next_poll = 0
+        self._lock = threading.Lock()
+
+    def position(self):
+        """(cursor, entries replayed past it), or None before the first read."""
+        with self._lock:
+            return None if self.cursor is None else (self.cursor, len(self.replayed))
+
+    def due(self):
+        return time.monotonic() >= self._next_poll
+
+    def catch_up(self, session, bind=None):
+        """Replays the entries not seen yet, reading them from `bind` (the primary by default)."""
+        bind_arguments = {'bind': db.engine if bind is None else bind}
+        with self._lock:
+            self._next_poll = time.monotonic() + self.interval
+            settled = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=self.settle)
+            if self.cursor is None:
+                # nothing is cached before the first read: start at the end of the log
+                self.cursor = session.execute(select(func.max(ChangeLog.seq)).where(ChangeLog.changed_at <= settled),
+                                              bind_arguments=bind_arguments).scalar() or 0
+            entries = session.execute(
+                select(ChangeLog.seq, ChangeLog.table_name, ChangeLog.row_key, ChangeLog.op, ChangeLog.changed_at)
+                .where(ChangeLog.seq > self.cursor).order_by(ChangeLog.seq).limit(MAX_REPLAYED + 1),
+                bind_arguments=bind_arguments).all()
+            changes = {}  # table -> {key: op}, or None when the rows are unknown
+            if len(entries) > MAX_REPLAYED:
+                changes = dict.fromkeys(TRACKED_TABLES)
+                entries = entries[:MAX_REPLAYED]
+            for entry in entries:
+                if entry.seq in self.replayed:
+                    continue
+                self.replayed.add(entry.seq)
+                rows = changes.setdefault(entry.table_name, {})
+                if entry.row_key is None:
+                    changes[entry.table_name] = None
+                elif rows is not None:
+                    rows[decode_key(entry.row_key)] = entry.op
+            # the cursor only passes settled entries: an older seq may still commit below a younger one
+            for entry in entries:
+                if entry.changed_at > settled and len(entries) <= MAX_REPLAYED:
+                    break
+                self.cursor = entry.seq
+            self.replayed = {seq for seq in self.replayed if seq > self.cursor}
+            for table, rows in changes.items():
+                self.events += 1
+                self.versions.notify(ChangeEvent(table, rows, remote=True))
+
+    def render_metrics(self):
+        return [
+            '# TYPE change_log_events_replayed_total counter',
+            'change_log_events_replayed_total %d' % self.events,
+            '# TYPE change_log_cursor gauge',
+            'change_log_cursor %d' % (self.cursor or 0),
+        ]
+
+
+def cache_invalidator(cache):
+    """A listener dropping the cached rows named by each change."""
+    def invalidate(change):
+        model = CACHED_MODELS.get(change.table)
+        if model is None:
+            return
+        if change.rows is None:
+            # unknown rows: this worker's copies go, the shared tier expires with its TTL
+            cache.local.clear()
+        elif change.remote:
+            for key in change.rows:
+                cache.local.delete(cache_key(model, key))
+        else:
+            for key in change.rows:
+                cache.invalidate(cache_key(model, key))
+    return invalidate
+
+
+def changes_args(args):
+    """Validates `since`, `tables` and `limit` of the feed."""
+    since = int_arg('since', 0, args)
+    if since is None:
+        raise APIException("Falta 'since', el ultimo 'next_since' recibido (0 la primera vez)", status_code=400)
+    tables = FEED_TABLES
+    if args.get('tables'):
+        tables = tuple(name.strip() for name in args['tables'].split(',') if name.strip())
+        unknown = set(tables).difference(FEED_TABLES)
+        if unknown:
+            raise APIException('Tablas desconocidas: %s' % ', '.join(sorted(unknown)), status_code=400,
+                               payload={'tables': list(FEED_TABLES)})
+    limit = min(int_arg('limit', 1, args) or DEFAULT_CHANGES_LIMIT, MAX_CHANGES_LIMIT)
+    return since, tables, limit
+
+
+def _row(table, row_key):
+    if row_key is None:
+        return None
+    columns = [column.name for column in db.metadata.tables[table].primary_key.columns]
+    values = [int(part) if part.lstrip('-').isdigit() else part for part in row_key.split(':')]
+    return values[0] if len(columns) == 1 else dict(zip(columns, values))
+
+
+def settled_seq(session, settle=DEFAULT_SETTLE):
+    """The newest seq a read made now covers: younger entries may still have older ones committing."""
+    query = session.query(func.max(ChangeLog.seq))
+    if settle:
+        settled = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=settle)
+        query = query.filter(ChangeLog.changed_at <= settled)
+    return query.scalar() or 0
+
+
+def changes_since(since, tables, limit, settle=DEFAULT_SETTLE, session=None):
+    """The feed page after `since`, or None when the log no longer goes back that far."""
+    if session is None:
+        session = db.session
+    if since:
+        oldest = session.query(func.min(ChangeLog.seq)).scalar()
+        if oldest is not None and since < oldest - 1:
+            return None
+    query = session.query(ChangeLog).filter(ChangeLog.seq > since, ChangeLog.table_name.in_(tables))
+    if settle:
+        settled = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=settle)
+        query = query.filter(ChangeLog.changed_at <= settled)
+    entries = query.order_by(ChangeLog.seq).limit(limit + 1).all()
+    more = len(entries) > limit
+    entries = entries[:limit]
+    return {
+        'changes': [{
+            'seq': entry.seq,
+            'table': entry.table_name,
+            'row': _row(entry.table_name, entry.row_key),
+            'op': entry.op,
+            'changed_at': entry.changed_at.isoformat() + 'Z',
+        } for entry in entries],
+        'next_since': entries[-1].seq if entries else since,
+        'more': more,
+    }
+
+
+@click.command('mark-changed')
+@click.argument('tables', nargs=-1, required=True, type=click.Choice(TRACKED_TABLES))
+@with_appcontext
+def mark_changed_command(tables):
+    """Records that every row of TABLES may have changed (after raw SQL or a migration)."""
+    for table in tables:
+        mark_changed(db.session, table)
+    db.session.commit()
+    click.echo('Cambios registrados: %s' % ', '.join(tables))
+
+
+@click.command('prune-changes')
+@click.option('--days', type=int, default=None, help='Dias a conservar (CHANGES_RETENTION_DAYS, 7).')
+@with_appcontext
+def prune_changes_command(days):
+    """Deletes the change log older than --days, but for its newest entry."""
+    if days is None:
+        days = int(os.environ.get('CHANGES_RETENTION_DAYS', DEFAULT_RETENTION_DAYS))
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=days)
+    # an empty log would take the data versions back to where they started
+    newest = db.session.execute(select(func.max(ChangeLog.seq))).scalar() or 0
+    removed = db.session.execute(
+        delete(ChangeLog).where(ChangeLog.changed_at < cutoff, ChangeLog.seq < newest)).rowcount
+    db.session.commit()
+    click.echo('%d cambios eliminados' % removed)
+
+
+def setup_changes(app):
+    app.config.setdefault('CHANGES_SETTLE', float(os.environ.get('CHANGES_SETTLE', DEFAULT_SETTLE)))
+    versions = app.extensions['table_versions']
+    versions.subscribe(cache_invalidator(app.extensions['catalog_cache']))
+    follower = versions.follower = app.extensions['change_log_follower'] = ChangeLogFollower(
+        versions, float(os.environ.get('CHANGES_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)), app.config['CHANGES_SETTLE'])
+    bus = bus_from_url(os.environ.get('CHANGES_BUS_URL'))
+    relay = app.extensions['change_relay'] = ChangeRelay(versions, bus) if bus is not None else None
+    if 'metrics' in app.extensions:
+        app.extensions['metrics'].register(follower.render_metrics)
+        if relay is not None:
+            app.extensions['metrics'].register(relay.render_metrics)
+
+    @app.before_request
+    def follow_change_log():
+        if follower.due():
+            follower.catch_up(db.session)
+
+    app.cli.add_command(mark_changed_command)
+    app.cli.add_command(prune_changes_command)
@@ -0,0 +1,130 @@
+"""
+Request coalescing ("single flight") for the catalog reads.
+
+When a page goes viral, hundreds of identical requests arrive at once and
+each would run the same query and serialize the same JSON. Within a worker,
+the first of them runs the view and the others that arrive while it is in
+flight wait for it and get a copy of its response.
+
+    COALESCE_READS   share one execution between concurrent identical reads (true)
+    COALESCE_WAIT    seconds a request waits for the one in flight before running the view itself (10)
+
+Requests are identical when they have the same path, query string and data
+version of the tables the view reads (the same key as the ETag, see
+conditional.py), and both read from the replicas or both from the primary,
+so a client that must read its own writes never gets a replica's answer.
+Streamed responses cannot be shared; the waiting requests run the view
+themselves then. Counted in /metrics as `requests_coalesced_total`.
+"""
+import os
+import threading
+from functools import wraps
+from flask import current_app, request
+from conditional import compute_etag
+from metrics import Counter
+from models import db
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+DEFAULT_WAIT = 10
+
+
+class Flight:
+    """One execution in progress and what it produced."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs `fn` once per key at a time; callers arriving meanwhile share its result."""
+
+    def __init__(self, wait=DEFAULT_WAIT):
+        self.wait = wait
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.leaders = Counter()
+        self.collapsed = Counter()
+        self.timeouts = Counter()
+
+    def do(self, key, fn, label='', shareable=None):
+        """`(result, shared)`: shared is True when another caller ran `fn`. Its errors are raised here too.
+
+        A result failing `shareable(result)` is not handed to the waiting callers, they run `fn` themselves.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.leaders.inc((label,))
+        if leader:
+            try:
+                flight.result = fn()
+                return flight.result, False
+            except BaseException as error:
+                flight.error = error
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+        if not flight.done.wait(self.wait):
+            # the one in flight is stuck: do not pile up behind it
+            with self.lock:
+                self.timeouts.inc((label,))
+            return fn(), False
+        if flight.error is None and shareable is not None and not shareable(flight.result):
+            return fn(), False
+        with self.lock:
+            self.collapsed.inc((label,))
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, True
+
+    def render_metrics(self):
+        with self.lock:
+            lines = self.leaders.render('requests_coalesce_leaders_total', ('route',))
+            lines += self.collapsed.render('requests_coalesced_total', ('route',))
+            lines += self.timeouts.render('requests_coalesce_timeouts_total', ('route',))
+        return lines
+
+
+def setup_coalescing(app):
+    if os.environ.get('COALESCE_READS', 'true').lower() not in TRUE_VALUES:
+        return
+    flights = app.extensions['single_flight'] = SingleFlight(float(os.environ.get('COALESCE_WAIT', DEFAULT_WAIT)))
+    if 'metrics' in app.extensions:
+        app.extensions['metrics'].register(flights.render_metrics)
+
+
+def coalesced(*tables, row=None):
+    """Shares the response of a GET view over `tables` between concurrent identical requests.
+
+    `tables` and `row` as in `conditional`; goes below it, so a 304 never waits.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            flights = current_app.extensions.get('single_flight')
+            if flights is None:
+                return view(*args, **kwargs)
+            key = (compute_etag(tables, kwargs[row] if row is not None else None),
+                   db.session.info.get('replicas') is not None)
+
+            def run():
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.is_streamed or response.direct_passthrough:
+                    return response, None
+                # the waiting requests get their own copy: the after_request hooks change the response in place
+                return response, (response.get_data(), response.status_code, list(response.headers.items()))
+
+            (response, frozen), shared = flights.do(key, run, request.url_rule.rule,
+                                                    shareable=lambda result: result[1] is not None)
+            if not shared:
+                return response
+            body, status, headers = frozen
+            return current_app.response_class(body, status=status, headers=headers)
+        return wrapper
+    return decorator
@@ -0,0 +1,163 @@
+"""
+Negotiated gzip/brotli compression of the responses, plus precompressed full catalogs.
+
+Any JSON, text or HTML response of at least COMPRESS_MIN_SIZE bytes is
+compressed with the best encoding the client accepts (brotli when the
+optional `brotli` package is installed, gzip otherwise). Strong ETags get
+the encoding appended ("abc-gzip"), since the bytes differ, and
+conditional.py matches them back to the plain tag.
+
+The full `/people` and `/planets` listings are kept in memory already
+compressed, once per encoding, and rebuilt when the table version changes
+or after CACHE_TTL seconds, so those big payloads are not compressed again
+on every request.
+"""
+import gzip
+import os
+import threading
+import time
+from functools import wraps
+from flask import current_app, request
+from werkzeug.http import parse_accept_header
+from cache import MISSING
+from replicas import primary_reads
+from versions import get_versions
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript')
+DEFAULT_MIN_SIZE = 500
+DEFAULT_LEVEL = 6
+# the precompressed payloads are built once per data version, so they can afford the slow levels
+PRECOMPRESSED_LEVEL = 9
+
+
+def available_encodings():
+    """Encodings we can produce, best first."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encodings):
+    """The encoding to use for an `Accept-Encoding` (a header string or werkzeug's parsed value)."""
+    if isinstance(accept_encodings, str) or accept_encodings is None:
+        accept_encodings = parse_accept_header(accept_encodings or '')
+    return accept_encodings.best_match(available_encodings())
+
+
+def compress(data, encoding, level=DEFAULT_LEVEL):
+    if encoding == 'br':
+        # brotli goes up to 11, but past 9 it gets too slow even for a payload built once
+        return brotli.compress(data, quality=min(level, 9))
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def encoded_etag(etag, encoding):
+    return '%s-%s' % (etag, encoding)
+
+
+def base_etag(tag):
+    """The tag without the suffix `encoded_etag` adds."""
+    for encoding in ('br', 'gzip'):
+        suffix = '-' + encoding
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)]
+    return tag
+
+
+def compress_response(response, accept_encodings, min_size=DEFAULT_MIN_SIZE, level=DEFAULT_LEVEL):
+    """Compresses `response` in place when it is worth it and the client accepts it."""
+    if response.status_code == 304:
+        response.vary.add('Accept-Encoding')
+        return response
+    if response.mimetype not in COMPRESSIBLE_TYPES or response.status_code != 200:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = response.headers.get('Content-Encoding')
+    if encoding is None:
+        if response.direct_passthrough or response.is_streamed:
+            return response
+        encoding = negotiate(accept_encodings)
+        if encoding is None or (response.content_length or 0) < min_size:
+            return response
+        response.set_data(compress(response.get_data(), encoding, level))
+        response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak and encoding in available_encodings() and base_etag(etag) == etag:
+        response.set_etag(encoded_etag(etag, encoding))
+    return response
+
+
+class PrecompressedPayloads:
+    """Response bodies by path, each kept raw and in every encoding asked for, for one data version
+    and at most `ttl` seconds."""
+
+    def __init__(self, level=PRECOMPRESSED_LEVEL, ttl=300):
+        self.level = level
+        self.ttl = ttl
+        self.entries = {}  # path -> (fingerprint, expires, {encoding or None: bytes})
+        self.lock = threading.Lock()
+
+    def get(self, path, fingerprint, encoding):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != fingerprint or entry[1] < time.monotonic():
+                return MISSING
+            data = entry[2].get(encoding, MISSING)
+            raw = entry[2][None]
+        if data is MISSING:
+            data = self._add(path, fingerprint, encoding, compress(raw, encoding, self.level))
+        return data
+
+    def set(self, path, fingerprint, raw, encoding):
+        """Stores the raw body and returns it in `encoding`."""
+        with self.lock:
+            self.entries[path] = (fingerprint, time.monotonic() + self.ttl, {None: raw})
+        if encoding is None:
+            return raw
+        return self._add(path, fingerprint, encoding, compress(raw, encoding, self.level))
+
+    def _add(self, path, fingerprint, encoding, data):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == fingerprint:
+                entry[2][encoding] = data
+        return data
+
+
+def setup_compression(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', int(os.environ.get('COMPRESS_MIN_SIZE', DEFAULT_MIN_SIZE)))
+    app.config.setdefault('COMPRESS_LEVEL', int(os.environ.get('COMPRESS_LEVEL', DEFAULT_LEVEL)))
+    app.extensions['precompressed'] = PrecompressedPayloads(ttl=app.extensions['catalog_cache'].ttl)
+
+    @app.after_request
+    def compress_after_request(response):
+        return compress_response(response, request.accept_encodings,
+                                 app.config['COMPRESS_MIN_SIZE'], app.config['COMPRESS_LEVEL'])
+
+
+def precompressed(*tables):
+    """Serves a GET view without query string from the precompressed payloads of `tables`."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.args:
+                return view(*args, **kwargs)
+            payloads = current_app.extensions['precompressed']
+            fingerprint = get_versions().fingerprint(tables)
+            encoding = negotiate(request.accept_encodings)
+            data = payloads.get(request.path, fingerprint, encoding)
+            if data is MISSING:
+                with primary_reads():
+                    response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                data = payloads.set(request.path, fingerprint, response.get_data(), encoding)
+            response = current_app.response_class(data, mimetype='application/json')
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,73 @@
+"""
+Strong ETags and conditional GET for the catalog endpoints.
+
+The ETag is derived from the table versions (or the row version, for the
+single-row routes, see versions.py) and the request path and query string, so a matching If-None-Match is answered with
+304 before the view runs any query. Tags of compressed responses carry the
+encoding (see compression.py) and match the same way. While the data
+behind a tag is newer than the replicas can be trusted to have, the view
+reads from the primary (see replicas.py).
+"""
+import hashlib
+import os
+from functools import wraps
+from flask import current_app, request
+from compression import base_etag
+from replicas import fresh_reads
+from versions import get_versions
+
+DEFAULT_CACHE_CONTROL = 'public, no-cache'
+
+
+def setup_conditional(app):
+    app.config.setdefault('CATALOG_CACHE_CONTROL', os.environ.get('CATALOG_CACHE_CONTROL', DEFAULT_CACHE_CONTROL))
+
+
+def make_etag(versions, tables, path, args, row=None):
+    """`row` is the primary key of the only row a single-row view reads from its one table."""
+    fingerprint = versions.fingerprint(tables) if row is None else versions.row_fingerprint(tables[0], row)
+    query = '&'.join(sorted('%s=%s' % item for item in args.items(multi=True)))
+    key = '%s|%s?%s' % (fingerprint, path, query)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+
+def compute_etag(tables, row=None):
+    return make_etag(get_versions(), tables, request.path, request.args, row)
+
+
+def matching_etag(if_none_match, etag):
+    """The tag of If-None-Match that names `etag` (compressed or not), or None."""
+    if if_none_match.star_tag:
+        return etag
+    for tag in if_none_match.as_set():
+        if base_etag(tag) == etag:
+            return tag
+    return None
+
+
+def conditional(*tables, row=None):
+    """Adds ETag/Cache-Control to a GET view over `tables` and answers 304 when nothing changed.
+
+    With `row`, the name of the view argument holding a primary key, the tag
+    follows that row of the (single) table instead of the whole table.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = kwargs[row] if row is not None else None
+            etag = compute_etag(tables, key)
+            cache_control = current_app.config['CATALOG_CACHE_CONTROL']
+            matched = matching_etag(request.if_none_match, etag)
+            if matched is not None:
+                response = current_app.response_class(status=304)
+                etag = matched
+            else:
+                with fresh_reads(tables if row is None else [(tables[0], key)]):
+                    response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,61 @@
+"""
+Configuration profiles for `create_app()`, picked with APP_PROFILE.
+
+    development   everything on, the default
+    production    no swagger
+    api           API-only workers: no admin UI and no swagger
+    testing       TESTING on, no admin UI
+
+The optional parts are the ones that cost the most to import: the admin UI
+(flask_admin, wtforms), migrations (flask_migrate, alembic) and swagger. Each
+flag can be forced from the environment (ENABLE_ADMIN=false, ...).
+ENABLE_MIGRATE defaults to "only when the app is built by the flask CLI",
+which is the only place the `flask db` commands run.
+"""
+import os
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+class Config:
+    ENABLE_ADMIN = True
+    ENABLE_SWAGGER = True
+    ENABLE_MIGRATE = None  # None: only under the flask CLI
+
+
+class DevelopmentConfig(Config):
+    pass
+
+
+class ProductionConfig(Config):
+    ENABLE_SWAGGER = False
+
+
+class ApiConfig(ProductionConfig):
+    ENABLE_ADMIN = False
+
+
+class TestingConfig(Config):
+    TESTING = True
+    ENABLE_ADMIN = False
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'api': ApiConfig,
+    'testing': TestingConfig,
+}
+
+
+def load_config(app, profile=None):
+    """Applies the profile (APP_PROFILE by default) and the ENABLE_* overrides from the environment."""
+    profile = profile or os.environ.get('APP_PROFILE') or 'development'
+    if profile not in PROFILES:
+        raise ValueError('APP_PROFILE desconocido: %s (opciones: %s)' % (profile, ', '.join(sorted(PROFILES))))
+    app.config.from_object(PROFILES[profile])
+    app.config['APP_PROFILE'] = profile
+    for flag in ('ENABLE_ADMIN', 'ENABLE_SWAGGER', 'ENABLE_MIGRATE'):
+        value = os.environ.get(flag)
+        if value not in (None, ''):
+            app.config[flag] = value.lower() in TRUE_VALUES
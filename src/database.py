@@ -0,0 +1,125 @@
+"""
+Database engine configuration (connection pool and statement timeout) and pool health.
+
+Everything is read from the environment:
+
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT   pool sizing (seconds for the timeout)
+    DB_POOL_RECYCLE                                  seconds before a connection is replaced (1800)
+    DB_POOL_PRE_PING                                 test connections on checkout (true)
+    DB_STATEMENT_TIMEOUT                             milliseconds, PostgreSQL, MySQL and MariaDB only
+
+The read replicas are configured in replicas.py.
+"""
+import os
+import time
+import click
+from sqlalchemy import event, text
+from models import db
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+def _env_int(name, default=None):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def engine_options(uri):
+    options = {
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'true').lower() in TRUE_VALUES,
+        'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800),
+    }
+    # SQLite uses its own pools that do not take these
+    if uri and not uri.startswith('sqlite'):
+        for option, name in (('pool_size', 'DB_POOL_SIZE'), ('max_overflow', 'DB_MAX_OVERFLOW'), ('pool_timeout', 'DB_POOL_TIMEOUT')):
+            value = _env_int(name)
+            if value is not None:
+                options[option] = value
+    return options
+
+
+def _statement_timeout_statement(dialect, timeout_ms):
+    if dialect.name == 'postgresql':
+        return 'SET statement_timeout = %d' % timeout_ms
+    if getattr(dialect, 'is_mariadb', False):
+        # MariaDB has no MAX_EXECUTION_TIME, its own variable takes seconds
+        # (and mysql+mysqlconnector:// on a MariaDB server still says 'mysql' in dialect.name)
+        return 'SET SESSION max_statement_time = %g' % (timeout_ms / 1000.0)
+    if dialect.name in ('mysql', 'mariadb'):
+        return 'SET SESSION MAX_EXECUTION_TIME = %d' % timeout_ms
+    return None
+
+
+def _statement_timeout_listener(dialect, timeout_ms):
+    if dialect.name not in ('postgresql', 'mysql', 'mariadb'):
+        return None
+
+    def set_timeout(dbapi_connection, connection_record):
+        # chosen here: is_mariadb is only known once the dialect has seen the server, on the first connect
+        statement = _statement_timeout_statement(dialect, timeout_ms)
+        if statement is None:
+            return
+        cursor = dbapi_connection.cursor()
+        cursor.execute(statement)
+        cursor.close()
+    return set_timeout
+
+
+def setup_database(app):
+    """Configures the engine from the environment and binds `db` to the app."""
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    db.init_app(app)
+
+    if _env_int('DB_STATEMENT_TIMEOUT'):
+        with app.app_context():
+            apply_statement_timeout(db.engine)
+
+
+def apply_statement_timeout(engine):
+    """Sets DB_STATEMENT_TIMEOUT on every new connection of `engine`, when the database supports it."""
+    timeout_ms = _env_int('DB_STATEMENT_TIMEOUT')
+    listener = _statement_timeout_listener(engine.dialect, timeout_ms) if timeout_ms else None
+    if listener is not None:
+        event.listen(engine, 'connect', listener)
+
+
+def setup_migrate(app):
+    """Registers the `flask db` commands, importing alembic only when they can run (see config.py)."""
+    enabled = app.config.get('ENABLE_MIGRATE')
+    if enabled is None:
+        enabled = click.get_current_context(silent=True) is not None
+    if enabled:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {'pool': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        method = getattr(pool, name, None)
+        if callable(method):
+            status[name] = method()
+    max_overflow = getattr(pool, '_max_overflow', None)
+    if 'size' in status and max_overflow is not None and max_overflow >= 0:
+        status['max_overflow'] = max_overflow
+        status['saturation'] = round(status.get('checkedout', 0) / float(status['size'] + max_overflow or 1), 3)
+    return status
+
+
+def db_health():
+    """Pool counters plus the round trip time of a `SELECT 1`."""
+    status = pool_status(db.engine)
+    started = time.perf_counter()
+    try:
+        # the primary, whose pool is the one reported
+        db.session.execute(text('SELECT 1'), bind_arguments={'bind': db.engine})
+        status['ok'] = True
+    except Exception as error:
+        db.session.rollback()
+        status['ok'] = False
+        status['error'] = error.__class__.__name__
+    status['latency_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    return status
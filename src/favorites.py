@@ -0,0 +1,158 @@
+"""
+Favorites helpers shared by the single and batch favorites endpoints.
+
+Every add or remove also moves the favorite counters of popularity.py in the
+same transaction.
+"""
+from models import db, Character, Planet, FavoritesCharacters, FavoritesPlanets
+from utils import APIException
+from popularity import count_favorites
+
+MAX_BATCH_ITEMS = 500
+
+# kind in the request/response body -> (favorites model, id column, catalog model)
+FAVORITE_KINDS = {
+    'character': (FavoritesCharacters, 'id_character', Character),
+    'planets': (FavoritesPlanets, 'id_planet', Planet),
+}
+
+
+def _parse_ids(values, kind, op):
+    if values is None:
+        return []
+    if not isinstance(values, list):
+        raise APIException("'%s.%s' debe ser una lista de ids" % (kind, op), status_code=400)
+    return values
+
+
+def parse_batch(body):
+    """Validates the batch body and returns (id_user, {kind: (adds, removes)})."""
+    if not isinstance(body, dict):
+        raise APIException('Se esperaba un objeto JSON', status_code=400)
+    id_user = body.get('id_user')
+    if not isinstance(id_user, int) or isinstance(id_user, bool):
+        raise APIException("'id_user' debe ser un entero", status_code=400)
+
+    changes = {}
+    total = 0
+    for kind in FAVORITE_KINDS:
+        ops = body.get(kind) or {}
+        if not isinstance(ops, dict):
+            raise APIException("'%s' debe ser un objeto con 'add' y/o 'remove'" % kind, status_code=400)
+        adds = _parse_ids(ops.get('add'), kind, 'add')
+        removes = _parse_ids(ops.get('remove'), kind, 'remove')
+        total += len(adds) + len(removes)
+        changes[kind] = (adds, removes)
+    if total > MAX_BATCH_ITEMS:
+        raise APIException('Maximo %d favoritos por lote' % MAX_BATCH_ITEMS, status_code=400)
+    return id_user, changes
+
+
+def _valid_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def apply_batch(id_user, kind, adds, removes, session=None):
+    """Stages the adds/removes of one kind in the session and returns the per-item results.
+
+    Runs a fixed number of queries no matter how many ids are given: one for
+    the catalog rows, one for the user's current favorites among them and a
+    single DELETE for the removals. The caller commits.
+    """
+    if session is None:
+        session = db.session
+    fav_model, id_column, catalog_model = FAVORITE_KINDS[kind]
+    fav_column = getattr(fav_model, id_column)
+    wanted = {x for x in adds + removes if _valid_id(x)}
+
+    existing_catalog = set()
+    current = set()
+    if wanted:
+        existing_catalog = {row[0] for row in session.query(catalog_model.id).filter(catalog_model.id.in_(wanted))}
+        current = {row[0] for row in session.query(fav_column).filter(
+            fav_model.id_user == id_user, fav_column.in_(wanted))}
+
+    results = []
+    to_delete = set()
+    for value in removes:
+        if not _valid_id(value):
+            status = 'invalid'
+        elif value not in current:
+            status = 'not_favorite'
+        else:
+            to_delete.add(value)
+            current.discard(value)
+            status = 'removed'
+        results.append({'id': value, 'op': 'remove', 'status': status})
+
+    # removals go first so removing and re-adding the same id in one batch works
+    if to_delete:
+        session.query(fav_model).filter(
+            fav_model.id_user == id_user, fav_column.in_(to_delete)
+        ).execution_options(changed_keys=[(id_user, id) for id in sorted(to_delete)]).delete(synchronize_session=False)
+    deltas = dict.fromkeys(to_delete, -1)
+
+    for value in adds:
+        if not _valid_id(value):
+            status = 'invalid'
+        elif value not in existing_catalog:
+            status = 'not_found'
+        elif value in current:
+            status = 'already_favorite'
+        else:
+            session.add(fav_model(**{'id_user': id_user, id_column: value}))
+            current.add(value)
+            deltas[value] = deltas.get(value, 0) + 1
+            status = 'added'
+        results.append({'id': value, 'op': 'add', 'status': status})
+    count_favorites(kind, deltas, session)
+    return results
+
+
+def favorite_ids(id_user, kind, session=None):
+    """Ids the user marked as favorite, answered from the (id_user, id) primary key index alone."""
+    if session is None:
+        session = db.session
+    fav_model, id_column, _ = FAVORITE_KINDS[kind]
+    column = getattr(fav_model, id_column)
+    query = session.query(column).filter(fav_model.id_user == id_user).order_by(column)
+    return [row[0] for row in query]
+
+
+def add_favorite(id_user, kind, id, session=None):
+    """Stages one favorite and its counter; the caller commits (a repeated favorite fails there)."""
+    if session is None:
+        session = db.session
+    fav_model, id_column, _ = FAVORITE_KINDS[kind]
+    session.add(fav_model(**{'id_user': id_user, id_column: id}))
+    session.flush()
+    count_favorites(kind, {id: 1}, session)
+
+
+def remove_favorite(id_user, kind, id, session=None):
+    """Deletes one favorite with a single DELETE by primary key, returns how many rows went away."""
+    if session is None:
+        session = db.session
+    fav_model, id_column, _ = FAVORITE_KINDS[kind]
+    removed = session.query(fav_model).filter(
+        fav_model.id_user == id_user, getattr(fav_model, id_column) == id
+    ).execution_options(changed_keys=[(id_user, id)]).delete(synchronize_session=False)
+    count_favorites(kind, {id: -removed}, session)
+    return removed
+
+
+MAX_EXPANDED_FAVORITES = 500
+
+
+def expanded_favorites(id_user, kind, limit, session=None):
+    """Full catalog rows of the user's favorites in one JOIN, capped at `limit`.
+
+    Returns (rows, truncated).
+    """
+    if session is None:
+        session = db.session
+    fav_model, id_column, catalog_model = FAVORITE_KINDS[kind]
+    rows = session.query(catalog_model).join(
+        fav_model, getattr(fav_model, id_column) == catalog_model.id
+    ).filter(fav_model.id_user == id_user).order_by(catalog_model.id).limit(limit + 1).all()
+    return [x.serialize() for x in rows[:limit]], len(rows) > limit
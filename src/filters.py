@@ -0,0 +1,58 @@
+"""
+Sparse fieldsets (`fields=id,name`) and typed filters for the catalog listings.
+
+String columns filter by equality, several values separated by commas
+(`gender=male,female`). Integer columns take `<column>_min` / `<column>_max`
+(`population_min=1000000`). Everything becomes part of the SQL query.
+"""
+from flask import request
+from sqlalchemy import Integer, String
+from serializers import serialize_fields
+from utils import APIException
+
+NOT_FILTERABLE = ('id', 'name', 'url')
+
+
+def fields_arg(model, args=None):
+    """The `fields` requested for `model`, in serialize() order, or None for all of them."""
+    value = (request.args if args is None else args).get('fields')
+    if not value:
+        return None
+    available = serialize_fields(model)
+    wanted = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = wanted.difference(available)
+    if unknown:
+        raise APIException('Campos desconocidos: %s' % ', '.join(sorted(unknown)), status_code=400,
+                           payload={'fields': list(available)})
+    return tuple(name for name in available if name in wanted)
+
+
+def _int_value(name, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise APIException("'%s' debe ser un entero" % name, status_code=400)
+
+
+def filter_args(model, args=None):
+    """SQL conditions for the filters present in the query string (or `args`)."""
+    args = request.args if args is None else args
+    conditions = []
+    for column in model.__table__.columns:
+        if column.name in NOT_FILTERABLE:
+            continue
+        attribute = getattr(model, column.name)
+        if isinstance(column.type, Integer):
+            minimum = args.get(column.name + '_min')
+            maximum = args.get(column.name + '_max')
+            if minimum:
+                conditions.append(attribute >= _int_value(column.name + '_min', minimum))
+            if maximum:
+                conditions.append(attribute <= _int_value(column.name + '_max', maximum))
+        elif isinstance(column.type, String):
+            value = args.get(column.name)
+            if value:
+                values = [x.strip() for x in value.split(',') if x.strip()]
+                if values:
+                    conditions.append(attribute == values[0] if len(values) == 1 else attribute.in_(values))
+    return conditions
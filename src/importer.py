@@ -0,0 +1,215 @@
+"""
+Bulk import of SWAPI dumps into the character and planet tables.
+
+    $ flask import-swapi people ./dumps/people.ndjson --batch-size 2000
+
+Reads a JSON array, NDJSON or SWAPI result pages from disk without loading
+the whole file, coerces the values to the model columns and upserts them in
+batches with a core INSERT (ON CONFLICT / ON DUPLICATE KEY where the
+database supports it). Progress is saved to a checkpoint file after each
+committed batch, so running the same command again resumes where it stopped.
+"""
+import json
+import os
+import re
+import time
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Integer, String, delete, insert
+from models import db, Character, Planet
+
+MODELS = {
+    'people': Character,
+    'planets': Planet,
+}
+NULL_VALUES = ('', 'unknown', 'n/a', 'none', 'null', 'indefinite')
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?')
+ID_FROM_URL_RE = re.compile(r'/(\d+)/?$')
+
+
+def iter_json_records(fp, chunk_size=1 << 16):
+    """Yields the objects of a JSON array, an NDJSON file or concatenated SWAPI pages."""
+    decoder = json.JSONDecoder()
+    buf = fp.read(chunk_size).lstrip()
+    in_array = buf.startswith('[')
+    pos = 1 if in_array else 0
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if in_array and buf[pos:pos + 1] == ']':
+            return
+        try:
+            if pos >= len(buf):
+                raise ValueError('need more data')
+            value, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                if buf[pos:].strip():
+                    raise click.ClickException('JSON invalido cerca de: %r' % buf[pos:pos + 80])
+                return
+            more = fp.read(chunk_size)
+            eof = not more
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        if isinstance(value, dict) and isinstance(value.get('results'), list):
+            yield from value['results']
+        else:
+            yield value
+
+
+def to_int(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = value
+    else:
+        text = str(value).strip().lower().replace(',', '')
+        if text in NULL_VALUES:
+            return None
+        match = NUMBER_RE.search(text)
+        if match is None:
+            return None
+        number = float(match.group())
+    number = int(round(number))
+    if number < INT_MIN or number > INT_MAX:
+        return None
+    return number
+
+
+def to_str(value, length=None):
+    if value is None:
+        return None
+    text = str(value).strip()
+    if text.lower() in ('', 'n/a'):
+        return None
+    return text[:length] if length else text
+
+
+def record_id(record, props):
+    for value in (record.get('uid'), record.get('id'), props.get('uid'), props.get('id')):
+        if value is not None:
+            return to_int(value)
+    match = ID_FROM_URL_RE.search(str(props.get('url') or ''))
+    return int(match.group(1)) if match else None
+
+
+def coerce_record(model, record):
+    """Maps one SWAPI record onto the columns of `model`, or returns None if it is unusable."""
+    if not isinstance(record, dict):
+        return None
+    props = record.get('properties', record)
+    row = {'id': record_id(record, props)}
+    for column in model.__table__.columns:
+        if column.name == 'id':
+            continue
+        value = props.get(column.name)
+        if isinstance(column.type, Integer):
+            row[column.name] = to_int(value)
+        elif isinstance(column.type, String):
+            row[column.name] = to_str(value, column.type.length)
+        else:
+            row[column.name] = value
+    if row['id'] is None or not row.get('name') or not row.get('url'):
+        return None
+    return row
+
+
+def upsert_rows(model, rows):
+    table = model.__table__
+    columns = [c.name for c in table.columns if c.name != 'id']
+    # the statements name their rows for the change log and the cache invalidation (see versions.py)
+    changed = {'changed_keys': [row['id'] for row in rows], 'change_op': 'update'}
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['id'],
+            set_={name: stmt.excluded[name] for name in columns}
+        )
+    elif dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        stmt = dialect_insert(table)
+        stmt = stmt.on_duplicate_key_update({name: stmt.inserted[name] for name in columns})
+    else:
+        db.session.execute(delete(table).where(table.c.id.in_(changed['changed_keys'])).execution_options(**changed))
+        stmt = insert(table)
+    db.session.execute(stmt.execution_options(**changed), rows)
+
+
+def read_checkpoint(path, source):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as fp:
+        data = json.load(fp)
+    if data.get('source') != os.path.abspath(source):
+        raise click.ClickException('El checkpoint %s es de otro archivo (%s)' % (path, data.get('source')))
+    return data['records']
+
+
+def write_checkpoint(path, source, records):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump({'source': os.path.abspath(source), 'records': records}, fp)
+    os.replace(tmp, path)
+
+
+@click.command('import-swapi')
+@click.argument('kind', type=click.Choice(sorted(MODELS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=1000, show_default=True, help='Filas por INSERT/commit.')
+@click.option('--checkpoint', 'checkpoint_path', default=None, help='Archivo de progreso (por defecto PATH.checkpoint).')
+@click.option('--restart', is_flag=True, help='Ignora el checkpoint y empieza desde el principio.')
+@with_appcontext
+def import_swapi(kind, path, batch_size, checkpoint_path, restart):
+    """Imports a SWAPI dump of people or planets."""
+    model = MODELS[kind]
+    checkpoint_path = checkpoint_path or path + '.checkpoint'
+    skip = 0 if restart else read_checkpoint(checkpoint_path, path)
+    if skip:
+        click.echo('Retomando desde el registro %d' % skip)
+
+    started = time.monotonic()
+    seen = skip
+    imported = invalid = 0
+    batch = {}
+
+    def flush():
+        upsert_rows(model, list(batch.values()))
+        db.session.commit()
+        write_checkpoint(checkpoint_path, path, seen)
+        elapsed = time.monotonic() - started
+        click.echo('%d filas importadas (%.0f filas/s)' % (imported, imported / elapsed if elapsed else 0))
+        batch.clear()
+
+    with open(path, encoding='utf-8') as fp:
+        for index, record in enumerate(iter_json_records(fp)):
+            if index < skip:
+                continue
+            seen = index + 1
+            row = coerce_record(model, record)
+            if row is None:
+                invalid += 1
+                continue
+            batch[row['id']] = row
+            imported += 1
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    elapsed = time.monotonic() - started
+    click.echo('Listo: %d filas en %.2fs (%.0f filas/s), %d registros invalidos omitidos' % (
+        imported, elapsed, imported / elapsed if elapsed else 0, invalid))
+
+
+def setup_importer(app):
+    app.cli.add_command(import_swapi)
@@ -0,0 +1,69 @@
+"""
+Characters and planets by a list of ids, for screens that need a few dozen
+specific rows (the favorites of a user, the cast of a film) in one request.
+
+    GET  /people?ids=1,4,7           POST /people/batch   {"ids": [1, 4, 7]}
+    GET  /planets?ids=2,3            POST /planets/batch  {"ids": [2, 3]}
+
+Rows already in the catalog cache come from there, the rest are loaded
+with a single `IN` query and cached. Results keep the order of the request
+(a repeated id comes back once) and the ids that do not exist are listed
+in `missing`. `fields` applies as in the listings; pagination and filters
+do not.
+"""
+from flask import request
+from cache import get_cache, cache_key
+from models import db
+from replicas import primary_reads
+from utils import APIException
+
+MAX_LOOKUP_IDS = 200
+
+
+def _check_ids(ids):
+    if not ids:
+        raise APIException("'ids' no puede estar vacio", status_code=400)
+    if len(ids) > MAX_LOOKUP_IDS:
+        raise APIException('Maximo %d ids por consulta' % MAX_LOOKUP_IDS, status_code=400)
+    # a repeated id comes back once, where it first appeared
+    return list(dict.fromkeys(ids))
+
+
+def ids_arg(args=None):
+    """The ids of `?ids=1,4,7` in order, or None when the query string does not have it."""
+    value = (request.args if args is None else args).get('ids')
+    if value is None:
+        return None
+    try:
+        ids = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise APIException("'ids' debe ser una lista de enteros separados por comas", status_code=400)
+    return _check_ids(ids)
+
+
+def ids_body(body):
+    """The ids of a `{"ids": [...]}` body, in order."""
+    ids = body.get('ids') if isinstance(body, dict) else None
+    if not isinstance(ids, list) or any(not isinstance(id, int) or isinstance(id, bool) for id in ids):
+        raise APIException("Se esperaba un objeto JSON con 'ids', una lista de enteros", status_code=400)
+    return _check_ids(ids)
+
+
+def lookup_rows(model, ids, fields=None, session=None):
+    """{"results": the serialized rows in the order of `ids`, "missing": the ids not found}."""
+    if session is None:
+        session = db.session
+    cache = get_cache()
+    keys = {id: cache_key(model, id) for id in ids}
+    cached = cache.get_many(list(keys.values()))
+    rows = {id: cached[key] for id, key in keys.items() if key in cached}
+    misses = [id for id in ids if id not in rows]
+    if misses:
+        with primary_reads(session):
+            loaded = {row.id: row.serialize() for row in session.query(model).filter(model.id.in_(misses))}
+        cache.set_many({keys[id]: value for id, value in loaded.items()})
+        rows.update(loaded)
+    results = [rows[id] for id in ids if id in rows]
+    if fields is not None:
+        results = [{name: row[name] for name in fields} for row in results]
+    return {'results': results, 'missing': [id for id in ids if id not in rows]}
@@ -2,35 +2,100 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+from flask import Blueprint, Flask, current_app, request, jsonify
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
-from admin import setup_admin
+from config import load_config
+from utils import APIException, setup_swagger
+from pagination import get_page_args, listing_response, int_arg
+from cache import setup_cache, get_cache, cache_key
+from versions import setup_versions
+from conditional import setup_conditional, conditional
+from compression import setup_compression, precompressed
+from coalesce import setup_coalescing, coalesced
+from importer import setup_importer
+from favorites import parse_batch, apply_batch, favorite_ids, add_favorite, remove_favorite
+from favorites import expanded_favorites, MAX_EXPANDED_FAVORITES
+from serializers import setup_serializers, get_encoder, rows_response
+from filters import fields_arg, filter_args
+from lookup import ids_arg, ids_body, lookup_rows
+from database import setup_database, setup_migrate, db_health
+from metrics import setup_metrics
+from ratelimit import setup_ratelimit
+from replicas import setup_replicas, primary_reads
+from sitemap import setup_sitemap, route_index_response
+from search import setup_search, get_search_index, search_args
+from changes import setup_changes, changes_args, changes_since
+from stats import stats_args, cached_stats
+from snapshot import setup_snapshots, snapshot_format, snapshot_response
+from popularity import setup_popularity, top_favorites, DEFAULT_TOP, MAX_TOP
 from models import db, User
-from models import Character, Planet, FavoritesCharacters, FavoritesPlanets 
-
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
+from models import Character, Planet
+
+api = Blueprint('api', __name__)
+
+
+def create_app(profile=None):
+    """Builds the app for a configuration profile (APP_PROFILE by default, see config.py)."""
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+    load_config(app, profile)
+    setup_database(app)
+    setup_migrate(app)
+    setup_metrics(app)
+    setup_replicas(app)
+    setup_ratelimit(app)
+    CORS(app)
+    setup_cache(app)
+    setup_versions(app)
+    setup_search(app)
+    setup_changes(app)
+    setup_conditional(app)
+    setup_compression(app)
+    setup_coalescing(app)
+    setup_importer(app)
+    setup_snapshots(app)
+    setup_popularity(app)
+    setup_serializers(app)
+    setup_sitemap(app)
+    if app.config['ENABLE_ADMIN']:
+        from admin import setup_admin
+        setup_admin(app)
+    if app.config['ENABLE_SWAGGER']:
+        setup_swagger(app)
+    app.register_blueprint(api)
+    return app
+
+
+def __getattr__(name):
+    # `main.app` for the entry points that import it (FLASK_APP=src/main.py), built on first use
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
+@api.app_errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
 # generate sitemap with all your endpoints
-@app.route('/')
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return route_index_response('sitemap')
+
+# el mismo indice de rutas en formato OpenAPI, para clientes y herramientas
+@api.route('/openapi.json', methods=['GET'])
+def openapi():
+    return route_index_response('openapi')
 
-@app.route('/user', methods=['GET'])
+# estado del pool de conexiones, para el balanceador y los dashboards
+@api.route('/health/db', methods=['GET'])
+def health_db():
+    status = db_health()
+    return jsonify(status), 200 if status['ok'] else 503
+
+@api.route('/user', methods=['GET'])
 def handle_hello():
 
     response_body = {
@@ -43,13 +108,36 @@ def handle_hello():
 #Aquí comienzan los endpoints de la tarea
 
 #get people (LISTOOOOOOOOOOOOOOOOOOOOOOOOOOOOOO)
-@app.route('/people', methods=['GET'])
+@api.route('/people', methods=['GET'])
+@conditional('character')
+@precompressed('character')
+@coalesced('character')
 def people():
 
+    ids = ids_arg()
+    limit, after, stream = get_page_args()
+    fields = fields_arg(Character)
+    filters = filter_args(Character)
     try:
-        characters = Character.query.all()
-        characters = list(map(lambda x: x.serialize(), characters))
-        return jsonify(characters), 200
+        if ids is not None:
+            return jsonify(lookup_rows(Character, ids, fields)), 200
+        return listing_response(Character, limit, after, stream, fields, filters), 200
+
+    except:
+        response_body = {
+            "msg": "Hubo un error en traer los personajes"
+        }
+        return jsonify(response_body), 500
+
+
+#varios personajes por id, para listas muy largas para el query string
+@api.route('/people/batch', methods=['POST'])
+def people_batch():
+
+    ids = ids_body(request.get_json(silent=True))
+    fields = fields_arg(Character)
+    try:
+        return jsonify(lookup_rows(Character, ids, fields)), 200
 
     except:
         response_body = {
@@ -58,8 +146,27 @@ def people():
         return jsonify(response_body), 500
 
 
+#personajes con mas favoritos
+@api.route('/people/top', methods=['GET'])
+@conditional('character', 'character_popularity')
+@coalesced('character', 'character_popularity')
+def top_people():
+
+    limit = min(int_arg('limit', 1) or DEFAULT_TOP, MAX_TOP)
+    try:
+        return jsonify(top_favorites('character', limit)), 200
+
+    except:
+        response_body = {
+            "msg": "Hubo un error en traer los personajes mas populares"
+        }
+        return jsonify(response_body), 500
+
+
 #get people específica (LISTOOOOOOOOOOOOOOOOOOOOOOOO)
-@app.route('/character/<int:id_character>', methods=['GET'])
+@api.route('/character/<int:id_character>', methods=['GET'])
+@conditional('character', row='id_character')
+@coalesced('character', row='id_character')
 def single_character(id_character):
 
     try:
@@ -67,8 +174,12 @@ def single_character(id_character):
         #one_character = Character.query.filter_by(id=id_character)
         #one_character = list(map(lambda x: x.serialize(), one_character))
         #return jsonify(one_character), 200
-        characters = Character.query.filter_by(id=id_character)[0]
-        return jsonify(characters.serialize()), 200
+        with primary_reads():
+            characters = get_cache().get_or_load(
+                cache_key(Character, id_character),
+                lambda: Character.query.filter_by(id=id_character)[0].serialize()
+            )
+        return jsonify(characters), 200
 
     except:
         response_body = {
@@ -78,13 +189,36 @@ def single_character(id_character):
 
 
 #get planets (LISTOOOOOOOOOOOOOOOOOOOOOOOOOOOOOO)
-@app.route('/planets', methods=['GET'])
+@api.route('/planets', methods=['GET'])
+@conditional('planet')
+@precompressed('planet')
+@coalesced('planet')
 def handle_planets():
 
+    ids = ids_arg()
+    limit, after, stream = get_page_args()
+    fields = fields_arg(Planet)
+    filters = filter_args(Planet)
     try:
-        planets = Planet.query.all()
-        planets = list(map(lambda x: x.serialize(), planets))
-        return jsonify(planets), 200
+        if ids is not None:
+            return jsonify(lookup_rows(Planet, ids, fields)), 200
+        return listing_response(Planet, limit, after, stream, fields, filters), 200
+
+    except:
+        response_body = {
+            "msg": "Hubo un error en traer los planetas"
+        }
+        return jsonify(response_body), 500
+
+
+#varios planetas por id, para listas muy largas para el query string
+@api.route('/planets/batch', methods=['POST'])
+def planets_batch():
+
+    ids = ids_body(request.get_json(silent=True))
+    fields = fields_arg(Planet)
+    try:
+        return jsonify(lookup_rows(Planet, ids, fields)), 200
 
     except:
         response_body = {
@@ -93,8 +227,27 @@ def handle_planets():
         return jsonify(response_body), 500
 
 
+#planetas con mas favoritos
+@api.route('/planets/top', methods=['GET'])
+@conditional('planet', 'planet_popularity')
+@coalesced('planet', 'planet_popularity')
+def top_planets():
+
+    limit = min(int_arg('limit', 1) or DEFAULT_TOP, MAX_TOP)
+    try:
+        return jsonify(top_favorites('planets', limit)), 200
+
+    except:
+        response_body = {
+            "msg": "Hubo un error en traer los planetas mas populares"
+        }
+        return jsonify(response_body), 500
+
+
 #get planets específico (LISTOOOOOOOOOOOOOOOOOOOO)
-@app.route('/planets/<int:id_planet>', methods=['GET'])
+@api.route('/planets/<int:id_planet>', methods=['GET'])
+@conditional('planet', row='id_planet')
+@coalesced('planet', row='id_planet')
 def single_planet(id_planet):
 
     try:
@@ -102,8 +255,12 @@ def single_planet(id_planet):
         #one_planet = Planet.query.filter_by(id=id_planet)
         #one_planet = list(map(lambda x: x.serialize(), one_planet))
         #return jsonify(one_planet), 200
-        planets = Planet.query.filter_by(id=id_planet)[0]
-        return jsonify(planets.serialize()), 200
+        with primary_reads():
+            planets = get_cache().get_or_load(
+                cache_key(Planet, id_planet),
+                lambda: Planet.query.filter_by(id=id_planet)[0].serialize()
+            )
+        return jsonify(planets), 200
 
     except:
         response_body = {
@@ -112,16 +269,108 @@ def single_planet(id_planet):
         return jsonify(response_body), 500
 
 
+#busca personajes y planetas por nombre (o clima/terreno de los planetas)
+@api.route('/search', methods=['GET'])
+@conditional('character', 'planet')
+def search():
+
+    q, kinds, limit, offset = search_args(request.args)
+    try:
+        results, more = get_search_index().search(q, kinds, limit, offset)
+        response_body = {
+            "results": results,
+            "next_offset": offset + limit if more else None
+        }
+        return jsonify(response_body), 200
+
+    except:
+        response_body = {
+            "msg": "Hubo un error en la búsqueda"
+        }
+        return jsonify(response_body), 500
+
+
+#estadisticas agrupadas (count, min, max, promedio, percentiles) de las columnas numericas
+@api.route('/stats/people', methods=['GET'])
+@conditional('character')
+@coalesced('character')
+def stats_people():
+
+    by, columns, percentiles = stats_args(Character, request.args)
+    filters = filter_args(Character)
+    try:
+        return jsonify(cached_stats(Character, by, columns, percentiles, filters)), 200
+
+    except:
+        response_body = {
+            "msg": "Hubo un error en calcular las estadisticas de los personajes"
+        }
+        return jsonify(response_body), 500
+
+
+@api.route('/stats/planets', methods=['GET'])
+@conditional('planet')
+@coalesced('planet')
+def stats_planets():
+
+    by, columns, percentiles = stats_args(Planet, request.args)
+    filters = filter_args(Planet)
+    try:
+        return jsonify(cached_stats(Planet, by, columns, percentiles, filters)), 200
+
+    except:
+        response_body = {
+            "msg": "Hubo un error en calcular las estadisticas de los planetas"
+        }
+        return jsonify(response_body), 500
+
+
+#cambios en personajes, planetas y favoritos desde `since`, para sincronizar sin traer todo
+@api.route('/changes', methods=['GET'])
+def changes():
+
+    since, tables, limit = changes_args(request.args)
+    try:
+        feed = changes_since(since, tables, limit, current_app.config['CHANGES_SETTLE'])
+        if feed is None:
+            response_body = {
+                "msg": "El historial ya no llega hasta 'since', vuelve a traer los listados completos"
+            }
+            return jsonify(response_body), 410
+        return jsonify(feed), 200
+
+    except:
+        response_body = {
+            "msg": "Hubo un error en traer los cambios"
+        }
+        return jsonify(response_body), 500
+
+
+#snapshot de todos los personajes o planetas en un archivo, con descargas que se pueden retomar
+@api.route('/snapshot/<any(people, planets):kind>', methods=['GET'])
+def snapshot(kind):
+
+    format = snapshot_format(request.args)
+    try:
+        return snapshot_response(kind, format)
+
+    except:
+        response_body = {
+            "msg": "Hubo un error en generar el snapshot"
+        }
+        return jsonify(response_body), 500
+
+
 #endpoints adicionales
 
 #obtener usuarios (LISTOOOOOOOOOOOOOOOOOOOOOOO)
-@app.route('/users', methods=['GET'])
+@api.route('/users', methods=['GET'])
 def getusers():
 
     try:
-        usuarios = User.query.all()
-        usuarios = list(map(lambda x: x.serialize(), usuarios))
-        return jsonify(usuarios), 200
+        encoder = get_encoder(User)
+        usuarios = encoder.query(db.session).all()
+        return rows_response(encoder, usuarios), 200
 
     except:
         response_body = {
@@ -131,16 +380,25 @@ def getusers():
 
 
 #user favorites (LISTOOOOOOOOOOOOOOOOOOOOOOOO)
-@app.route('/users/favorites', methods =['GET'])
+@api.route('/users/favorites', methods =['GET'])
 def user_favs():
 
+    expand = request.args.get('expand', '').lower() in ('1', 'true', 'yes')
+    limit = min(int_arg('limit', 1) or MAX_EXPANDED_FAVORITES, MAX_EXPANDED_FAVORITES)
     try:
         id_user = int(request.args.get('id_user'))
-        fav_character = FavoritesCharacters.query.filter_by(id_user=id_user)
-        fav_character = list(map(lambda x: x.serialize(), fav_character))
-        
-        fav_planet = FavoritesPlanets.query.filter_by(id_user=id_user)
-        fav_planet = list(map(lambda x: x.serialize(), fav_planet))
+        if expand:
+            fav_character, more_characters = expanded_favorites(id_user, 'character', limit)
+            fav_planet, more_planets = expanded_favorites(id_user, 'planets', limit)
+            favs = {
+                'character': fav_character,
+                'planets': fav_planet,
+                'truncated': more_characters or more_planets,
+            }
+            return jsonify(favs), 200
+
+        fav_character = [{"id_character": x} for x in favorite_ids(id_user, 'character')]
+        fav_planet = [{"id_planet": x} for x in favorite_ids(id_user, 'planets')]
 
         favs = {
             'character': fav_character,
@@ -156,17 +414,13 @@ def user_favs():
 
 
 #agrega un personaje favorito (LISTOOOOOOOOOOOOOOOOOOO)
-@app.route('/favorite/character', methods=['POST'])
+@api.route('/favorite/character', methods=['POST'])
 def add_character_fav():
 
     try:
         id_user = int(request.args.get('id_user'))
         id_character = int(request.args.get('id_character'))
-        fav = FavoritesCharacters(
-            id_character=id_character,
-            id_user=id_user
-        )
-        db.session.add(fav)
+        add_favorite(id_user, 'character', id_character)
         db.session.commit()
         response_body = {
             "msg": "Personaje agregado a favoritos"
@@ -181,17 +435,13 @@ def add_character_fav():
 
 
 #agrega un planeta favorito (LISTOOOOOOOOOOOOOOOOOO)
-@app.route('/favorite/planet', methods=['POST'])
+@api.route('/favorite/planet', methods=['POST'])
 def add_planet_fav():
 
     try:
         id_user = int(request.args.get('id_user'))
         id_planet = int(request.args.get('id_planet'))
-        fav = FavoritesPlanets(
-            id_planet=id_planet,
-            id_user=id_user
-        )
-        db.session.add(fav)
+        add_favorite(id_user, 'planets', id_planet)
         db.session.commit()
         response_body = {
             "msg": "Planeta agregado a favoritos"
@@ -205,18 +455,42 @@ def add_planet_fav():
         return jsonify(response_body), 500
 
 
+#agrega y borra muchos favoritos en una sola transaccion
+@api.route('/favorites/batch', methods=['POST'])
+def batch_favs():
+
+    id_user, changes = parse_batch(request.get_json(silent=True))
+    if User.query.filter_by(id=id_user).first() is None:
+        raise APIException('El usuario no existe', status_code=404)
+
+    try:
+        results = {}
+        for kind, (adds, removes) in changes.items():
+            results[kind] = apply_batch(id_user, kind, adds, removes)
+        db.session.commit()
+        return jsonify(results), 200
+
+    except:
+        db.session.rollback()
+        response_body = {
+            "msg": "Hubo un error actualizando los favoritos"
+        }
+        return jsonify(response_body), 500
+
+
 #borrar personaje favorito ( LISTOOOOOOOOOOOOOOOOOOOOOOO)
-@app.route('/favorite/character', methods=['DELETE'])
+@api.route('/favorite/character', methods=['DELETE'])
 def delete_fav_character():
 
     try:
         id_user = int(request.args.get('id_user'))
         id_character = int(request.args.get('id_character'))
-        fav = FavoritesCharacters(
-            id_character=id_character,
-            id_user=id_user
-        )
-        db.session.delete(fav)
+        if remove_favorite(id_user, 'character', id_character) == 0:
+            db.session.rollback()
+            response_body = {
+                "msg": "Personaje no encontrado en favoritos"
+            }
+            return jsonify(response_body), 404
         db.session.commit()
         response_body = {
             "msg": "Personaje eliminado con éxito"
@@ -231,17 +505,18 @@ def delete_fav_character():
 
 
 #borrar planeta favorito (LISTOOOOOOOOOOOOOOOOOOOOOOOO)
-@app.route('/favorite/planet', methods=['DELETE'])
+@api.route('/favorite/planet', methods=['DELETE'])
 def delete_fav_planet():
 
     try:
         id_user = int(request.args.get('id_user'))
         id_planet = int(request.args.get('id_planet'))
-        fav = FavoritesPlanets(
-            id_planet=id_planet,
-            id_user=id_user
-        )
-        db.session.delete(fav)
+        if remove_favorite(id_user, 'planets', id_planet) == 0:
+            db.session.rollback()
+            response_body = {
+                "msg": "Planeta no encontrado en favoritos"
+            }
+            return jsonify(response_body), 404
         db.session.commit()
         response_body = {
             "msg": "Planeta eliminado con éxito"
@@ -261,4 +536,4 @@ def delete_fav_planet():
 # this only runs if `$ python src/main.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
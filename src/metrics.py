@@ -0,0 +1,165 @@
+"""
+Request and SQL instrumentation, exposed at /metrics in Prometheus text format.
+
+Turned on with METRICS_ENABLED=true. For every request it records the
+latency per route, counts and times each SQL statement run through the
+engine, flags N+1 patterns (the same statement run METRICS_N_PLUS_ONE or
+more times in one request) and adds a Server-Timing header.
+"""
+import bisect
+import os
+import threading
+import time
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from models import db
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0, 0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self, name, label_names):
+        lines = ['# TYPE %s histogram' % name]
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            label_text = ','.join('%s="%s"' % pair for pair in zip(label_names, labels))
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, label_text, le, cumulative))
+            lines.append('%s_sum{%s} %.6f' % (name, label_text, total))
+            lines.append('%s_count{%s} %d' % (name, label_text, count))
+        return lines
+
+
+class Counter:
+
+    def __init__(self):
+        self.series = {}
+
+    def inc(self, labels, value=1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self, name, label_names):
+        lines = ['# TYPE %s counter' % name]
+        for labels, value in sorted(self.series.items()):
+            label_text = ','.join('%s="%s"' % pair for pair in zip(label_names, labels))
+            lines.append('%s{%s} %s' % (name, label_text, value))
+        return lines
+
+
+class Metrics:
+
+    def __init__(self, n_plus_one=5):
+        self.n_plus_one = n_plus_one
+        self.lock = threading.Lock()
+        self.request_latency = Histogram()
+        self.sql_latency = Histogram()  # total SQL time of each request
+        self.sql_queries = Counter()
+        self.n_plus_one_total = Counter()
+        self.extra = []
+
+    def register(self, render):
+        """Adds a callable returning more exposition lines (other modules' counters)."""
+        self.extra.append(render)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            lines += self.request_latency.render('http_request_duration_seconds', ('route', 'method', 'status'))
+            lines += self.sql_latency.render('sql_request_duration_seconds', ('route',))
+            lines += self.sql_queries.render('sql_queries_total', ('route',))
+            lines += self.n_plus_one_total.render('sql_n_plus_one_total', ('route',))
+        for render in self.extra:
+            lines += render()
+        return '\n'.join(lines) + '\n'
+
+
+def _route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def start_request():
+    """Starts timing the request of the current context (`g`), and counting its SQL."""
+    g.request_started = time.perf_counter()
+    g.sql_time = 0.0
+    g.sql_count = 0
+    g.sql_statements = {}
+
+
+def record_request_metrics(metrics, route, method, status, logger):
+    """Records the request timed by `start_request` and returns its Server-Timing header, or None."""
+    if 'request_started' not in g:
+        return None
+    elapsed = time.perf_counter() - g.request_started
+    repeated = [sql for sql, count in g.sql_statements.items() if count >= metrics.n_plus_one]
+    with metrics.lock:
+        metrics.request_latency.observe((route, method, str(status)), elapsed)
+        if g.sql_count:
+            metrics.sql_latency.observe((route,), g.sql_time)
+            metrics.sql_queries.inc((route,), g.sql_count)
+        if repeated:
+            metrics.n_plus_one_total.inc((route,))
+    if repeated:
+        logger.warning('Posible N+1 en %s: %s', route, repeated[0][:200])
+    return 'app;dur=%.2f, db;dur=%.2f;desc="%d queries"' % (elapsed * 1000, g.sql_time * 1000, g.sql_count)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # on the execution context, which goes away with the statement even when it fails
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_started', None)
+    # g of the app context: the ASGI handlers time their requests without a request context
+    if started is None or not has_app_context() or 'request_started' not in g:
+        return
+    elapsed = time.perf_counter() - started
+    g.sql_time += elapsed
+    g.sql_count += 1
+    g.sql_statements[statement] = g.sql_statements.get(statement, 0) + 1
+
+
+def instrument_engine(engine):
+    """Counts the queries of `engine` in the per-request SQL metrics."""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def setup_metrics(app):
+    if os.environ.get('METRICS_ENABLED', '').lower() not in ('1', 'true', 'yes', 'on'):
+        return
+    metrics = app.extensions['metrics'] = Metrics(int(os.environ.get('METRICS_N_PLUS_ONE', 5)))
+
+    with app.app_context():
+        instrument_engine(db.engine)
+
+    @app.before_request
+    def start_timer():
+        start_request()
+
+    @app.after_request
+    def record_request(response):
+        server_timing = record_request_metrics(metrics, _route(), request.method, response.status_code, app.logger)
+        if server_timing is not None:
+            response.headers.add('Server-Timing', server_timing)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -1,7 +1,27 @@
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 
 
-db = SQLAlchemy()
+class RoutingSession(Session):
+    """Sends the reads of a read-only request to a replica (see replicas.py), everything else to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or getattr(clause, 'is_dml', False):
+                # whatever this session reads after a write must see it
+                self.info['wrote'] = True
+                self.info.pop('replicas', None)
+            elif self.info.get('replicas') is not None:
+                engine = self.info.get('replica')
+                if engine is None:
+                    # one replica for the whole request; False when none is healthy
+                    engine = self.info['replica'] = self.info['replicas'].pick() or False
+                if engine:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -32,8 +52,8 @@ class Character(db.Model):
     id = db.Column(db.Integer, primary_key = True)
     name = db.Column(db.String(120), nullable=False)
     url = db.Column(db.String(250),nullable=False)
-    gender = db.Column(db.String(10),nullable=True)
-    eye_color = db.Column(db.String(10), nullable=True)
+    gender = db.Column(db.String(10),nullable=True, index=True)
+    eye_color = db.Column(db.String(10), nullable=True, index=True)
     hair_color = db.Column(db.String(10), nullable=True)
     skin_color = db.Column(db.String(10), nullable=True)
     birth_year = db.Column(db.String(20), nullable=True)
@@ -81,9 +101,9 @@ class Planet(db.Model):
     diameter = db.Column(db.Integer, nullable=True)
     orbital_period = db.Column(db.Integer, nullable=True)
     rotation_period = db.Column(db.Integer, nullable=True)
-    climate = db.Column(db.String(20),nullable=True)
-    terrain = db.Column(db.String(20),nullable=True)
-    population = db.Column(db.Integer, nullable=True)
+    climate = db.Column(db.String(20),nullable=True, index=True)
+    terrain = db.Column(db.String(20),nullable=True, index=True)
+    population = db.Column(db.Integer, nullable=True, index=True)
     surface_water = db.Column(db.Integer, nullable=True)
     gravity = db.Column(db.Integer, nullable=True)
 
@@ -125,7 +145,7 @@ class Planet(db.Model):
 class FavoritesCharacters(db.Model):
     __tablename__ = 'favorites_characters'
     id_user = db.Column(db.Integer,db.ForeignKey('user.id'), primary_key = True)
-    id_character = db.Column(db.Integer, nullable=False)
+    id_character = db.Column(db.Integer, db.ForeignKey('character.id', ondelete='CASCADE'), primary_key = True, index=True)
 
     def __init__(self, id_user, id_character):
         self.id_user = id_user
@@ -144,7 +164,7 @@ class FavoritesCharacters(db.Model):
 class FavoritesPlanets(db.Model):
     __tablename__ = 'favorites_planet'
     id_user = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key = True)
-    id_planet = db.Column(db.Integer, nullable=False)
+    id_planet = db.Column(db.Integer, db.ForeignKey('planet.id', ondelete='CASCADE'), primary_key = True, index=True)
 
     def __init__(self, id_user, id_planet):
         self.id_user = id_user
@@ -157,3 +177,41 @@ class FavoritesPlanets(db.Model):
         return {
             "id_planet": self.id_planet,
         }
+
+
+#Cuantos usuarios tienen a cada personaje en favoritos
+class CharacterPopularity(db.Model):
+    __tablename__ = 'character_popularity'
+    id_character = db.Column(db.Integer, db.ForeignKey('character.id', ondelete='CASCADE'), primary_key = True)
+    favorites = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+    def __repr__(self):
+        return '<CharacterPopularity %r: %r>' % (self.id_character, self.favorites)
+
+
+#Cuantos usuarios tienen a cada planeta en favoritos
+class PlanetPopularity(db.Model):
+    __tablename__ = 'planet_popularity'
+    id_planet = db.Column(db.Integer, db.ForeignKey('planet.id', ondelete='CASCADE'), primary_key = True)
+    favorites = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+    def __repr__(self):
+        return '<PlanetPopularity %r: %r>' % (self.id_planet, self.favorites)
+
+
+#Cada cambio confirmado en personajes, planetas y favoritos (lo escribe versions.py, lo lee /changes)
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        # the newest entry of a table and of a row, for the data versions (see versions.py)
+        db.Index('ix_change_log_table_name_seq', 'table_name', 'seq'),
+        db.Index('ix_change_log_table_name_row_key_seq', 'table_name', 'row_key', 'seq'),
+    )
+    seq = db.Column(db.Integer, primary_key = True)
+    table_name = db.Column(db.String(64), nullable=False)
+    row_key = db.Column(db.String(64))  # NULL when a bulk statement did not name its rows
+    op = db.Column(db.String(8), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return '<ChangeLog %r %s %s %s>' % (self.seq, self.op, self.table_name, self.row_key)
@@ -0,0 +1,113 @@
+"""
+Keyset (cursor) pagination and streaming helpers for the catalog listings
+"""
+from flask import Response, current_app, request, stream_with_context, url_for
+from utils import APIException
+from models import db
+from replicas import pinned_reads
+from serializers import get_encoder, matches_jsonify, rows_response
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+
+
+def int_arg(name, minimum, args=None):
+    value = (request.args if args is None else args).get(name)
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise APIException("'%s' debe ser un entero" % name, status_code=400)
+    if value < minimum:
+        raise APIException("'%s' debe ser mayor o igual a %d" % (name, minimum), status_code=400)
+    return value
+
+
+def get_page_args(args=None):
+    """Reads `limit`, `after` and `stream` from the query string (or `args`).
+
+    `limit` is None when the client did not ask for pagination, so the
+    listings keep returning the whole table like they always did.
+    """
+    args = request.args if args is None else args
+    limit = int_arg('limit', 1, args)
+    after = int_arg('after', 0, args)
+    stream = args.get('stream', '').lower() in ('1', 'true', 'yes')
+    if after is not None and limit is None and not stream:
+        limit = DEFAULT_PAGE_SIZE
+    if limit is not None:
+        limit = min(limit, MAX_PAGE_SIZE)
+    return limit, after, stream
+
+
+def keyset_query(query, model, after=None):
+    query = query.order_by(model.id)
+    if after is not None:
+        query = query.filter(model.id > after)
+    return query
+
+
+def keyset_page(query, model, limit, after=None):
+    """Returns one page of rows plus the cursor for the next one (or None)."""
+    rows = keyset_query(query, model, after).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1].id
+    return rows, None
+
+
+def next_page_link(next_after, limit):
+    args = dict(request.view_args or {})
+    args.update(request.args.to_dict())
+    args.update(after=next_after, limit=limit)
+    return '<%s>; rel="next"' % url_for(request.endpoint, **args)
+
+
+def stream_json_array(rows, encoder):
+    """Writes a JSON array one row at a time, with the same bytes `jsonify` would produce."""
+    # `rows` runs once the view has returned: keep it on the database the view was reading from
+    reads = pinned_reads()
+
+    def generate():
+        if matches_jsonify():
+            encode = encoder.encode_row
+        else:
+            dumps = current_app.json.dumps
+            encode = lambda row: dumps(encoder.to_dict(row), separators=(',', ':'))
+        with reads:
+            yield '['
+            first = True
+            for row in rows:
+                item = encode(row)
+                yield item if first else ',' + item
+                first = False
+            yield ']\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def stream_query(query, model, limit=None, after=None):
+    """Runs the listing on a server-side cursor, fetching STREAM_CHUNK_SIZE rows at a time."""
+    query = keyset_query(query, model, after)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.yield_per(STREAM_CHUNK_SIZE)
+
+
+def listing_response(model, limit, after, stream, fields=None, filters=()):
+    """Builds the response for a catalog listing: streamed, one keyset page, or the whole table."""
+    encoder = get_encoder(model, fields)
+    query = encoder.query(db.session).filter(*filters)
+    if stream:
+        return stream_json_array(stream_query(query, model, limit, after), encoder)
+
+    if limit is None:
+        return rows_response(encoder, keyset_query(query, model).all())
+
+    rows, next_after = keyset_page(query, model, limit, after)
+    response = rows_response(encoder, rows)
+    if next_after is not None:
+        response.headers['Link'] = next_page_link(next_after, limit)
+    return response
@@ -0,0 +1,100 @@
+"""
+Favorite counters per character and planet, behind /people/top and /planets/top.
+
+The favorites helpers adjust the counters in the same transaction that adds
+or removes the favorites, so a top-N read walks the counters index instead
+of grouping every row of the favorites tables.
+
+    $ flask rebuild-popularity
+
+recounts them from the favorites tables, for data loaded around the API
+(imports, users deleted directly in the database).
+"""
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import delete, func, insert, select, update
+from models import db, Character, Planet, FavoritesCharacters, FavoritesPlanets
+from models import CharacterPopularity, PlanetPopularity
+
+DEFAULT_TOP = 10
+MAX_TOP = 100
+
+# favorites kind -> (counter model, id column, catalog model, favorites model)
+POPULARITY_KINDS = {
+    'character': (CharacterPopularity, 'id_character', Character, FavoritesCharacters),
+    'planets': (PlanetPopularity, 'id_planet', Planet, FavoritesPlanets),
+}
+
+
+def count_favorites(kind, deltas, session=None):
+    """Adds `deltas` ({id: change}) to the counters of `kind` with a single upsert.
+
+    The caller commits, together with the favorites it added or removed.
+    """
+    if session is None:
+        session = db.session
+    model, id_column, _, _ = POPULARITY_KINDS[kind]
+    table = model.__table__
+    # same order in every transaction, so two batches never wait on each other's rows
+    rows = [{id_column: id, 'favorites': delta} for id, delta in sorted(deltas.items()) if delta]
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[id_column],
+            set_={'favorites': table.c.favorites + stmt.excluded.favorites}
+        )
+    elif dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        stmt = dialect_insert(table)
+        stmt = stmt.on_duplicate_key_update({'favorites': table.c.favorites + stmt.inserted.favorites})
+    else:
+        for row in rows:
+            updated = session.execute(update(table).where(table.c[id_column] == row[id_column]).values(
+                favorites=table.c.favorites + row['favorites'])).rowcount
+            if not updated:
+                session.execute(insert(table).values(**row))
+        return
+    session.execute(stmt, rows)
+
+
+def top_favorites(kind, limit, session=None):
+    """The `limit` catalog rows with the most favorites, each with its `favorites` count."""
+    if session is None:
+        session = db.session
+    model, id_column, catalog_model, _ = POPULARITY_KINDS[kind]
+    rows = session.query(catalog_model, model.favorites).join(
+        model, getattr(model, id_column) == catalog_model.id
+    ).filter(model.favorites > 0).order_by(model.favorites.desc(), catalog_model.id).limit(limit)
+    return [dict(row.serialize(), favorites=favorites) for row, favorites in rows]
+
+
+def rebuild_popularity(kind, session=None):
+    """Replaces the counters of `kind` with a fresh count of the favorites table."""
+    if session is None:
+        session = db.session
+    model, id_column, _, fav_model = POPULARITY_KINDS[kind]
+    fav_column = getattr(fav_model, id_column)
+    session.execute(delete(model.__table__))
+    counts = select(fav_column, func.count()).group_by(fav_column)
+    session.execute(insert(model.__table__).from_select([id_column, 'favorites'], counts))
+
+
+@click.command('rebuild-popularity')
+@with_appcontext
+def rebuild_popularity_command():
+    """Recounts the favorites of every character and planet."""
+    for kind in POPULARITY_KINDS:
+        rebuild_popularity(kind)
+    db.session.commit()
+    click.echo('Contadores de favoritos recalculados')
+
+
+def setup_popularity(app):
+    app.cli.add_command(rebuild_popularity_command)
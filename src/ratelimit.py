@@ -0,0 +1,292 @@
+"""
+Token-bucket rate limiting per client and route, and load shedding on queue depth.
+
+Both run before the view, so a rejected request never takes a connection
+from the database pool. Configured from the environment:
+
+    RATE_LIMIT_ENABLED       turn the rate limits on (false)
+    RATE_LIMITS              rules `METHODS PATH RATE/UNIT [BURST]` separated by `;`, first match wins,
+                             e.g. "POST,DELETE /favorite/* 5/s 10; GET /people* 20/s"
+    RATE_LIMIT_STORAGE_URL   memory:// (per process, the default) or redis://... shared by every worker
+    RATE_LIMIT_TRUST_PROXY   take the address from X-Forwarded-For (false)
+    RATE_LIMIT_KEY_HEADER    header carrying an API key (none: every client is its address)
+    RATE_LIMIT_API_KEYS      the API keys honored in that header, separated by commas
+    LOAD_SHED_MAX_QUEUE      requests allowed to wait for a pooled connection before new ones get 503 (off),
+                             per worker process
+    LOAD_SHED_RETRY_AFTER    seconds suggested in the 503 (1)
+
+Load shedding counts the requests of this process waiting for a connection:
+the ones in flight beyond those holding one, while the pool has none left.
+A sync worker (gunicorn's default, see the Procfile) runs one request at a
+time and never has any waiting, its queue is the listen backlog we cannot
+see, so shedding needs threaded workers (`--worker-class gthread`) or the
+ASGI app.
+
+Rules match the request path with shell-style wildcards, so they keep
+working when a view function is renamed. Each rule has its own bucket per
+client: a burst of BURST requests (by default the count in RATE), refilled
+at RATE per unit. A client is its address unless it sends one of
+RATE_LIMIT_API_KEYS in RATE_LIMIT_KEY_HEADER; any other value of the header
+is ignored, so making one up never buys a fresh bucket.
+"""
+import fnmatch
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from flask import g, jsonify, request
+from database import pool_status
+from models import db
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+DEFAULT_RATE_LIMITS = (
+    'POST,DELETE /favorite/* 5/s 10; '
+    'POST /favorites/batch 1/s 5; '
+    'POST /people/batch 10/s 20; '
+    'POST /planets/batch 10/s 20; '
+    'GET /people* 20/s 40; '
+    'GET /planets* 20/s 40; '
+    'GET /search 10/s 20; '
+    'GET /changes 5/s 10; '
+    'GET /stats/* 5/s 10; '
+    'GET /snapshot/* 1/s 5'
+)
+UNITS = {'s': 1, 'sec': 1, 'second': 1, 'm': 60, 'min': 60, 'minute': 60, 'h': 3600, 'hour': 3600}
+RATE_RE = re.compile(r'^(\d+(?:\.\d+)?)/(%s)$' % '|'.join(UNITS))
+# never limited nor shed, so monitoring keeps working under load
+EXEMPT_PATHS = ('/metrics',)
+
+
+class Rule:
+
+    def __init__(self, name, methods, pattern, rate, burst):
+        self.name = name
+        self.methods = methods  # None for any method
+        self.pattern = pattern
+        self.rate = rate  # tokens per second
+        self.burst = burst
+
+    def matches(self, method, path):
+        return (self.methods is None or method in self.methods) and fnmatch.fnmatchcase(path, self.pattern)
+
+
+def parse_rules(text):
+    rules = []
+    for entry in re.split(r'[;\n]', text or ''):
+        parts = entry.split()
+        if not parts:
+            continue
+        found = RATE_RE.match(parts[2]) if len(parts) in (3, 4) else None
+        if found is None or (len(parts) == 4 and not parts[3].isdigit()):
+            raise ValueError('Regla de rate limit invalida: %r' % entry.strip())
+        rate = float(found.group(1)) / UNITS[found.group(2)]
+        burst = int(parts[3]) if len(parts) == 4 else max(1, int(math.ceil(float(found.group(1)))))
+        methods = None if parts[0] == '*' else frozenset(parts[0].upper().split(','))
+        rules.append(Rule(' '.join(parts[:2]), methods, parts[1], rate, burst))
+    return rules
+
+
+class MemoryBuckets:
+    """Token buckets of this process; also the stand-in for the shared backend in tests."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a token, returns 0 when allowed or the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            # idle buckets are full again anyway, dropping the oldest loses nothing
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBuckets:
+    """Token buckets shared by every worker (needs the optional `redis` package)."""
+
+    SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+    def __init__(self, url, namespace='ratelimit'):
+        import redis
+        self.namespace = namespace
+        self._script = redis.Redis.from_url(url).register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self._script(keys=['%s:%s' % (self.namespace, key)], args=[rate, burst]))
+
+
+def buckets_from_url(url):
+    if not url or url == 'memory://':
+        return MemoryBuckets()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBuckets(url)
+    raise ValueError('RATE_LIMIT_STORAGE_URL no soportada: %s' % url)
+
+
+class Admission:
+    """Decides whether a request runs: load shedding first, then the rate limit of its route."""
+
+    def __init__(self, rules=(), buckets=None, max_queue=None, pools=(), shed_retry_after=1,
+                 key_header=None, api_keys=(), trust_proxy=False):
+        self.rules = list(rules)
+        self.buckets = buckets
+        self.max_queue = max_queue
+        self.pools = list(pools)  # the connection pools the requests of this process wait for
+        self.shed_retry_after = shed_retry_after
+        self.key_header = key_header.lower() if key_header else None
+        self.api_keys = frozenset(api_keys)
+        self.trust_proxy = trust_proxy
+        self.inflight = 0
+        self.limited = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def client_key(self, headers, remote_addr):
+        """The bucket owner: a known API key when sent, else the client address. Header names in lowercase."""
+        value = headers.get(self.key_header) if self.key_header else None
+        if value and value in self.api_keys:
+            # hashed: the keys are not written to the shared backend
+            return 'key:' + hashlib.sha256(value.encode()).hexdigest()[:16]
+        forwarded = headers.get('x-forwarded-for') if self.trust_proxy else None
+        if forwarded:
+            remote_addr = forwarded.split(',')[0].strip()
+        return 'ip:%s' % remote_addr
+
+    def enter(self, method, path, client):
+        """Returns None when the request may run (call `leave()` after it), else (status, retry after)."""
+        if path in EXEMPT_PATHS:
+            return None
+        with self._lock:
+            if self.max_queue is not None and self.waiting() >= self.max_queue:
+                self.shed += 1
+                return 503, self.shed_retry_after
+            self.inflight += 1
+        rule = next((rule for rule in self.rules if rule.matches(method, path)), None)
+        wait = 0
+        if rule is not None:
+            try:
+                wait = self.buckets.take('%s|%s' % (rule.name, client), rule.rate, rule.burst)
+            except Exception:
+                # an unreachable shared backend should not take the API down with it
+                wait = 0
+        if wait:
+            self.leave()
+            with self._lock:
+                self.limited += 1
+            return 429, int(math.ceil(wait))
+        return None
+
+    def waiting(self):
+        """Requests in flight waiting for a connection, 0 while every pool still has one free."""
+        holding = 0
+        exhausted = False
+        for pool in self.pools:
+            checked_out = pool.checkedout()
+            holding += checked_out
+            # a negative max_overflow means no limit, that pool never makes anyone wait
+            if pool._max_overflow >= 0 and checked_out >= pool.size() + pool._max_overflow:
+                exhausted = True
+        return self.inflight - holding if exhausted else 0
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def render_metrics(self):
+        return [
+            '# TYPE rate_limited_total counter',
+            'rate_limited_total %d' % self.limited,
+            '# TYPE load_shed_total counter',
+            'load_shed_total %d' % self.shed,
+            '# TYPE requests_in_flight gauge',
+            'requests_in_flight %d' % self.inflight,
+            '# TYPE requests_waiting_for_connection gauge',
+            'requests_waiting_for_connection %d' % self.waiting(),
+        ]
+
+
+def rejection(status, retry_after):
+    """Body, status and headers of a rejected request."""
+    if status == 429:
+        msg = 'Demasiadas solicitudes, intenta de nuevo en %d segundos' % retry_after
+    else:
+        msg = 'El servidor esta saturado, intenta de nuevo en %d segundos' % retry_after
+    return {'msg': msg}, status, {'Retry-After': str(retry_after)}
+
+
+def setup_ratelimit(app):
+    enabled = os.environ.get('RATE_LIMIT_ENABLED', '').lower() in TRUE_VALUES
+    max_queue = os.environ.get('LOAD_SHED_MAX_QUEUE')
+    if not enabled and not max_queue:
+        return
+    key_header = os.environ.get('RATE_LIMIT_KEY_HEADER') or None
+    api_keys = [key.strip() for key in os.environ.get('RATE_LIMIT_API_KEYS', '').split(',') if key.strip()]
+    if key_header and not api_keys:
+        app.logger.warning('RATE_LIMIT_KEY_HEADER ignorado: RATE_LIMIT_API_KEYS esta vacio')
+    pools = []
+    if max_queue:
+        with app.app_context():
+            if 'max_overflow' in pool_status(db.engine):
+                pools.append(db.engine.pool)
+            else:
+                # SQLite's pools do not queue, there is nothing to shed on
+                app.logger.warning('LOAD_SHED_MAX_QUEUE ignorado: el pool de %s no tiene limite', db.engine.dialect.name)
+    admission = app.extensions['admission'] = Admission(
+        parse_rules(os.environ.get('RATE_LIMITS', DEFAULT_RATE_LIMITS)) if enabled else (),
+        buckets_from_url(os.environ.get('RATE_LIMIT_STORAGE_URL')),
+        int(max_queue) if max_queue else None,
+        pools,
+        int(os.environ.get('LOAD_SHED_RETRY_AFTER', 1)),
+        key_header,
+        api_keys,
+        os.environ.get('RATE_LIMIT_TRUST_PROXY', '').lower() in TRUE_VALUES,
+    )
+    if 'metrics' in app.extensions:
+        app.extensions['metrics'].register(admission.render_metrics)
+
+    @app.before_request
+    def admit_request():
+        client = admission.client_key(request.headers, request.remote_addr)
+        rejected = admission.enter(request.method, request.path, client)
+        if rejected is not None:
+            body, status, headers = rejection(*rejected)
+            return jsonify(body), status, headers
+        g.admitted = request.path not in EXEMPT_PATHS
+
+    @app.teardown_request
+    def release_request(error=None):
+        if g.pop('admitted', False):
+            admission.leave()
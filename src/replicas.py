@@ -0,0 +1,218 @@
+"""
+Read replicas for the GET endpoints.
+
+    DB_REPLICA_URLS             replica URLs separated by commas (none: everything reads from the primary)
+    DB_REPLICA_CHECK_INTERVAL   seconds between health checks of the replicas (10)
+    DB_READ_YOUR_WRITES         seconds a client keeps reading from the primary after a write (5)
+
+GET and HEAD requests are marked read-only, and `db.session` (a
+RoutingSession, see models.py) sends their queries to one replica, chosen
+round-robin among the healthy ones on the first query. Writes, and every
+read after a write in the same session, go to the primary, and so does
+everything when no replica is healthy. A replica is marked down when its
+health check (a `SELECT 1` every DB_REPLICA_CHECK_INTERVAL) fails or when
+one of its connections drops.
+
+A client that just wrote must see its write, so for DB_READ_YOUR_WRITES
+seconds its reads stay on the primary: the response to the write sets a
+cookie, for clients that keep cookies across workers, and this process
+remembers the `id_user` of the write, for the ones that do not.
+
+Whatever outlives the request is read from the primary too (with
+`primary_reads`): rows going into the catalog cache, precompressed
+payloads, cached stats, snapshot files, the search index, the data
+versions themselves, and the body of a conditional view whose tables
+changed in the last DB_READ_YOUR_WRITES seconds (`fresh_reads`). All of
+them are kept for a data version (see versions.py), so a lagging replica
+would pin old rows to it in every client and proxy cache.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from flask import request
+from sqlalchemy import create_engine, event, text
+from database import apply_statement_timeout, engine_options
+from metrics import instrument_engine
+from models import db
+from versions import get_versions
+
+DEFAULT_CHECK_INTERVAL = 10
+DEFAULT_READ_YOUR_WRITES = 5
+PRIMARY_COOKIE = 'read_primary_until'
+READ_METHODS = ('GET', 'HEAD')
+
+
+class ReplicaSet:
+    """The replica engines with their health, handed out round-robin."""
+
+    def __init__(self, engines, check_interval=DEFAULT_CHECK_INTERVAL, lag_window=DEFAULT_READ_YOUR_WRITES):
+        self.engines = list(engines)
+        self.check_interval = check_interval
+        self.lag_window = lag_window  # seconds a change may take to reach the replicas
+        self.healthy = [True] * len(self.engines)
+        self.picked = [0] * len(self.engines)
+        self.fallbacks = 0
+        self._next = 0
+        self._next_check = 0
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._on_error)
+
+    def pick(self):
+        """A healthy replica engine, or None to use the primary."""
+        now = time.monotonic()
+        if now >= self._next_check:
+            self.check(now)
+        with self._lock:
+            for _ in range(len(self.engines)):
+                index = self._next % len(self.engines)
+                self._next += 1
+                if self.healthy[index]:
+                    self.picked[index] += 1
+                    return self.engines[index]
+            self.fallbacks += 1
+        return None
+
+    def check(self, now=None):
+        """Runs a `SELECT 1` on every replica; only one thread checks per interval."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+        for index, engine in enumerate(self.engines):
+            try:
+                with engine.connect() as connection:
+                    connection.execute(text('SELECT 1'))
+                healthy = True
+            except Exception:
+                healthy = False
+            self.healthy[index] = healthy
+
+    def _on_error(self, context):
+        if context.is_disconnect and context.engine in self.engines:
+            self.healthy[self.engines.index(context.engine)] = False
+
+    def render_metrics(self):
+        lines = ['# TYPE db_replica_up gauge']
+        lines += ['db_replica_up{replica="%d"} %d' % (index, up) for index, up in enumerate(self.healthy)]
+        lines.append('# TYPE db_replica_reads_total counter')
+        lines += ['db_replica_reads_total{replica="%d"} %d' % item for item in enumerate(self.picked)]
+        lines += ['# TYPE db_replica_fallback_total counter', 'db_replica_fallback_total %d' % self.fallbacks]
+        return lines
+
+
+class RecentWriters:
+    """Users that wrote in the last `window` seconds, whose reads stay on the primary."""
+
+    def __init__(self, window=DEFAULT_READ_YOUR_WRITES, maxsize=100000):
+        self.window = window
+        self.maxsize = maxsize
+        self._until = OrderedDict()  # id_user -> deadline, oldest first
+        self._lock = threading.Lock()
+
+    def add(self, id_user):
+        now = time.time()
+        with self._lock:
+            self._until[id_user] = now + self.window
+            self._until.move_to_end(id_user)
+            while self._until and (len(self._until) > self.maxsize or next(iter(self._until.values())) <= now):
+                self._until.popitem(last=False)
+
+    def __contains__(self, id_user):
+        return self._until.get(id_user, 0) > time.time()
+
+
+@contextmanager
+def primary_reads(session=None):
+    """Reads from the primary inside the block, for data that must not lag behind (the search index)."""
+    if session is None:
+        session = db.session
+    replicas = session.info.pop('replicas', None)
+    try:
+        yield session
+    finally:
+        if replicas is not None and not session.info.get('wrote'):
+            session.info['replicas'] = replicas
+
+
+@contextmanager
+def fresh_reads(names, session=None):
+    """`primary_reads` while any of `names` (tables or (table, key) pairs, see versions.py) changed
+    more recently than the replicas are trusted to have caught up."""
+    if session is None:
+        session = db.session
+    replicas = session.info.get('replicas')
+    if replicas is not None and get_versions().changed_within(names, replicas.lag_window):
+        with primary_reads(session):
+            yield session
+    else:
+        yield session
+
+
+def pinned_reads(session=None):
+    """Reads from where `session` reads now, for queries that run after the view returned (a streamed body)."""
+    if session is None:
+        # the session itself: a streamed body may run where `db.session` resolves to another one
+        session = db.session()
+    return nullcontext(session) if session.info.get('replicas') is not None else primary_reads(session)
+
+
+def _request_user():
+    id_user = request.args.get('id_user')
+    if id_user is None and request.is_json:
+        body = request.get_json(silent=True)
+        id_user = body.get('id_user') if isinstance(body, dict) else None
+    return str(id_user) if id_user is not None else None
+
+
+def _cookie_deadline():
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0))
+    except ValueError:
+        return 0
+
+
+def replica_engine(url):
+    engine = create_engine(url, **engine_options(url))
+    apply_statement_timeout(engine)
+    return engine
+
+
+def setup_replicas(app):
+    urls = [url.strip() for url in os.environ.get('DB_REPLICA_URLS', '').split(',') if url.strip()]
+    if not urls:
+        return
+    window = float(os.environ.get('DB_READ_YOUR_WRITES', DEFAULT_READ_YOUR_WRITES))
+    replicas = app.extensions['replicas'] = ReplicaSet(
+        [replica_engine(url) for url in urls],
+        float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL)),
+        window,
+    )
+    writers = RecentWriters(window)
+    if 'metrics' in app.extensions:
+        app.extensions['metrics'].register(replicas.render_metrics)
+        for engine in replicas.engines:
+            instrument_engine(engine)
+
+    @app.before_request
+    def route_reads():
+        if request.method not in READ_METHODS or _cookie_deadline() > time.time():
+            return
+        id_user = _request_user()
+        if id_user is None or id_user not in writers:
+            db.session.info['replicas'] = replicas
+
+    @app.after_request
+    def remember_writes(response):
+        if not db.session.info.get('wrote') or response.status_code >= 400:
+            return response
+        deadline = time.time() + writers.window
+        id_user = _request_user()
+        if id_user is not None:
+            writers.add(id_user)
+        response.set_cookie(PRIMARY_COOKIE, '%.3f' % deadline, max_age=int(writers.window) + 1,
+                            httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,383 @@
+"""
+In-memory prefix search over character and planet names (and planet climate/terrain).
+
+Each table gets an inverted index from lowercase word tokens to row ids plus
+the sorted list of tokens, so a prefix is a bisect into that list instead of
+a scan. The index is kept current from the change log: when the data
+version of its table moves (see versions.py), the rows logged since the
+last refresh are re-read by id, whichever process wrote them. A bulk
+statement that did not name its rows, more than MAX_REFRESH_ROWS changed
+rows or a log pruned past the index reload the table instead: a new index
+is built in a background thread and swapped in when complete, searches
+keep answering from the previous one meanwhile. Only the first search of
+a table waits for its index.
+
+Results are ranked: names starting with the query, then whole-word matches,
+then word-prefix matches, then climate/terrain matches; shorter names first
+inside each group. A query of several words intersects the postings of
+each word, the shortest first.
+Rankings are memoized per query until the index changes, which is what
+keeps the one and two letter prefixes of type-ahead clients cheap.
+"""
+import bisect
+import heapq
+import itertools
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy import func
+from utils import APIException
+from cache import LRUCache, MISSING
+from pagination import int_arg
+from changes import DEFAULT_SETTLE, settled_seq
+from models import db, Character, Planet, ChangeLog
+from replicas import primary_reads
+from versions import get_versions
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+MAX_SEARCH_OFFSET = 1000
+MAX_QUERY_LENGTH = 100
+MAX_REFRESH_ROWS = 1000
+MEMO_TTL = 60
+
+# type in the response -> (model, fields that rank as the name, extra fields)
+SEARCH_TYPES = {
+    'character': (Character, ('name',), ()),
+    'planet': (Planet, ('name',), ('climate', 'terrain')),
+}
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+def sort_key(name, id):
+    """Shorter names first, then lower ids, packed in one int so postings stay plain sorted lists."""
+    return (len(name) << ID_BITS) | id
+
+
+def _contains(keys, key):
+    i = bisect.bisect_left(keys, key)
+    return i < len(keys) and keys[i] == key
+
+
+class TableIndex:
+    """Inverted index of one table.
+
+    Postings are lists of sort keys kept in order, split in three maps: the
+    first word of the name, any word of the name and the extra fields. A
+    one-word query only reads the head of each list it needs, so its cost
+    depends on the page size rather than on how many rows share the prefix.
+    """
+
+    def __init__(self, model, name_fields, extra_fields):
+        self.model = model
+        self.name_fields = name_fields
+        self.extra_fields = extra_fields
+        self.version = None
+        self.since = None  # the change log is applied up to this seq
+        self.generation = 0  # changes with every load or refresh, keys the memoized rankings
+        self.docs = {}  # id -> (name, url, name tokens, extra tokens)
+        self.first = {}
+        self.names = {}
+        self.extra = {}
+        self.tokens = []  # sorted, every token of the three maps
+
+    def _columns(self):
+        names = ('id', 'url') + self.name_fields + self.extra_fields
+        return [getattr(self.model, name) for name in names]
+
+    def _document(self, row):
+        names = [getattr(row, field) for field in self.name_fields]
+        name_tokens = tuple(token for value in names for token in tokenize(value))
+        extra_tokens = tuple(token for field in self.extra_fields for token in tokenize(getattr(row, field)))
+        return ' '.join(value for value in names if value), row.url, name_tokens, extra_tokens
+
+    def _postings(self, doc):
+        name, url, name_tokens, extra_tokens = doc
+        if name_tokens:
+            yield self.first, name_tokens[0]
+        for token in set(name_tokens):
+            yield self.names, token
+        for token in set(extra_tokens).difference(name_tokens):
+            yield self.extra, token
+
+    def _indexed(self, token):
+        return token in self.first or token in self.names or token in self.extra
+
+    def load(self, session):
+        self.docs, self.first, self.names, self.extra = {}, {}, {}, {}
+        for row in session.query(*self._columns()).yield_per(5000):
+            doc = self.docs[row.id] = self._document(row)
+            key = sort_key(doc[0], row.id)
+            for postings, token in self._postings(doc):
+                keys = postings.get(token)
+                if keys is None:
+                    keys = postings[token] = []
+                keys.append(key)
+        for postings in (self.first, self.names, self.extra):
+            for keys in postings.values():
+                keys.sort()
+        self.tokens = sorted(set(self.first).union(self.names, self.extra))
+        self.generation += 1
+
+    def _remove(self, id):
+        doc = self.docs.pop(id, None)
+        if doc is None:
+            return
+        key = sort_key(doc[0], id)
+        for postings, token in self._postings(doc):
+            keys = postings[token]
+            del keys[bisect.bisect_left(keys, key)]
+            if not keys:
+                del postings[token]
+                if not self._indexed(token):
+                    del self.tokens[bisect.bisect_left(self.tokens, token)]
+
+    def _add(self, row):
+        doc = self.docs[row.id] = self._document(row)
+        key = sort_key(doc[0], row.id)
+        for postings, token in self._postings(doc):
+            keys = postings.get(token)
+            if keys is None:
+                if not self._indexed(token):
+                    bisect.insort(self.tokens, token)
+                keys = postings[token] = []
+            bisect.insort(keys, key)
+
+    def changed(self, session, settle, limit=MAX_REFRESH_ROWS):
+        """The ids logged after `since` and the seq to move `since` to, or None when the table must reload."""
+        table = self.model.__tablename__
+        oldest = session.query(func.min(ChangeLog.seq)).scalar()
+        if self.since is None or (oldest is not None and self.since < oldest - 1):
+            return None
+        entries = (session.query(ChangeLog.seq, ChangeLog.row_key, ChangeLog.changed_at)
+                   .filter(ChangeLog.table_name == table, ChangeLog.seq > self.since)
+                   .order_by(ChangeLog.seq).limit(limit + 1).all())
+        if len(entries) > limit or any(entry.row_key is None for entry in entries):
+            return None
+        # entries younger than `settle` are read again next time, as the feed does (see changes.py)
+        settled = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=settle)
+        since = max([self.since] + [entry.seq for entry in entries if entry.changed_at <= settled])
+        return {int(entry.row_key) for entry in entries}, since
+
+    def fetch(self, session, ids):
+        """The current rows of `ids`, to hand to `refresh` (deleted ones are missing)."""
+        ids = [id for id in ids if id is not None]
+        return session.query(*self._columns()).filter(self.model.id.in_(ids)).all() if ids else []
+
+    def refresh(self, ids, rows):
+        """Replaces the rows `ids` with `rows`, read by `fetch` (deleted ones simply drop out)."""
+        for id in ids:
+            self._remove(id)
+        for row in rows:
+            self._add(row)
+        self.generation += 1
+
+    def _prefixed(self, prefix):
+        start = bisect.bisect_left(self.tokens, prefix)
+        end = bisect.bisect_left(self.tokens, prefix + '\uffff')
+        return self.tokens[start:end]
+
+    def _smallest(self, postings, tokens, count):
+        """The `count` smallest distinct keys in the postings of `tokens`, in order."""
+        lists = [postings[token] for token in tokens if token in postings]
+        if len(lists) > count:
+            # only lists starting at or below the count-th smallest head can reach the result
+            threshold = heapq.nsmallest(count, [keys[0] for keys in lists])[-1]
+            keys = set()
+            for candidates in lists:
+                if candidates[0] <= threshold:
+                    keys.update(candidates[:bisect.bisect_right(candidates, threshold)])
+            if len(keys) >= count:
+                return sorted(keys)[:count]
+        merged = (key for key, _ in itertools.groupby(heapq.merge(*lists)))
+        return list(itertools.islice(merged, count))
+
+    def _ranked_word(self, term, count):
+        prefixed = self._prefixed(term)
+        groups = ((self.first, prefixed), (self.names, [term]), (self.names, prefixed), (self.extra, prefixed))
+        ranked = []
+        seen = set()
+        for group, (postings, tokens) in enumerate(groups):
+            for key in self._smallest(postings, tokens, count + len(seen)):
+                if key not in seen:
+                    seen.add(key)
+                    ranked.append((group, key >> ID_BITS, key & ID_MASK))
+                    if len(ranked) == count:
+                        return ranked
+        return ranked
+
+    def rank(self, id, terms):
+        name, url, name_tokens, extra_tokens = self.docs[id]
+        size = len(terms)
+        if name_tokens[:size - 1] == tuple(terms[:-1]) and len(name_tokens) >= size and name_tokens[size - 1].startswith(terms[-1]):
+            group = 0
+        elif all(term in name_tokens for term in terms):
+            group = 1
+        elif all(any(token.startswith(term) for token in name_tokens) for term in terms):
+            group = 2
+        else:
+            group = 3
+        return group, len(name), id
+
+    def _word_postings(self, term):
+        """The postings lists of the rows with a word starting with `term`, in the name or the extra fields."""
+        return [postings[token] for token in self._prefixed(term)
+                for postings in (self.names, self.extra) if token in postings]
+
+    def ranked(self, terms, count):
+        """The best `count` matches as `(group, name length, id)` tuples, best first."""
+        if len(terms) == 1:
+            return self._ranked_word(terms[0], count)
+        # several words: intersect their postings, starting from the shortest
+        words = sorted((self._word_postings(term) for term in set(terms)),
+                       key=lambda lists: sum(len(keys) for keys in lists))
+        keys = set(itertools.chain.from_iterable(words[0]))
+        for lists in words[1:]:
+            if not keys:
+                break
+            if len(keys) * len(lists) < sum(len(postings) for postings in lists):
+                # few candidates left: bisect each into the lists rather than reading them whole
+                keys = {key for key in keys if any(_contains(postings, key) for postings in lists)}
+            else:
+                keys.intersection_update(itertools.chain.from_iterable(lists))
+        return heapq.nsmallest(count, (self.rank(key & ID_MASK, terms) for key in keys))
+
+
+class SearchIndex:
+
+    def __init__(self, memo_size=1024):
+        self.memo = LRUCache(memo_size, ttl=MEMO_TTL)
+        self.lock = threading.Lock()  # serializes updating, swapping and ranking; no query runs under it
+        self.tables = dict(
+            (kind, TableIndex(model, name_fields, extra_fields))
+            for kind, (model, name_fields, extra_fields) in SEARCH_TYPES.items())
+        self.loading = {}  # kind -> Event set when its background load ends
+
+    def _reload(self, kind):
+        """Starts building a new index of `kind` in a background thread, unless one is; returns its Event."""
+        loading = self.loading.get(kind)
+        if loading is None:
+            loading = self.loading[kind] = threading.Event()
+            threading.Thread(target=self._load, args=(current_app._get_current_object(), kind, loading),
+                             name='search-load-%s' % kind, daemon=True).start()
+        return loading
+
+    def _load(self, app, kind, loading):
+        index = TableIndex(*SEARCH_TYPES[kind])
+        try:
+            with app.app_context():
+                settle = app.config.get('CHANGES_SETTLE', DEFAULT_SETTLE)
+                with primary_reads() as session:
+                    # read before the rows: what commits while loading is read again next time
+                    since = settled_seq(session, settle)
+                    index.load(session)
+                index.since = since
+        except Exception:
+            app.logger.exception('No se pudo cargar el índice de búsqueda de %s', kind)
+            index = None
+        with self.lock:
+            current = self.tables[kind]
+            if index is None:
+                current.version = None  # tried again on the next search
+            else:
+                # the new index catches up from `since` on the next search
+                index.generation = current.generation + 1
+                self.tables[kind] = index
+            del self.loading[kind]
+        loading.set()
+
+    def _current(self, kind, versions, session):
+        """Brings the index of `kind` up to date, or returns the Event to wait for when it was never loaded.
+
+        The change log and the rows are read without the lock, which is only
+        taken to apply them; a search that finds the index moved meanwhile
+        leaves it to the next one.
+        """
+        index = self.tables[kind]
+        if index.since is None:
+            with self.lock:
+                return self._reload(kind)
+        version = versions.get(index.model.__tablename__)
+        if version == index.version:
+            return None
+        since = index.since
+        settle = current_app.config.get('CHANGES_SETTLE', DEFAULT_SETTLE)
+        with primary_reads(session):
+            changed = index.changed(session, settle)
+            rows = index.fetch(session, changed[0]) if changed is not None else None
+        with self.lock:
+            if self.tables[kind] is not index or index.since != since:
+                return None
+            if changed is None:
+                # searches keep this index until the new one is swapped in
+                self._reload(kind)
+            else:
+                ids, index.since = changed
+                if ids:
+                    index.refresh(ids, rows)
+            index.version = version
+        return None
+
+    def _ranked(self, kind, terms, count, versions, session):
+        """The best `count` matches of `kind` as `(rank, name, url)`, waiting for the first load of its index."""
+        for attempt in range(2):
+            loading = self._current(kind, versions, session)
+            if loading is None:
+                with self.lock:
+                    index = self.tables[kind]
+                    key = (kind, index.generation, tuple(terms), count)
+                    top = self.memo.get(key)
+                    if top is MISSING:
+                        top = index.ranked(terms, count)
+                        self.memo.set(key, top)
+                    return [(rank,) + index.docs[rank[2]][:2] for rank in top]
+            loading.wait()
+        raise APIException('El índice de búsqueda no está disponible', status_code=503)
+
+    def search(self, q, kinds, limit, offset, session=None):
+        """Returns the page `offset:offset + limit` of the ranking and whether more results follow."""
+        if session is None:
+            session = db.session
+        terms = tokenize(q)
+        if not terms:
+            return [], False
+        versions = get_versions()
+        ranked = []
+        for kind in kinds:
+            for rank, name, url in self._ranked(kind, terms, offset + limit + 1, versions, session):
+                ranked.append((rank, kind, {'type': kind, 'id': rank[2], 'name': name, 'url': url}))
+        ranked.sort(key=lambda item: item[:2])
+        return [item[2] for item in ranked[offset:offset + limit]], len(ranked) > offset + limit
+
+
+def setup_search(app):
+    app.extensions['search_index'] = SearchIndex()
+
+
+def get_search_index():
+    return current_app.extensions['search_index']
+
+
+def search_args(args):
+    """Reads `q`, `type`, `limit` and `offset`; raises APIException (400) on bad values."""
+    q = (args.get('q') or '').strip()
+    if not q:
+        raise APIException("El parámetro 'q' es obligatorio", status_code=400)
+    if len(q) > MAX_QUERY_LENGTH:
+        raise APIException("'q' no puede tener más de %d caracteres" % MAX_QUERY_LENGTH, status_code=400)
+    kinds = [kind.strip() for kind in args.get('type', '').split(',') if kind.strip()] or list(SEARCH_TYPES)
+    unknown = [kind for kind in kinds if kind not in SEARCH_TYPES]
+    if unknown:
+        raise APIException("Tipo desconocido: %s" % ', '.join(unknown), status_code=400,
+                           payload={'available': sorted(SEARCH_TYPES)})
+    limit = min(int_arg('limit', 1, args) or DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT)
+    offset = min(int_arg('offset', 0, args) or 0, MAX_SEARCH_OFFSET)
+    return q, kinds, limit, offset
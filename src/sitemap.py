@@ -0,0 +1,99 @@
+"""
+The route index: the sitemap page at `/` and its machine-readable twin at
+`/openapi.json`, built once and served from memory with a strong ETag.
+
+Health checkers and crawlers hit `/` constantly, so walking the url map
+and building the HTML on every request is wasted work. The index is built
+on the first request, when every blueprint is registered (Flask refuses new
+routes after that), and only rebuilt if the number of rules changes.
+"""
+import hashlib
+import re
+import threading
+from flask import current_app, request
+from conditional import matching_etag
+from utils import generate_sitemap
+
+OPENAPI_VERSION = '3.0.3'
+# werkzeug converter -> OpenAPI schema type
+PARAMETER_TYPES = {'int': 'integer', 'float': 'number'}
+PARAMETER_RE = re.compile(r'<(?:([a-zA-Z_][a-zA-Z0-9_]*)(?:\([^)]*\))?:)?([a-zA-Z_][a-zA-Z0-9_]*)>')
+HIDDEN_PREFIXES = ('/admin', '/static')
+
+
+def openapi_document(app):
+    """A minimal OpenAPI document listing every route with its methods and path parameters."""
+    paths = {}
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        if rule.rule.startswith(HIDDEN_PREFIXES):
+            continue
+        parameters = [{
+            'name': name,
+            'in': 'path',
+            'required': True,
+            'schema': {'type': PARAMETER_TYPES.get(converter, 'string')},
+        } for converter, name in PARAMETER_RE.findall(rule.rule)]
+        view = app.view_functions.get(rule.endpoint)
+        doc = (view.__doc__ or '').strip().split('\n')[0] if view is not None else ''
+        path = paths.setdefault(PARAMETER_RE.sub(r'{\2}', rule.rule), {})
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            operation = path[method.lower()] = {
+                'operationId': rule.endpoint,
+                'responses': {'200': {'description': 'OK'}},
+            }
+            if doc:
+                operation['summary'] = doc
+            if parameters:
+                operation['parameters'] = parameters
+    return {
+        'openapi': OPENAPI_VERSION,
+        'info': {'title': app.import_name, 'version': '1.0'},
+        'paths': paths,
+    }
+
+
+class RouteIndex:
+    """The sitemap and OpenAPI bodies with their ETags, for one set of url rules."""
+
+    def __init__(self):
+        self.rules = None  # how many rules the bodies were built from
+        self.pages = {}  # name -> (body, mimetype, etag)
+        self.lock = threading.Lock()
+
+    def get(self, app, name):
+        rules = len(app.url_map._rules)
+        page = self.pages.get(name) if self.rules == rules else None
+        if page is None:
+            with self.lock:
+                if self.rules != rules:
+                    self.pages = self.build(app)
+                    self.rules = rules
+                page = self.pages[name]
+        return page
+
+    def build(self, app):
+        pages = {}
+        for name, body, mimetype in (
+            ('sitemap', generate_sitemap(app).encode('utf-8'), 'text/html'),
+            ('openapi', app.json.dumps(openapi_document(app)).encode('utf-8'), 'application/json'),
+        ):
+            pages[name] = (body, mimetype, hashlib.sha1(body).hexdigest()[:20])
+        return pages
+
+
+def setup_sitemap(app):
+    app.extensions['route_index'] = RouteIndex()
+
+
+def route_index_response(name):
+    """The cached page `name` of the route index, or a 304 when the client has it."""
+    body, mimetype, etag = current_app.extensions['route_index'].get(current_app, name)
+    matched = matching_etag(request.if_none_match, etag)
+    if matched is not None:
+        response = current_app.response_class(status=304)
+        etag = matched
+    else:
+        response = current_app.response_class(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = current_app.config['CATALOG_CACHE_CONTROL']
+    return response
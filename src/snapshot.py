@@ -0,0 +1,172 @@
+"""
+Snapshots of the whole catalog for offline clients and analytics jobs, so
+they stop downloading the full `/people` and `/planets` listings again and
+again.
+
+    GET /snapshot/people?format=columnar      binary, column by column (the default, see columnar.py)
+    GET /snapshot/planets?format=ndjson       gzip'd NDJSON
+
+    SNAPSHOT_DIR    where the files are kept (instance/snapshots)
+    SNAPSHOT_KEEP   files kept per table and format, older data versions are deleted (4)
+
+A snapshot is written once per data version of its table (see versions.py)
+and then served from disk with `send_file`, so `Range`/`If-Range` resume an
+interrupted download and `If-None-Match` answers 304 while the data has not
+changed. The header of every snapshot carries `since`: replaying `/changes`
+from there brings the client up to date without another snapshot.
+
+    $ flask export-snapshot people --format ndjson     writes it ahead of the first request
+    $ flask export-snapshot --output ./dumps           a copy for a job, outside SNAPSHOT_DIR
+
+Every worker reads the same data versions, so they all serve the same file
+and the command writes the one they serve.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+import click
+from flask import current_app, send_file
+from flask.cli import with_appcontext
+from sqlalchemy import Integer
+from columnar import ColumnarWriter, NDJSONWriter
+from changes import DEFAULT_SETTLE, settled_seq
+from importer import MODELS
+from models import db
+from replicas import primary_reads
+from serializers import get_encoder
+from utils import APIException
+from versions import get_versions
+
+DEFAULT_KEEP = 4
+# format -> (file extension, mimetype)
+FORMATS = {
+    'columnar': ('.snap', 'application/octet-stream'),
+    'ndjson': ('.ndjson.gz', 'application/gzip'),
+}
+DEFAULT_FORMAT = 'columnar'
+
+
+def snapshot_header(model, since):
+    encoder = get_encoder(model)
+    columns = model.__table__.columns
+    return {
+        'table': model.__tablename__,
+        'columns': [{'name': name, 'type': 'int32' if isinstance(columns[name].type, Integer) else 'str'}
+                    for name in encoder.fields],
+        'since': since,
+        'generated_at': datetime.now(timezone.utc).replace(tzinfo=None).isoformat() + 'Z',
+    }
+
+
+def write_snapshot(fp, model, format, session=None, settle=DEFAULT_SETTLE):
+    """Writes every row of `model` to `fp` in `format`, streaming from the database; returns the row count."""
+    if session is None:
+        session = db.session
+    encoder = get_encoder(model)
+    with primary_reads(session):
+        header = snapshot_header(model, settled_seq(session, settle))
+        if format == 'ndjson':
+            writer = NDJSONWriter(fp, header)
+            encode = encoder.encode_row
+        else:
+            writer = ColumnarWriter(fp, header)
+            encode = tuple
+        for row in encoder.query(session).order_by(model.id).yield_per(1000):
+            writer.write(encode(row))
+    writer.close()
+    return writer.rows
+
+
+class SnapshotStore:
+    """The snapshot files in `directory`, one per table, format and data version."""
+
+    def __init__(self, directory, keep=DEFAULT_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self.lock = threading.Lock()
+
+    def name(self, kind, format, version):
+        return '%s-%s%s' % (kind, hashlib.sha1(version.encode('utf-8')).hexdigest()[:12], FORMATS[format][0])
+
+    def get(self, kind, format, settle=DEFAULT_SETTLE):
+        """The path of the snapshot of the current data version, written first if needed."""
+        model = MODELS[kind]
+        # read before the rows: a change made while writing moves the version and gets its own file
+        version = get_versions().fingerprint((model.__tablename__,))
+        path = os.path.join(self.directory, self.name(kind, format, version))
+        if not os.path.exists(path):
+            with self.lock:
+                if not os.path.exists(path):
+                    self.write(path, model, format, settle)
+                    self.prune(kind, format)
+        return path
+
+    def write(self, path, model, format, settle):
+        os.makedirs(self.directory, exist_ok=True)
+        # written aside and renamed, so no worker ever serves a half-written file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                write_snapshot(fp, model, format, settle=settle)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def prune(self, kind, format):
+        if not self.keep:
+            return
+        extension = FORMATS[format][0]
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.startswith(kind + '-') and name.endswith(extension)]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[self.keep:]:
+            try:
+                # a download already under way keeps its open file
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def snapshot_format(args):
+    format = args.get('format', DEFAULT_FORMAT)
+    if format not in FORMATS:
+        raise APIException("'format' debe ser uno de: %s" % ', '.join(sorted(FORMATS)), status_code=400)
+    return format
+
+
+def snapshot_response(kind, format):
+    """The snapshot file of `kind` with Range and conditional GET support."""
+    path = current_app.extensions['snapshots'].get(kind, format, current_app.config.get('CHANGES_SETTLE'))
+    extension, mimetype = FORMATS[format]
+    # the file name already names the data version, so it makes a strong tag
+    etag = os.path.basename(path)[:-len(extension)]
+    response = send_file(path, mimetype=mimetype, as_attachment=True, download_name=kind + extension,
+                         etag=etag, conditional=True, max_age=None)
+    response.headers['Cache-Control'] = current_app.config['CATALOG_CACHE_CONTROL']
+    return response
+
+
+@click.command('export-snapshot')
+@click.argument('kinds', nargs=-1, type=click.Choice(sorted(MODELS)))
+@click.option('--format', 'formats', multiple=True, type=click.Choice(sorted(FORMATS)),
+              help='Formato a generar, se puede repetir (por defecto todos).')
+@click.option('--output', default=None, type=click.Path(file_okay=False),
+              help='Directorio donde dejar una copia (por defecto SNAPSHOT_DIR, el que sirve /snapshot).')
+@with_appcontext
+def export_snapshot(kinds, formats, output):
+    """Writes the snapshots of the current data version of people and planets."""
+    store = current_app.extensions['snapshots'] if output is None else SnapshotStore(output, keep=0)
+    settle = current_app.config.get('CHANGES_SETTLE')
+    for kind in kinds or sorted(MODELS):
+        for format in formats or sorted(FORMATS):
+            path = store.get(kind, format, settle)
+            click.echo('%s (%d bytes)' % (path, os.path.getsize(path)))
+
+
+def setup_snapshots(app):
+    directory = os.environ.get('SNAPSHOT_DIR') or os.path.join(app.instance_path, 'snapshots')
+    app.extensions['snapshots'] = SnapshotStore(directory, int(os.environ.get('SNAPSHOT_KEEP', DEFAULT_KEEP)))
+    app.cli.add_command(export_snapshot)
@@ -0,0 +1,157 @@
+"""
+Grouped statistics over the Integer columns of the catalog, for dashboards
+that now pull the whole of `/people` or `/planets` to crunch them client-side.
+
+    GET /stats/people?by=gender&columns=height,mass
+    GET /stats/planets?by=climate&columns=population&percentiles=50,95&terrain=desert
+
+`by` is a text column to group by (none: one group with every row),
+`columns` the Integer columns to summarize (all but `id` by default) and
+`percentiles` the ones to compute (50,90,99). The filters of the listings
+apply. Each group comes back as
+
+    {"group": "female", "count": 12,
+     "columns": {"height": {"count": 11, "min": 150, "max": 202, "sum": 1870, "mean": 170.0, "p50": 168.0}}}
+
+where the group `count` is its rows and each column's `count` its non-null
+values, the ones the rest is computed over.
+
+count, min, max, sum and mean run as a single GROUP BY. Percentiles use
+`percentile_cont` on PostgreSQL; elsewhere the values come from one more
+query and are interpolated here the same way. Results are cached per data
+version of the table (see versions.py), so a dashboard refreshing every few
+seconds does not run them again until the data changes.
+"""
+import math
+from sqlalchemy import Integer, String, func
+from cache import get_cache
+from conditional import compute_etag
+from filters import NOT_FILTERABLE
+from models import db
+from replicas import primary_reads
+from utils import APIException
+
+DEFAULT_PERCENTILES = (50, 90, 99)
+MAX_PERCENTILES = 10
+
+
+def numeric_columns(model):
+    return tuple(column.name for column in model.__table__.columns
+                 if isinstance(column.type, Integer) and column.name != 'id')
+
+
+def group_columns(model):
+    return tuple(column.name for column in model.__table__.columns
+                 if isinstance(column.type, String) and column.name not in NOT_FILTERABLE)
+
+
+def stats_args(model, args):
+    """Validates `by`, `columns` and `percentiles` of the stats of `model`."""
+    by = args.get('by') or None
+    if by is not None and by not in group_columns(model):
+        raise APIException("'by' debe ser uno de: %s" % ', '.join(group_columns(model)), status_code=400)
+    available = numeric_columns(model)
+    columns = available
+    if args.get('columns'):
+        wanted = {name.strip() for name in args['columns'].split(',') if name.strip()}
+        unknown = wanted.difference(available)
+        if unknown:
+            raise APIException('Columnas desconocidas: %s' % ', '.join(sorted(unknown)), status_code=400,
+                               payload={'columns': list(available)})
+        columns = tuple(name for name in available if name in wanted)
+    percentiles = DEFAULT_PERCENTILES
+    if args.get('percentiles') is not None:
+        try:
+            percentiles = tuple(sorted({float(value) for value in args['percentiles'].split(',') if value.strip()}))
+        except ValueError:
+            raise APIException("'percentiles' debe ser una lista de numeros separados por comas", status_code=400)
+        if len(percentiles) > MAX_PERCENTILES or any(not 0 <= value <= 100 for value in percentiles):
+            raise APIException('Hasta %d percentiles, entre 0 y 100' % MAX_PERCENTILES, status_code=400)
+    return by, columns, percentiles
+
+
+def percentile_name(value):
+    return 'p%g' % value
+
+
+def interpolate(values, fraction):
+    """The percentile of sorted `values` by linear interpolation, as percentile_cont computes it."""
+    position = (len(values) - 1) * fraction
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return float(values[lower] + (values[upper] - values[lower]) * (position - lower))
+
+
+def _grouped(session, group, selected, conditions):
+    """The query of `selected` per value of `group`, or over every row when group is None, with the group first."""
+    if group is None:
+        return [(None,) + tuple(row) for row in session.query(*selected).filter(*conditions)]
+    return session.query(group, *selected).filter(*conditions).group_by(group).all()
+
+
+def _percentiles(model, group, columns, percentiles, conditions, session):
+    """{group: {column: {"p50": ...}}}."""
+    found = {}
+    if session.get_bind().dialect.name == 'postgresql':
+        selected = [func.percentile_cont(value / 100).within_group(getattr(model, name))
+                    for name in columns for value in percentiles]
+        for row in _grouped(session, group, selected, conditions):
+            values = iter(row[1:])
+            found[row[0]] = {name: {percentile_name(value): next(values) for value in percentiles} for name in columns}
+        return found
+    # one pass over the values, sorted here per group and column
+    values = {}
+    selected = [getattr(model, name) for name in columns]
+    query = session.query(*selected) if group is None else session.query(group, *selected)
+    for row in query.filter(*conditions):
+        key, row = (None, row) if group is None else (row[0], row[1:])
+        by_column = values.setdefault(key, {name: [] for name in columns})
+        for name, value in zip(columns, row):
+            if value is not None:
+                by_column[name].append(value)
+    for key, by_column in values.items():
+        found[key] = {}
+        for name, column_values in by_column.items():
+            column_values.sort()
+            found[key][name] = {
+                percentile_name(value): interpolate(column_values, value / 100) if column_values else None
+                for value in percentiles
+            }
+    return found
+
+
+def compute_stats(model, by, columns, percentiles, conditions=(), session=None):
+    """The groups of `model` (by the column `by`, or a single one) with the stats of `columns`."""
+    if session is None:
+        session = db.session
+    group = getattr(model, by) if by is not None else None
+    selected = [func.count()]
+    for name in columns:
+        column = getattr(model, name)
+        selected += [func.count(column), func.min(column), func.max(column), func.sum(column), func.avg(column)]
+    with primary_reads(session):
+        rows = _grouped(session, group, selected, conditions)
+        found = _percentiles(model, group, columns, percentiles, conditions, session) if percentiles and rows else {}
+    groups = []
+    for row in sorted(rows, key=lambda row: (row[0] is None, row[0] or '')):
+        stats = {}
+        for index, name in enumerate(columns):
+            count, minimum, maximum, total, mean = row[2 + 5 * index:7 + 5 * index]
+            stats[name] = {
+                'count': count,
+                'min': minimum,
+                'max': maximum,
+                'sum': int(total) if total is not None else None,
+                'mean': float(mean) if mean is not None else None,
+            }
+            for key, value in found.get(row[0], {}).get(name, {}).items():
+                stats[name][key] = float(value) if value is not None else None
+        groups.append({'group': row[0], 'count': row[1], 'columns': stats})
+    return {'by': by, 'columns': list(columns), 'groups': groups}
+
+
+def cached_stats(model, by, columns, percentiles, conditions):
+    """`compute_stats` for the current request, cached for the current data version of the table."""
+    # the ETag key already covers the data version, the path and the whole query string
+    key = 'stats:%s' % compute_etag((model.__tablename__,))
+    return get_cache().get_or_load(key, lambda: compute_stats(model, by, columns, percentiles, conditions))
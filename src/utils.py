@@ -21,7 +21,7 @@ def has_no_empty_params(rule):
     return len(defaults) >= len(arguments)
 
 def generate_sitemap(app):
-    links = ['/admin/']
+    links = ['/admin/'] if app.config.get('ENABLE_ADMIN', True) else []
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters
@@ -39,3 +39,10 @@ def generate_sitemap(app):
         <p>Start working on your proyect by following the <a href="https://github.com/4GeeksAcademy/flask-rest-hello/blob/master/docs/_QUICK_START.md" target="_blank">Quick Start</a></p>
         <p>Remember to specify a real endpoint path like: </p>
         <ul style="text-align: left;">"""+links_html+"</ul></div>"
+
+def setup_swagger(app):
+    # the spec is only built when asked for, so flask_swagger is not imported at startup
+    @app.route('/swagger.json')
+    def swagger_spec():
+        from flask_swagger import swagger
+        return jsonify(swagger(app))
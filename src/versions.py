@@ -0,0 +1,299 @@
+"""
+Change capture: per-table and per-row data versions, the change log and the
+change events, all driven by the SQLAlchemy session events.
+
+Every flush and bulk statement on a tracked table is collected with the
+rows it touched (or as "unknown rows" for a bulk statement that does not
+name them, see `changed_keys` below) and written to the `change_log` table
+in the same transaction. After the commit a `ChangeEvent` is handed to the
+listeners (search index, catalog cache, and the cross-process bus of
+changes.py).
+
+The data versions are read from the change log on the primary, so every
+process agrees on them whoever made the change. A table's version is its
+newest sequence number plus how many of its entries are among the last
+VERSION_WINDOW sequence numbers, so a transaction that took its numbers
+before another but committed after it still moves the version; a row's
+version is the same over its own entries and the table's bulk ones. Both
+are read in one query, and then reused by the process:
+
+    VERSIONS_MAX_AGE   seconds a process reuses the versions it read (5; 0 reads them on every request)
+
+so repeated conditional GETs are answered without any query. The process's
+own commits show in the ETags at once. A change made by another process
+shows once this process replays it from the change log (every
+CHANGES_POLL_INTERVAL, see changes.py), and never later than
+VERSIONS_MAX_AGE.
+
+Bulk statements that know their rows say so with execution options:
+
+    session.execute(stmt.execution_options(changed_keys=[1, 2], change_op='update'))
+"""
+import itertools
+import os
+from datetime import datetime, timedelta, timezone
+from flask import current_app, g, has_app_context
+from sqlalchemy import event, func, inspect, insert, or_, select
+from sqlalchemy.orm import Session
+from cache import LRUCache, MISSING
+from models import db, ChangeLog
+
+TRACKED_TABLES = ('character', 'planet', 'character_popularity', 'planet_popularity',
+                  'favorites_characters', 'favorites_planet')
+# recent sequence numbers counted into a version, see the docstring
+VERSION_WINDOW = 1000
+DEFAULT_MAX_AGE = 5
+
+
+class ChangeEvent:
+    """A committed change to `table`: `rows` maps each primary key to insert/update/delete, or is None
+    when a bulk statement touched rows it did not name. `remote` events come from another process."""
+
+    def __init__(self, table, rows, remote=False):
+        self.table = table
+        self.rows = rows
+        self.remote = remote
+
+    def __repr__(self):
+        return '<ChangeEvent %s %r>' % (self.table, self.rows)
+
+
+def _version(conditions):
+    """The newest seq of the entries matching `conditions`, how many of them are recent and when the newest was written."""
+    newest = select(func.max(ChangeLog.seq)).where(*conditions).correlate(None).scalar_subquery()
+    recent = select(func.count()).select_from(ChangeLog.__table__).where(
+        *conditions, ChangeLog.seq > newest - VERSION_WINDOW).correlate(None).scalar_subquery()
+    changed_at = select(ChangeLog.changed_at).where(ChangeLog.seq == newest).correlate(None).scalar_subquery()
+    return [newest, recent, changed_at]
+
+
+class TableVersions:
+    """The data versions of the tables and rows, read from the change log."""
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE, memo_size=4096):
+        self.memo = LRUCache(memo_size, ttl=max_age) if max_age else None  # name -> (version, changed at)
+        self.listeners = []
+        # replays the entries of the other processes (changes.ChangeLogFollower), caught up here whenever
+        # the log has entries it has not seen, so no cached row is older than the version just read
+        self.follower = None
+
+    def _known(self, names):
+        """The versions of `names` already read in this request (or recently, with max_age) and the missing ones."""
+        known = g.setdefault('data_versions', {}) if has_app_context() else {}
+        missing = []
+        for name in names:
+            if name not in known and self.memo is not None:
+                version = self.memo.get(name)
+                if version is not MISSING:
+                    known[name] = version
+            if name not in known:
+                missing.append(name)
+        return known, missing
+
+    def _query(self, names, position=None):
+        """One SELECT of the versions of `names`, tables or (table, key) pairs (then the entries past
+        the follower's cursor, given its `position`)."""
+        # the oldest entry kept: versions never go back when pruning removes their entries
+        columns = [select(func.min(ChangeLog.seq)).correlate(None).scalar_subquery()]
+        for name in names:
+            if isinstance(name, tuple):
+                table, key = name
+                columns += _version((ChangeLog.table_name == table,
+                                     or_(ChangeLog.row_key == encode_key(key), ChangeLog.row_key.is_(None))))
+            else:
+                columns += _version((ChangeLog.table_name == name,))
+        if position is not None:
+            columns.append(select(func.count()).select_from(ChangeLog.__table__)
+                           .where(ChangeLog.seq > position[0]).correlate(None).scalar_subquery())
+        return select(*columns)
+
+    def _store(self, known, names, row):
+        floor, values = row[0] or 0, iter(row[1:])
+        for name in names:
+            newest, recent, changed_at = next(values), next(values), next(values)
+            known[name] = ('%d.%d' % (max(newest or 0, floor), recent), changed_at)
+            if self.memo is not None:
+                self.memo.set(name, known[name])
+
+    def _behind(self, position, row):
+        """Whether the follower has entries to replay: it never ran, or the log past its cursor changed."""
+        return self.follower is not None and (position is None or row[-1] != position[1])
+
+    def _read(self, names, session=None):
+        known, missing = self._known(names)
+        if missing:
+            session = db.session if session is None else session
+            position = self.follower.position() if self.follower is not None else None
+            # on the primary, see replicas.py
+            row = session.execute(self._query(missing, position), bind_arguments={'bind': db.engine}).one()
+            self._store(known, missing, row)
+            if self._behind(position, row):
+                self.follower.catch_up(session)
+        return {name: known[name] for name in names}
+
+    async def prefetch(self, names, session):
+        """Reads the versions of `names` with an AsyncSession of the primary, so the ASGI handlers
+        get their fingerprints without a blocking query."""
+        known, missing = self._known(names)
+        if missing:
+            position = self.follower.position() if self.follower is not None else None
+            row = (await session.execute(self._query(missing, position))).one()
+            self._store(known, missing, row)
+            if self._behind(position, row):
+                await session.run_sync(lambda sync_session: self.follower.catch_up(sync_session, sync_session.bind))
+
+    def get(self, table):
+        return self._read([table])[table][0]
+
+    def changed_within(self, names, seconds):
+        """Whether any of `names` (tables or (table, key) pairs) changed in the last `seconds`."""
+        since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=seconds)
+        return any(changed_at is not None and changed_at > since for _, changed_at in self._read(names).values())
+
+    def forget(self):
+        """Drops the versions read so far, after this process committed a change."""
+        if has_app_context():
+            g.pop('data_versions', None)
+        if self.memo is not None:
+            self.memo.clear()
+
+    def subscribe(self, listener):
+        """Calls `listener(event)` with a ChangeEvent after each commit that changes a table."""
+        self.listeners.append(listener)
+
+    def notify(self, change):
+        if change.remote and self.memo is not None:
+            # the versions of another process's change are read again on the next request
+            self.memo.clear()
+        for listener in self.listeners:
+            listener(change)
+
+    def fingerprint(self, tables):
+        """A short string that changes whenever any of `tables` changes."""
+        versions = self._read(tables)
+        return '-'.join('%s%s' % (table, versions[table][0]) for table in tables)
+
+    def row_fingerprint(self, table, key):
+        """Like `fingerprint`, but only changes with the row `key` of `table`."""
+        return '%s.%s.%s' % (table, key, self._read([(table, key)])[(table, key)][0])
+
+
+def setup_versions(app):
+    app.extensions['table_versions'] = TableVersions(float(os.environ.get('VERSIONS_MAX_AGE', DEFAULT_MAX_AGE)))
+
+
+def get_versions():
+    return current_app.extensions['table_versions']
+
+
+def encode_key(key):
+    """The primary key as stored in the change log: "5", or "1:5" for a composite key."""
+    return ':'.join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+
+
+def decode_key(row_key):
+    """The primary key of a change log entry, as the ChangeEvents of this process carry it."""
+    parts = tuple(int(part) if part.lstrip('-').isdigit() else part for part in row_key.split(':'))
+    return parts[0] if len(parts) == 1 else parts
+
+
+def _pending(session):
+    return session.info.setdefault('changed_tables', set())
+
+
+def _pending_rows(session):
+    return session.info.setdefault('changed_rows', {})
+
+
+def _log(session, table, changes, op=None):
+    """Writes the change log entries of `changes` ({key: op}, or None for unknown rows changed by `op`)."""
+    if table not in TRACKED_TABLES:
+        return
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if changes is None:
+        entries = [{'table_name': table, 'row_key': None, 'op': op, 'changed_at': now}]
+    else:
+        entries = [{'table_name': table, 'row_key': encode_key(key), 'op': row_op, 'changed_at': now}
+                   for key, row_op in changes.items()]
+    if entries:
+        session.connection(bind_arguments={'mapper': ChangeLog}).execute(insert(ChangeLog.__table__), entries)
+
+
+def mark_changed(session, table, keys=None, op='update'):
+    """Records a change to `keys` of `table` (None: unknown rows) made in this transaction.
+
+    The bulk statements go through here; call it for changes made behind the
+    session's back (raw SQL, migrations) so they are versioned and logged too.
+    """
+    _pending(session).add(table)
+    rows = _pending_rows(session)
+    if keys is None:
+        rows[table] = None
+        _log(session, table, None, op)
+    else:
+        changes = dict.fromkeys(keys, op)
+        if rows.get(table, {}) is not None:
+            rows.setdefault(table, {}).update(changes)
+        _log(session, table, changes)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_flushed(session, flush_context):
+    flushed = {}
+    changes = itertools.chain(
+        ((obj, 'insert') for obj in session.new),
+        ((obj, 'delete') for obj in session.deleted),
+        ((obj, 'update') for obj in session.dirty if session.is_modified(obj)),
+    )
+    for obj, op in changes:
+        table = getattr(obj, '__tablename__', None)
+        if table is None or table == ChangeLog.__tablename__:
+            continue
+        key = tuple(inspect(obj).mapper.primary_key_from_instance(obj))
+        key = key[0] if len(key) == 1 else key
+        flushed.setdefault(table, {})[key] = op
+    rows = _pending_rows(session)
+    for table, changes in flushed.items():
+        _pending(session).add(table)
+        if rows.get(table, {}) is not None:
+            pending = rows.setdefault(table, {})
+            for key, op in changes.items():
+                # an insert later updated in the same transaction is still an insert
+                if pending.get(key) != 'insert' or op == 'delete':
+                    pending[key] = op
+        _log(session, table, changes)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_executed(orm_execute_state):
+    # bulk query.update()/query.delete() and session.execute(insert(...)) skip the flush
+    state = orm_execute_state
+    if not (state.is_insert or state.is_update or state.is_delete):
+        return None
+    table = getattr(state.statement, 'table', None)
+    if table is None or table.name == ChangeLog.__tablename__:
+        return None
+    result = state.invoke_statement()
+    op = state.execution_options.get('change_op') or (
+        'insert' if state.is_insert else 'update' if state.is_update else 'delete')
+    mark_changed(state.session, table.name, state.execution_options.get('changed_keys'), op)
+    return result
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_committed(session):
+    tables = session.info.pop('changed_tables', None)
+    rows = session.info.pop('changed_rows', None) or {}
+    if not tables or not has_app_context() or 'table_versions' not in current_app.extensions:
+        return
+    versions = get_versions()
+    versions.forget()
+    for table in tables:
+        if table in TRACKED_TABLES:
+            versions.notify(ChangeEvent(table, rows.get(table)))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back(session):
+    session.info.pop('changed_tables', None)
+    session.info.pop('changed_rows', None)
@@ -1,7 +1,10 @@
 # This file was created to run the application on heroku using gunicorn.
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
+# APP_PROFILE=api skips the admin UI and swagger in API-only workers (see config.py)
 
-from main import app as application
+from main import create_app
+
+application = create_app()
 
 if __name__ == "__main__":
     application.run()
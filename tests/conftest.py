@@ -0,0 +1,63 @@
+"""
+Fixtures building the app with create_app('testing') on SQLite files under
+the test's tmp_path. `make_app(**env)` sets the environment variables read at
+setup and returns a new app, so two apps on the same files stand for two
+worker processes.
+"""
+import os
+import sqlite3
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from main import create_app  # noqa: E402
+from models import db, User, Character, Planet  # noqa: E402
+
+
+def sqlite_url(path):
+    return 'sqlite:///%s' % path
+
+
+def age_change_log(path, seconds=3600):
+    """Moves the change log of the database at `path` back in time, as if written `seconds` ago."""
+    with sqlite3.connect(str(path)) as connection:
+        connection.execute("UPDATE change_log SET changed_at = datetime(changed_at, '-%d seconds')" % seconds)
+
+
+def rename(app, model, id, name):
+    """Commits a new name for a row through `app`, as a write from its process."""
+    with app.app_context():
+        db.session.get(model, id).name = name
+        db.session.commit()
+
+
+@pytest.fixture
+def primary(tmp_path):
+    return tmp_path / 'primary.db'
+
+
+@pytest.fixture
+def make_app(monkeypatch, primary):
+    def make(**env):
+        env.setdefault('DB_CONNECTION_STRING', sqlite_url(primary))
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        return create_app('testing')
+    return make
+
+
+@pytest.fixture
+def seed(make_app, primary):
+    """Creates the schema in the primary with 2 users, 10 characters and 10 planets, logged an hour ago."""
+    app = make_app()
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([User('a@example.com', 'x', True), User('b@example.com', 'x', True)])
+        for id in range(1, 11):
+            db.session.add(Character(id, 'Character %d' % id, 'https://swapi.dev/api/people/%d' % id))
+            db.session.add(Planet(id, 'Planet %d' % id, 'https://swapi.dev/api/planets/%d' % id))
+        db.session.commit()
+        db.engine.dispose()
+    age_change_log(primary)
+    return app
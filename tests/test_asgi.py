@@ -0,0 +1,54 @@
+"""
+The ASGI entry point (asgi.py), called with bare scope/receive/send.
+"""
+import asyncio
+import pytest
+
+
+@pytest.fixture
+def application(make_app, seed):
+    app = make_app()
+    from asgi import ASGIApp
+    return ASGIApp(app)
+
+
+def call(application, method, path, query=b''):
+    """Runs one request, returns (status, headers, body)."""
+    messages = []
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'headers': [],
+             'client': ('127.0.0.1', 1234)}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    start = messages[0]
+    assert start['type'] == 'http.response.start'
+    headers = {key.decode('latin-1'): value.decode('latin-1') for key, value in start['headers']}
+    return start['status'], headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+
+@pytest.mark.parametrize('path, query', [
+    ('/people', b''),
+    ('/people', b'limit=2'),
+    ('/character/3', b''),
+])
+def test_head_sends_the_headers_of_get_without_a_body(application, path, query):
+    status, headers, body = call(application, 'GET', path, query)
+    head_status, head_headers, head_body = call(application, 'HEAD', path, query)
+
+    assert status == head_status == 200
+    assert body and head_body == b''
+    assert head_headers['content-length'] == headers['content-length'] == str(len(body))
+    assert head_headers['etag'] == headers['etag']
+
+
+def test_head_of_a_streamed_listing_has_no_body(application):
+    status, headers, body = call(application, 'HEAD', '/people', b'stream=true')
+
+    assert status == 200
+    assert body == b''
+    assert headers['content-type'] == 'application/json'
@@ -0,0 +1,46 @@
+"""
+Change propagation between workers (changes.py): two apps on the same
+primary stand for two processes, with no bus between them unless set.
+"""
+from conftest import rename
+from models import db, Character
+
+
+def test_changes_from_another_process_reach_the_cache(make_app, seed):
+    app, other = make_app(CHANGES_POLL_INTERVAL='0'), make_app()
+    client = app.test_client()
+    assert client.get('/character/3').get_json()['name'] == 'Character 3'
+
+    rename(other, Character, 3, 'Renamed')
+
+    assert client.get('/character/3').get_json()['name'] == 'Renamed'
+    assert client.get('/people').get_json()[2]['name'] == 'Renamed'
+    assert app.extensions['change_log_follower'].events >= 1
+
+
+def test_the_follower_replays_each_entry_once(make_app, seed):
+    app, other = make_app(), make_app()
+    follower = app.extensions['change_log_follower']
+    events = []
+    app.extensions['table_versions'].subscribe(events.append)
+    app.test_client().get('/character/3')
+
+    rename(other, Character, 3, 'Renamed')
+    with app.app_context():
+        follower.catch_up(db.session)
+        follower.catch_up(db.session)
+
+    assert [(event.table, event.rows, event.remote) for event in events] == [('character', {3: 'update'}, True)]
+
+
+def test_memory_buses_do_not_cross_apps(make_app, seed):
+    app, other = make_app(CHANGES_BUS_URL='memory://'), make_app(CHANGES_BUS_URL='memory://')
+
+    rename(app, Character, 3, 'Renamed')
+
+    assert app.extensions['change_relay'].published == 1
+    assert other.extensions['change_relay'].received == 0
+
+
+def test_no_bus_by_default(make_app, seed):
+    assert make_app().extensions['change_relay'] is None
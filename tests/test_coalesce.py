@@ -0,0 +1,119 @@
+"""
+Request coalescing (coalesce.py): concurrent identical reads share one run
+of the view.
+"""
+import threading
+import time
+import pytest
+import main
+from coalesce import SingleFlight
+
+CALLERS = 8
+
+
+def concurrently(count, target):
+    """`count` threads running `target(i)`, only the first one started, and the list their results go to."""
+    results = [None] * count
+
+    def run(i):
+        try:
+            results[i] = target(i)
+        except Exception as error:
+            results[i] = error
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    threads[0].start()
+    return threads, results
+
+
+class Blocked:
+    """A function that blocks until released, counting its calls."""
+
+    def __init__(self, result=None, error=None):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+        self.result = result
+        self.error = error
+
+    def __call__(self):
+        self.calls += 1
+        self.entered.set()
+        assert self.release.wait(10)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def run_flight(flights, fn, shareable=None):
+    threads, results = concurrently(CALLERS, lambda i: flights.do('key', fn, shareable=shareable))
+    assert fn.entered.wait(10)
+    for thread in threads[1:]:
+        thread.start()
+    # the followers are waiting for the leader
+    time.sleep(0.2)
+    fn.release.set()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_concurrent_calls_share_one_run():
+    flights = SingleFlight()
+    fn = Blocked('result')
+
+    results = run_flight(flights, fn)
+
+    assert fn.calls == 1
+    assert sorted(results, key=lambda result: result[1]) == [('result', False)] + [('result', True)] * (CALLERS - 1)
+    assert flights.flights == {}
+    # the next call runs again
+    fn.release.set()
+    assert flights.do('key', fn) == ('result', False)
+
+
+def test_errors_reach_every_caller():
+    flights = SingleFlight()
+    fn = Blocked(error=ValueError('boom'))
+
+    results = run_flight(flights, fn)
+
+    assert fn.calls == 1
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_results_that_cannot_be_shared_run_again():
+    flights = SingleFlight()
+    fn = Blocked('streamed')
+
+    results = run_flight(flights, fn, shareable=lambda result: False)
+
+    assert fn.calls == CALLERS
+    assert results == [('streamed', False)] * CALLERS
+
+
+@pytest.mark.parametrize('path', ['/people', '/people?limit=3'])
+def test_identical_requests_collapse(make_app, seed, monkeypatch, path):
+    app = make_app()
+    listing = Blocked()
+    listing_response = main.listing_response
+
+    def blocked_listing(*args, **kwargs):
+        listing()
+        return listing_response(*args, **kwargs)
+
+    monkeypatch.setattr(main, 'listing_response', blocked_listing)
+    threads, responses = concurrently(CALLERS, lambda i: app.test_client().get(path))
+    assert listing.entered.wait(10)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.2)
+    listing.release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert listing.calls == 1
+    assert [response.status_code for response in responses] == [200] * CALLERS
+    assert len({response.get_data() for response in responses}) == 1
+    assert len({response.headers['ETag'] for response in responses}) == 1
+    assert app.extensions['single_flight'].collapsed.series[('/people',)] == CALLERS - 1
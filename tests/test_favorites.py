@@ -0,0 +1,70 @@
+"""
+Batch favorites (favorites.py): the result of each item and the favorite
+counters of popularity.py moving with them.
+"""
+from models import db
+from popularity import rebuild_popularity, top_favorites
+
+
+def batch(client, body):
+    return client.post('/favorites/batch', json=body)
+
+
+def top(client, path='/people/top'):
+    return [(row['id'], row['favorites']) for row in client.get(path).get_json()]
+
+
+def test_each_item_gets_its_result(make_app, seed):
+    client = make_app().test_client()
+    assert client.post('/favorite/character?id_user=1&id_character=2').status_code == 200
+
+    response = batch(client, {'id_user': 1, 'character': {'add': [3, 3, 99, 'x', 2], 'remove': [2, 5]},
+                              'planets': {'add': [1]}})
+
+    assert response.status_code == 200
+    assert response.get_json() == {
+        'character': [
+            # removals first, so 2 is removed and added again
+            {'id': 2, 'op': 'remove', 'status': 'removed'},
+            {'id': 5, 'op': 'remove', 'status': 'not_favorite'},
+            {'id': 3, 'op': 'add', 'status': 'added'},
+            {'id': 3, 'op': 'add', 'status': 'already_favorite'},
+            {'id': 99, 'op': 'add', 'status': 'not_found'},
+            {'id': 'x', 'op': 'add', 'status': 'invalid'},
+            {'id': 2, 'op': 'add', 'status': 'added'},
+        ],
+        'planets': [{'id': 1, 'op': 'add', 'status': 'added'}],
+    }
+    favorites = client.get('/users/favorites?id_user=1').get_json()
+    assert favorites['character'] == [{'id_character': 2}, {'id_character': 3}]
+
+
+def test_the_counters_follow_the_batches(make_app, seed):
+    app = make_app()
+    client = app.test_client()
+
+    batch(client, {'id_user': 1, 'character': {'add': [3, 4]}, 'planets': {'add': [5]}})
+    batch(client, {'id_user': 2, 'character': {'add': [4, 4]}})
+    assert top(client) == [(4, 2), (3, 1)]
+    assert top(client, '/planets/top') == [(5, 1)]
+
+    batch(client, {'id_user': 1, 'character': {'remove': [4, 4, 7]}, 'planets': {'remove': [5]}})
+    assert top(client) == [(3, 1), (4, 1)]
+    assert top(client, '/planets/top') == []
+    # the same as counting the favorites tables again
+    with app.app_context():
+        counted = top_favorites('character', 10)
+        rebuild_popularity('character')
+        assert top_favorites('character', 10) == counted
+        db.session.rollback()
+
+
+def test_bad_batches_change_nothing(make_app, seed):
+    client = make_app().test_client()
+
+    assert batch(client, {'id_user': 'a', 'character': {'add': [1]}}).status_code == 400
+    assert batch(client, {'id_user': 1, 'character': {'add': 1}}).status_code == 400
+    assert batch(client, {'id_user': 1, 'character': {'add': list(range(501))}}).status_code == 400
+    assert batch(client, {'id_user': 99, 'character': {'add': [1]}}).status_code == 404
+    assert client.get('/users/favorites?id_user=1').get_json()['character'] == []
+    assert top(client) == []
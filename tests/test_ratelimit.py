@@ -0,0 +1,70 @@
+"""
+Rate limiting and load shedding (ratelimit.py): 429 and 503 with their
+Retry-After, and who a client is.
+"""
+RULES = 'GET /people* 1/m 2'
+
+
+def statuses(client, count, path='/people', **headers):
+    return [client.get(path, headers=headers).status_code for _ in range(count)]
+
+
+def test_over_the_limit_gets_429_and_retry_after(make_app, seed):
+    client = make_app(RATE_LIMIT_ENABLED='true', RATE_LIMITS=RULES, METRICS_ENABLED='true').test_client()
+
+    assert statuses(client, 2) == [200, 200]
+    response = client.get('/people?limit=1')
+    assert response.status_code == 429
+    assert 55 <= int(response.headers['Retry-After']) <= 60
+    assert response.get_json()['msg'].startswith('Demasiadas solicitudes')
+    # other routes have their own buckets, /metrics none
+    assert client.get('/planets').status_code == 200
+    assert statuses(client, 3, '/metrics') == [200, 200, 200]
+
+
+def test_made_up_keys_share_the_address_bucket(make_app, seed):
+    client = make_app(RATE_LIMIT_ENABLED='true', RATE_LIMITS=RULES, RATE_LIMIT_KEY_HEADER='X-Api-Key',
+                      RATE_LIMIT_API_KEYS='secret').test_client()
+
+    assert [client.get('/people', headers={'X-Api-Key': 'made-up-%d' % i}).status_code for i in range(3)] == \
+        [200, 200, 429]
+    # a known key is a client of its own
+    assert statuses(client, 3, **{'X-Api-Key': 'secret'}) == [200, 200, 429]
+
+
+def test_the_key_header_is_ignored_unless_configured(make_app, seed):
+    app = make_app(RATE_LIMIT_ENABLED='true', RATE_LIMITS=RULES)
+    client = app.test_client()
+
+    assert statuses(client, 3, **{'X-Api-Key': 'secret'}) == [200, 200, 429]
+    assert app.extensions['admission'].client_key({'x-api-key': 'secret'}, '10.0.0.1') == 'ip:10.0.0.1'
+
+
+class FullPool:
+    """A pool with every connection checked out."""
+
+    _max_overflow = 0
+
+    def size(self):
+        return 2
+
+    def checkedout(self):
+        return 2
+
+
+def test_requests_beyond_the_queue_get_503(make_app, seed):
+    app = make_app(LOAD_SHED_MAX_QUEUE='1', LOAD_SHED_RETRY_AFTER='3', METRICS_ENABLED='true')
+    admission = app.extensions['admission']
+    # SQLite's pool never queues: stand in a saturated one, with one request already waiting
+    admission.pools = [FullPool()]
+    admission.inflight = 3
+    client = app.test_client()
+
+    response = client.get('/people')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '3'
+    assert client.get('/metrics').status_code == 200
+    assert admission.shed == 1
+    admission.inflight = 2
+    assert client.get('/people').status_code == 200
+    assert admission.inflight == 2
@@ -0,0 +1,106 @@
+"""
+Read replicas (replicas.py) on two SQLite files: the replica is a copy of
+the primary taken before the writes of each test, so it lags behind them.
+"""
+import shutil
+import sqlite3
+import pytest
+from conftest import age_change_log, rename, sqlite_url
+from models import Character
+
+
+@pytest.fixture
+def replica(seed, primary, tmp_path):
+    path = tmp_path / 'replica.db'
+    shutil.copyfile(str(primary), str(path))
+    return path
+
+
+def mark_replica(path, id, name):
+    """Changes a character in the replica only, to tell which database answered."""
+    with sqlite3.connect(str(path)) as connection:
+        connection.execute('UPDATE character SET name = ? WHERE id = ?', (name, id))
+
+
+def names(response):
+    return [row['name'] for row in response.get_json()]
+
+
+def test_reads_go_to_the_replica(make_app, replica):
+    mark_replica(replica, 1, 'From the replica')
+    app = make_app(DB_REPLICA_URLS=sqlite_url(replica))
+    client = app.test_client()
+
+    assert names(client.get('/people?limit=2')) == ['From the replica', 'Character 2']
+    assert app.extensions['replicas'].picked == [1]
+
+
+def test_reads_fall_back_to_the_primary_without_a_healthy_replica(make_app, seed, tmp_path):
+    app = make_app(DB_REPLICA_URLS=sqlite_url(tmp_path / 'missing' / 'replica.db'))
+
+    assert names(app.test_client().get('/people?limit=1')) == ['Character 1']
+    assert app.extensions['replicas'].healthy == [False]
+    assert app.extensions['replicas'].fallbacks == 1
+
+
+def test_writer_reads_its_own_writes(make_app, replica):
+    app = make_app(DB_REPLICA_URLS=sqlite_url(replica))
+    writer = app.test_client()
+
+    response = writer.post('/favorite/character?id_user=1&id_character=2')
+    assert response.status_code == 200
+    assert 'read_primary_until' in response.headers['Set-Cookie']
+    expected = [{'id_character': 2}]
+    # the cookie, then the id_user for a client that does not keep it
+    assert writer.get('/users/favorites?id_user=1').get_json()['character'] == expected
+    assert app.test_client().get('/users/favorites?id_user=1').get_json()['character'] == expected
+    # any other client reads the replica, which has not caught up
+    assert app.test_client().get('/users/favorites?id_user=2').get_json()['character'] == []
+    assert app.extensions['replicas'].picked == [1]
+
+
+def test_recent_changes_are_read_from_the_primary(make_app, replica):
+    app = make_app(DB_REPLICA_URLS=sqlite_url(replica))
+    rename(app, Character, 1, 'Renamed')
+
+    # the ETag already names the change: a lagging replica must not answer under it
+    client = app.test_client()
+    assert names(client.get('/people?limit=1')) == ['Renamed']
+    # streamed, the rows are read after the view returned
+    assert names(client.get('/people?stream=true&limit=1')) == ['Renamed']
+    assert app.extensions['replicas'].picked == [0]
+
+
+@pytest.mark.parametrize('path, read', [
+    ('/character/3', lambda response: response.get_json()['name']),
+    ('/people?ids=3', lambda response: response.get_json()['results'][0]['name']),
+    ('/people', lambda response: response.get_json()[2]['name']),
+])
+def test_cached_reads_come_from_the_primary(make_app, replica, primary, path, read):
+    app = make_app(DB_REPLICA_URLS=sqlite_url(replica))
+    rename(app, Character, 3, 'Renamed')
+    # past DB_READ_YOUR_WRITES, but the replica still lags
+    age_change_log(primary)
+    client = app.test_client()
+
+    assert read(client.get(path)) == 'Renamed'
+    # served again from what the first request cached
+    assert read(client.get(path)) == 'Renamed'
+    assert names(client.get('/people?limit=3'))[2] == 'Character 3'
+
+
+def test_changes_from_another_process_move_the_etags(make_app, seed):
+    # replayed from the change log on every request
+    app, other = make_app(CHANGES_POLL_INTERVAL='0'), make_app()
+    client = app.test_client()
+    listing = client.get('/people').headers['ETag']
+    row = client.get('/character/3').headers['ETag']
+    untouched = client.get('/character/4').headers['ETag']
+
+    rename(other, Character, 3, 'Renamed')
+
+    response = client.get('/people', headers={'If-None-Match': listing})
+    assert response.status_code == 200
+    assert response.get_json()[2]['name'] == 'Renamed'
+    assert client.get('/character/3', headers={'If-None-Match': row}).status_code == 200
+    assert client.get('/character/4', headers={'If-None-Match': untouched}).status_code == 304
@@ -0,0 +1,107 @@
+"""
+Prefix search (search.py): the multi-word ranking against a scan of every
+row, and the index kept current without holding searches: full reloads are
+built in the background, refreshes read the database outside the lock.
+"""
+import heapq
+import sqlite3
+import threading
+from collections import namedtuple
+import pytest
+from conftest import rename
+from models import db, Character, Planet
+from search import TableIndex, tokenize
+from versions import mark_changed
+
+Row = namedtuple('Row', 'id url name climate terrain')
+
+WORDS = ['alpha', 'alder', 'beta', 'bravo', 'arid', 'desert', 'temperate', 'tundra', 'dune', 'delta']
+
+
+def planets(count=300):
+    """Rows with names of one to three words, sharing prefixes between the names and the extra fields."""
+    for id in range(1, count + 1):
+        name = ' '.join(WORDS[(id * step) % len(WORDS)] for step in range(1, id % 3 + 2))
+        yield Row(id, 'u%d' % id, name, WORDS[id % 7], WORDS[id % 4 + 5])
+
+
+def scan(index, terms, count):
+    """The ranking of `index.ranked`, checking every row."""
+    matching = []
+    for id, (name, url, name_tokens, extra_tokens) in index.docs.items():
+        if all(any(token.startswith(term) for token in name_tokens + extra_tokens) for term in terms):
+            matching.append(index.rank(id, terms))
+    return heapq.nsmallest(count, matching)
+
+
+@pytest.mark.parametrize('q', ['al be', 'alpha d', 'd a', 'de te', 'b b', 'delta tundra arid', 'a zz', 'tun al'])
+def test_several_words_intersect_the_postings(q):
+    index = TableIndex(Planet, ('name',), ('climate', 'terrain'))
+    for row in planets():
+        index._add(row)
+
+    terms = tokenize(q)
+    assert index.ranked(terms, 20) == scan(index, terms, 20)
+    assert index.ranked(terms, 1000) == scan(index, terms, 1000)
+
+
+def search(client, q):
+    return [result['name'] for result in client.get('/search?type=character&q=%s' % q).get_json()['results']]
+
+
+def test_reloads_run_in_the_background(make_app, seed, primary, monkeypatch):
+    app = make_app(CHANGES_SETTLE='0')
+    client = app.test_client()
+    assert search(client, 'character 3') == ['Character 3']
+
+    release = threading.Event()
+    load = TableIndex.load
+
+    def blocked_load(index, session):
+        release.wait(10)
+        load(index, session)
+
+    monkeypatch.setattr(TableIndex, 'load', blocked_load)
+    # a change that names no rows: the index must reload
+    with sqlite3.connect(str(primary)) as connection:
+        connection.execute("UPDATE character SET name = 'Zeta' WHERE id = 3")
+    with app.app_context():
+        mark_changed(db.session, 'character')
+        db.session.commit()
+
+    # answered from the previous index while the new one loads
+    assert search(client, 'zeta') == []
+    assert search(client, 'character 3') == ['Character 3']
+    loading = app.extensions['search_index'].loading['character']
+    release.set()
+    assert loading.wait(10)
+    assert search(client, 'zeta') == ['Zeta']
+    assert search(client, 'character 3') == []
+
+
+def test_refreshes_read_outside_the_lock(make_app, seed, monkeypatch):
+    app = make_app(CHANGES_SETTLE='0')
+    index = app.extensions['search_index']
+    assert search(app.test_client(), 'character 3') == ['Character 3']
+
+    entered, release = threading.Event(), threading.Event()
+    fetch = TableIndex.fetch
+
+    def blocked_fetch(table_index, session, ids):
+        entered.set()
+        release.wait(10)
+        return fetch(table_index, session, ids)
+
+    monkeypatch.setattr(TableIndex, 'fetch', blocked_fetch)
+    rename(app, Character, 3, 'Zeta')
+    results = []
+    searching = threading.Thread(target=lambda: results.append(search(app.test_client(), 'zeta')))
+    searching.start()
+    assert entered.wait(10)
+
+    # the refresh is reading its rows: other searches can still take the lock
+    assert index.lock.acquire(timeout=1)
+    index.lock.release()
+    release.set()
+    searching.join(10)
+    assert results == [['Zeta']]
@@ -0,0 +1,49 @@
+"""
+Listing encoders (serializers.py): the same bytes `jsonify` gives for the
+serialized objects, with either JSON backend, streamed or not.
+"""
+import pytest
+from flask import jsonify
+from models import db, Character, Planet
+
+ODD_NAMES = ['Niño Über', 'Say "hi"', 'back\\slash', 'tab\there', 'emoji \U0001f680', '</script>', '']
+
+
+@pytest.fixture
+def odd_rows(seed, make_app):
+    app = make_app()
+    with app.app_context():
+        for id, name in enumerate(ODD_NAMES, start=1):
+            character = db.session.get(Character, id)
+            character.name = name
+            character.height = None if id % 2 else id * 10
+            character.birth_year = '19BBY' if id % 3 else None
+            db.session.get(Planet, id).climate = name
+        db.session.commit()
+
+
+def jsonified(app, model, fields=None):
+    with app.test_request_context():
+        rows = [row.serialize() for row in model.query.order_by(model.id)]
+        if fields:
+            rows = [{field: row[field] for field in fields} for row in rows]
+        return jsonify(rows).get_data()
+
+
+@pytest.mark.parametrize('backend', ['builtin', 'orjson'])
+@pytest.mark.parametrize('path, model', [('/people', Character), ('/planets', Planet)])
+def test_listings_match_jsonify(make_app, odd_rows, backend, path, model):
+    app = make_app(JSON_BACKEND=backend)
+    client = app.test_client()
+    expected = jsonified(app, model)
+
+    assert client.get(path).get_data() == expected
+    assert client.get(path + '?limit=100').get_data() == expected
+    assert client.get(path + '?stream=true').get_data() == expected
+
+
+def test_projected_fields_match_jsonify(make_app, odd_rows):
+    app = make_app()
+
+    assert app.test_client().get('/people?fields=name,id,height').get_data() == \
+        jsonified(app, Character, ['name', 'id', 'height'])
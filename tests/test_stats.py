@@ -0,0 +1,93 @@
+"""
+Grouped statistics (stats.py): the aggregates per group and the percentiles
+interpolated as PostgreSQL's percentile_cont does, checked against
+`statistics.quantiles(method='inclusive')`, the same linear interpolation.
+"""
+import statistics
+import pytest
+from models import db, Character
+from stats import interpolate
+
+# id -> (gender, height, mass); None heights are left out of the column stats
+PEOPLE = {
+    1: ('female', 150, 50), 2: ('female', 172, None), 3: ('female', 165, 61), 4: ('female', None, 70),
+    5: ('male', 180, 80), 6: ('male', 202, 120), 7: ('male', 175, 77), 8: ('male', 183, 90),
+    9: ('male', 96, 32), 10: (None, 66, 17),
+}
+PERCENTILES = (0, 1, 25, 50, 90, 99, 100)
+
+
+@pytest.fixture
+def people(make_app, seed):
+    app = make_app()
+    with app.app_context():
+        for id, (gender, height, mass) in PEOPLE.items():
+            character = db.session.get(Character, id)
+            character.gender, character.height, character.mass = gender, height, mass
+        db.session.commit()
+    return app
+
+
+def percentile_cont(values, percentile):
+    values = sorted(values)
+    if len(values) == 1 or percentile == 0:
+        return float(values[0])
+    if percentile == 100:
+        return float(values[-1])
+    return statistics.quantiles(values, n=100, method='inclusive')[percentile - 1]
+
+
+def stats(client, query):
+    response = client.get('/stats/people?' + query)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+@pytest.mark.parametrize('values', [[7], [1, 2], [150, 172, 165], [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5]])
+def test_interpolate_matches_percentile_cont(values):
+    for percentile in PERCENTILES:
+        assert interpolate(sorted(values), percentile / 100) == pytest.approx(percentile_cont(values, percentile))
+
+
+def test_groups_match_their_rows(people):
+    query = 'by=gender&columns=height,mass&percentiles=%s' % ','.join(map(str, PERCENTILES))
+    found = stats(people.test_client(), query)
+
+    assert found['by'] == 'gender'
+    assert found['columns'] == ['height', 'mass']
+    # sorted by group, the rows without one last
+    assert [group['group'] for group in found['groups']] == ['female', 'male', None]
+    for group in found['groups']:
+        rows = [row for row in PEOPLE.values() if row[0] == group['group']]
+        assert group['count'] == len(rows)
+        for index, name in ((1, 'height'), (2, 'mass')):
+            values = [row[index] for row in rows if row[index] is not None]
+            column = group['columns'][name]
+            assert column['count'] == len(values)
+            assert (column['min'], column['max'], column['sum']) == (min(values), max(values), sum(values))
+            assert column['mean'] == pytest.approx(statistics.mean(values))
+            for percentile in PERCENTILES:
+                assert column['p%d' % percentile] == pytest.approx(percentile_cont(values, percentile))
+
+
+def test_filters_apply_and_changes_show(people):
+    client = people.test_client()
+    heights = [row[1] for row in PEOPLE.values() if row[1] is not None and row[1] <= 175]
+
+    found = stats(client, 'columns=height&height_max=175&percentiles=50')['groups']
+    assert found == [{'group': None, 'count': len(heights), 'columns': {'height': {
+        'count': len(heights), 'min': min(heights), 'max': max(heights), 'sum': sum(heights),
+        'mean': pytest.approx(statistics.mean(heights)), 'p50': pytest.approx(statistics.median(heights))}}}]
+
+    before = stats(client, 'columns=height')['groups'][0]['columns']['height']
+    with people.app_context():
+        db.session.get(Character, 6).height = 250
+        db.session.commit()
+    after = stats(client, 'columns=height')['groups'][0]['columns']['height']
+    assert (before['max'], after['max']) == (202, 250)
+
+
+@pytest.mark.parametrize('query', ['by=name', 'columns=foo', 'percentiles=120', 'percentiles=a',
+                                   'percentiles=' + ','.join(map(str, range(11)))])
+def test_bad_arguments_are_400(people, query):
+    assert people.test_client().get('/stats/people?' + query).status_code == 400
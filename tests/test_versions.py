@@ -0,0 +1,67 @@
+"""
+Data versions (versions.py) behind the ETags: reused for VERSIONS_MAX_AGE,
+moved at once by the process's own commits and by the replayed change log.
+"""
+from contextlib import contextmanager
+from sqlalchemy import event
+from conftest import rename
+from models import db, Character
+
+
+@contextmanager
+def statements(app):
+    """Collects the SQL run on the primary inside the block."""
+    executed = []
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', collect)
+    try:
+        yield executed
+    finally:
+        event.remove(engine, 'before_cursor_execute', collect)
+
+
+def test_revalidations_run_no_query(make_app, seed):
+    app = make_app(CHANGES_POLL_INTERVAL='60')
+    client = app.test_client()
+    etag = client.get('/people').headers['ETag']
+    row = client.get('/character/3').headers['ETag']
+
+    with statements(app) as executed:
+        for _ in range(3):
+            assert client.get('/people', headers={'If-None-Match': etag}).status_code == 304
+            assert client.get('/character/3', headers={'If-None-Match': row}).status_code == 304
+
+    assert executed == []
+
+
+def test_own_commits_move_the_etags_at_once(make_app, seed):
+    app = make_app(CHANGES_POLL_INTERVAL='60')
+    client = app.test_client()
+    etag = client.get('/people').headers['ETag']
+
+    rename(app, Character, 3, 'Renamed')
+
+    response = client.get('/people', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()[2]['name'] == 'Renamed'
+
+
+def test_versions_of_other_processes_wait_for_the_replay(make_app, seed):
+    app, other = make_app(CHANGES_POLL_INTERVAL='60'), make_app()
+    client = app.test_client()
+    etag = client.get('/people').headers['ETag']
+
+    rename(other, Character, 3, 'Renamed')
+
+    # within VERSIONS_MAX_AGE and before the next poll: the version read before
+    assert client.get('/people', headers={'If-None-Match': etag}).status_code == 304
+    with app.test_request_context():
+        app.extensions['change_log_follower'].catch_up(db.session)
+    response = client.get('/people', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()[2]['name'] == 'Renamed'